@@ -0,0 +1,8 @@
+'''
+Benchmarks for Trixy. Each module can be run on its own, for example::
+
+   python3 -m benchmarks.buffers
+
+benchmarks.proxy measures whole configurations end to end, and
+benchmarks.tls measures TLS handshakes.
+'''
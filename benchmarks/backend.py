@@ -0,0 +1,111 @@
+'''
+A local echo server for the benchmarks to send traffic to, and helpers
+to run it (and Trixy) in processes of their own.
+'''
+import asyncio
+import os
+import resource
+import signal
+import socket
+import time
+
+
+class EchoProtocol(asyncio.Protocol):
+    '''
+    Send everything received straight back, and stop reading while the
+    client is not keeping up.
+    '''
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.transport.write(data)
+
+    def pause_writing(self):
+        self.transport.pause_reading()
+
+    def resume_writing(self):
+        self.transport.resume_reading()
+
+
+def run_echo_server(host, port):
+    '''
+    Serve echo connections on `host` and `port` until killed.
+    '''
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(
+        loop.create_server(EchoProtocol, host, port, backlog=1024))
+    loop.run_forever()
+
+
+def raise_file_limit():
+    '''
+    Allow as many open files as the hard limit permits.
+    '''
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def spawn(func, *args):
+    '''
+    Run `func(*args)` in a child process and return its pid.
+    '''
+    pid = os.fork()
+    if pid == 0:
+        status = 0
+        try:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            func(*args)
+        except BaseException:
+            status = 1
+        finally:
+            os._exit(status)
+    return pid
+
+
+def stop(pid):
+    '''
+    Kill a process started with spawn and wait for it.
+    '''
+    try:
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+    except (ProcessLookupError, ChildProcessError):
+        pass
+
+
+def wait_listening(host, port, timeout=5):
+    '''
+    Wait until something accepts connections on `host` and `port`.
+    '''
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.01)
+
+
+def free_port(host):
+    '''
+    Return a port that nothing is listening on right now.
+    '''
+    with socket.socket() as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+
+def rss(pid):
+    '''
+    Return the resident set size of a process in bytes.
+    '''
+    with open('/proc/%i/status' % pid) as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return 0
@@ -0,0 +1,58 @@
+'''
+Compare the per-byte cost of buffering data in a bytes object (the way
+dispatcher_with_send does) against trixy.buffers.ChunkBuffer as the
+backlog grows.
+
+The workload appends a backlog of 16 KiB chunks and then drains it
+with partial sends of 65536 bytes minus one (so that no send lines up
+with a chunk boundary), the pattern a slow socket produces.
+'''
+import time
+from trixy.buffers import ChunkBuffer
+
+
+CHUNK = b'x' * 16384
+SEND_SIZE = 65535
+
+
+def bytes_buffer(backlog):
+    buf = b''
+    for i in range(backlog // len(CHUNK)):
+        buf += CHUNK
+    while buf:
+        sent = len(buf[:SEND_SIZE])
+        buf = buf[sent:]
+
+
+def chunk_buffer(backlog):
+    buf = ChunkBuffer()
+    for i in range(backlog // len(CHUNK)):
+        buf.append(CHUNK)
+    while buf:
+        buf.consume(len(buf.peek(SEND_SIZE)))
+
+
+def measure(func, backlog, repeat=3):
+    '''
+    Return the best time per byte, in nanoseconds, of `repeat` runs.
+    '''
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        func(backlog)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best / backlog * 1e9
+
+
+def main():
+    print('%12s %14s %14s' % ('backlog', 'bytes ns/B', 'chunks ns/B'))
+    for mib in (1, 2, 4, 8, 16, 32):
+        backlog = mib * 1024 * 1024
+        print('%10iMi %14.3f %14.3f' % (mib, measure(bytes_buffer, backlog),
+                                        measure(chunk_buffer, backlog)))
+
+
+if __name__ == '__main__':
+    main()
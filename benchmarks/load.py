@@ -0,0 +1,122 @@
+'''
+A load generator for the benchmarks. Each measurement takes an `opener`:
+a coroutine function that connects through the proxy under test,
+completes any proxy handshake, and returns an asyncio (reader, writer)
+pair connected to the echo backend.
+'''
+import asyncio
+import time
+
+
+def percentile(samples, fraction):
+    '''
+    Return the value below which `fraction` of the sorted `samples` lie.
+    '''
+    if not samples:
+        return float('nan')
+    index = min(int(len(samples) * fraction), len(samples) - 1)
+    return samples[index]
+
+
+async def close(writer):
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        pass
+
+
+async def connection_rate(opener, duration, concurrency):
+    '''
+    Open a connection, echo one byte over it, and close it again, as
+    often as possible from `concurrency` clients at once.
+
+    :returns: Connections per second.
+    '''
+    deadline = time.monotonic() + duration
+    count = 0
+
+    async def client():
+        nonlocal count
+        while time.monotonic() < deadline:
+            reader, writer = await opener()
+            writer.write(b'x')
+            await reader.readexactly(1)
+            await close(writer)
+            count += 1
+
+    start = time.monotonic()
+    await asyncio.gather(*(client() for i in range(concurrency)))
+    return count / (time.monotonic() - start)
+
+
+async def latency(opener, duration, concurrency, size=64):
+    '''
+    Send `size` byte messages and wait for their echo, one at a time on
+    each of `concurrency` open connections.
+
+    :returns: A sorted list of round trip times in seconds.
+    '''
+    message = b'x' * size
+    samples = []
+    connections = [await opener() for i in range(concurrency)]
+    deadline = time.monotonic() + duration
+
+    async def client(reader, writer):
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            writer.write(message)
+            await reader.readexactly(size)
+            samples.append(time.perf_counter() - start)
+
+    await asyncio.gather(*(client(*c) for c in connections))
+    for reader, writer in connections:
+        await close(writer)
+    samples.sort()
+    return samples
+
+
+async def throughput(opener, total, chunk_size=65536):
+    '''
+    Stream `total` bytes through one connection while reading the echo
+    back at the same time.
+
+    :returns: Bytes per second.
+    '''
+    reader, writer = await opener()
+    chunk = b'x' * chunk_size
+
+    async def send():
+        for i in range(total // chunk_size):
+            writer.write(chunk)
+            await writer.drain()
+
+    async def receive():
+        remaining = total // chunk_size * chunk_size
+        while remaining:
+            data = await reader.read(min(remaining, 1 << 20))
+            if not data:
+                raise ConnectionError('Connection closed early')
+            remaining -= len(data)
+
+    start = time.monotonic()
+    await asyncio.gather(send(), receive())
+    elapsed = time.monotonic() - start
+    await close(writer)
+    return total / elapsed
+
+
+async def hold_connections(opener, count):
+    '''
+    Open `count` connections and echo a byte over each of them, so that
+    every connection has been fully set up by the proxy.
+
+    :returns: The open (reader, writer) pairs.
+    '''
+    connections = []
+    for i in range(count):
+        reader, writer = await opener()
+        writer.write(b'x')
+        await reader.readexactly(1)
+        connections.append((reader, writer))
+    return connections
@@ -0,0 +1,205 @@
+'''
+Measure Trixy end to end. A local echo backend and a TrixyServer each
+run in a process of their own, and a load generator in this process
+connects through Trixy to the backend. For every configuration it
+reports:
+
+* connections per second (connect, echo one byte, close),
+* throughput of a single bulk transfer,
+* p50 and p99 round trip latency of small messages, and
+* the growth of Trixy's resident memory per idle connection.
+
+Run all configurations with::
+
+   python3 -m benchmarks.proxy
+
+or pick some with, for example, ``--configs plain socks5``. Use
+``--json`` to get machine readable results to compare between builds.
+'''
+import argparse
+import asyncio
+import json
+import os
+import socket
+import ssl
+import struct
+import trixy
+import trixy.encryption
+import trixy.proxy
+import trixy.timers
+from benchmarks import backend, load
+
+
+HOST = '127.0.0.1'
+CERTFILE = os.path.join(os.path.dirname(__file__), os.pardir, 'tests',
+                        'certs', 'localhost.pem')
+
+#: The (host, port) of the echo backend, set before Trixy is started.
+BACKEND = None
+
+
+class PassProcessor(trixy.TrixyProcessor):
+    '''
+    Forward data unchanged. Defining the handlers makes the chain
+    non-opaque, so data takes the normal path through every node.
+    '''
+
+    def handle_packet_down(self, data):
+        self.forward_packet_down(data)
+
+    def handle_packet_up(self, data):
+        self.forward_packet_up(data)
+
+
+class PlainInput(trixy.TrixyInput):
+    def __init__(self, sock, addr):
+        super().__init__(sock, addr)
+        self.connect_node(trixy.TrixyOutput(*BACKEND))
+
+
+class ChainedInput(trixy.TrixyInput):
+    #: The number of processors between the input and the output.
+    processors = 3
+
+    def __init__(self, sock, addr):
+        super().__init__(sock, addr)
+        node = self
+        for i in range(self.processors):
+            processor = PassProcessor()
+            node.connect_node(processor)
+            node = processor
+        node.connect_node(trixy.TrixyOutput(*BACKEND))
+
+
+class TLSInput(trixy.encryption.TrixySSLInput):
+    def __init__(self, sock, addr):
+        super().__init__(sock, addr, certfile=CERTFILE)
+        self.connect_node(trixy.TrixyOutput(*BACKEND))
+
+
+async def open_plain(port):
+    return await asyncio.open_connection(HOST, port)
+
+
+async def open_socks4(port):
+    reader, writer = await asyncio.open_connection(HOST, port)
+    writer.write(b'\x04\x01' + struct.pack('!H', BACKEND[1]) +
+                 socket.inet_aton(BACKEND[0]) + b'\x00')
+    reply = await reader.readexactly(8)
+    if reply[1] != 90:
+        raise ConnectionError('SOCKS4 request failed: %i' % reply[1])
+    return reader, writer
+
+
+async def open_socks5(port):
+    reader, writer = await asyncio.open_connection(HOST, port)
+    writer.write(b'\x05\x01\x00' + b'\x05\x01\x00\x01' +
+                 socket.inet_aton(BACKEND[0]) + struct.pack('!H', BACKEND[1]))
+    reply = await reader.readexactly(12)
+    if reply[3] != 0:
+        raise ConnectionError('SOCKS5 request failed: %i' % reply[3])
+    return reader, writer
+
+
+CLIENT_CONTEXT = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+CLIENT_CONTEXT.check_hostname = False
+CLIENT_CONTEXT.verify_mode = ssl.CERT_NONE
+
+
+async def open_tls(port):
+    return await asyncio.open_connection(HOST, port, ssl=CLIENT_CONTEXT)
+
+
+#: Maps a configuration name to its input class and client opener.
+CONFIGS = {
+    'plain': (PlainInput, open_plain),
+    'chained': (ChainedInput, open_plain),
+    'socks4': (trixy.proxy.Socks4Input, open_socks4),
+    'socks5': (trixy.proxy.Socks5Input, open_socks5),
+    'tls': (TLSInput, open_tls),
+}
+
+
+def run_trixy(tinput, port):
+    backend.raise_file_limit()
+    trixy.TrixyServer(tinput, HOST, port)
+    trixy.timers.loop(use_poll=True)
+
+
+async def measure(opener, pid, args):
+    results = {}
+    # Measure memory first, before other measurements leave freed
+    # memory behind for the new connections to reuse.
+    before = backend.rss(pid)
+    connections = await load.hold_connections(opener, args.idle)
+    results['rss_per_conn_kib'] = (
+        (backend.rss(pid) - before) / args.idle / 1024)
+    for reader, writer in connections:
+        await load.close(writer)
+
+    results['conn_per_sec'] = await load.connection_rate(
+        opener, args.duration, args.concurrency)
+    results['mib_per_sec'] = await load.throughput(
+        opener, args.bulk_mib << 20) / (1 << 20)
+    samples = await load.latency(opener, args.duration, args.concurrency)
+    results['p50_ms'] = load.percentile(samples, 0.50) * 1000
+    results['p99_ms'] = load.percentile(samples, 0.99) * 1000
+    return results
+
+
+def run_config(name, args):
+    tinput, opener = CONFIGS[name]
+    port = backend.free_port(HOST)
+    pid = backend.spawn(run_trixy, tinput, port)
+    try:
+        backend.wait_listening(HOST, port)
+        return asyncio.run(
+            measure(lambda: opener(port), pid, args))
+    finally:
+        backend.stop(pid)
+
+
+def main():
+    global BACKEND
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--configs', nargs='+', choices=list(CONFIGS),
+                        default=list(CONFIGS))
+    parser.add_argument('--duration', type=float, default=3,
+                        help='Seconds to run each timed measurement.')
+    parser.add_argument('--concurrency', type=int, default=16,
+                        help='Simultaneous clients.')
+    parser.add_argument('--bulk-mib', type=int, default=256,
+                        help='MiB to send in the throughput measurement.')
+    parser.add_argument('--idle', type=int, default=500,
+                        help='Connections to hold open to measure memory.')
+    parser.add_argument('--json', action='store_true',
+                        help='Print the results as JSON.')
+    args = parser.parse_args()
+
+    backend.raise_file_limit()
+    BACKEND = (HOST, backend.free_port(HOST))
+    echo = backend.spawn(backend.run_echo_server, *BACKEND)
+    results = {}
+    try:
+        backend.wait_listening(*BACKEND)
+        for name in args.configs:
+            results[name] = run_config(name, args)
+            if not args.json:
+                if len(results) == 1:
+                    print('%8s %10s %10s %9s %9s %13s' % (
+                        'config', 'conn/s', 'MiB/s', 'p50 ms', 'p99 ms',
+                        'KiB/conn'))
+                print('%8s %10.1f %10.1f %9.3f %9.3f %13.1f' % (
+                    name, *(results[name][key] for key in (
+                        'conn_per_sec', 'mib_per_sec', 'p50_ms', 'p99_ms',
+                        'rss_per_conn_kib'))))
+    finally:
+        backend.stop(echo)
+
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+'''
+Compare TLS handshakes per second with a new SSLContext for every
+connection (the way TrixySSLInput and TrixySSLOutput used to work)
+against shared contexts from trixy.encryption.ContextRegistry, with and
+without session resumption.
+
+The server and client run in the same process on the loopback
+interface, so the numbers include the work of both sides.
+'''
+import os
+import socket
+import ssl
+import threading
+import time
+from trixy.encryption import ContextRegistry
+
+
+CERTFILE = os.path.join(os.path.dirname(__file__), os.pardir, 'tests',
+                        'certs', 'localhost.pem')
+HOST = '127.0.0.1'
+CONNECTIONS = 300
+
+
+def new_server_context():
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(CERTFILE)
+    return context
+
+
+def new_client_context():
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+def serve(lsock, get_context, count):
+    for i in range(count):
+        sock = lsock.accept()[0]
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock = get_context().wrap_socket(sock, server_side=True)
+        sock.sendall(b'x')
+        sock.recv(1)
+        sock.close()
+
+
+def run(mode, count=CONNECTIONS):
+    '''
+    Return the number of handshakes per second for `mode`.
+    '''
+    registry = ContextRegistry()
+    if mode == 'per-connection':
+        server_context = new_server_context
+        client_context = new_client_context
+    else:
+        server_context = lambda: registry.server_context(CERTFILE)
+        client_context = lambda: registry.client_context(
+            cert_reqs=ssl.CERT_NONE)
+
+    lsock = socket.socket()
+    lsock.bind((HOST, 0))
+    lsock.listen(16)
+    port = lsock.getsockname()[1]
+    thread = threading.Thread(target=serve,
+                              args=(lsock, server_context, count))
+    thread.start()
+
+    start = time.perf_counter()
+    for i in range(count):
+        context = client_context()
+        session = None
+        if mode == 'resumed':
+            session = registry.session(context, HOST, port)
+        sock = socket.socket()
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock = context.wrap_socket(sock, session=session)
+        sock.connect((HOST, port))
+        sock.recv(1)  # Also receives any session tickets.
+        registry.save_session(HOST, port, sock)
+        sock.close()
+    elapsed = time.perf_counter() - start
+
+    thread.join()
+    lsock.close()
+    return count / elapsed
+
+
+def main():
+    print('%16s %14s' % ('contexts', 'handshakes/s'))
+    for mode in ('per-connection', 'shared', 'resumed'):
+        print('%16s %14.1f' % (mode, run(mode)))
+
+
+if __name__ == '__main__':
+    main()
@@ -18,9 +18,28 @@ So, you should switch to nosetests soon.
 sys.path.insert(1, 'trixy')  # Load trixy from local src directory
 sys.path.insert(1, 'tests')  # Allow tests to be run stand-alone from IDE
 
+from tests.test_admission import *
+from tests.test_aio import *
+from tests.test_backpressure import *
+from tests.test_batch import *
+from tests.test_buffers import *
+from tests.test_capture import *
+from tests.test_chain import *
 from tests.test_chaining import *
 from tests.test_closing import *
+from tests.test_encryption import *
+from tests.test_executor import *
+from tests.test_http import *
+from tests.test_metrics import *
+from tests.test_passthrough import *
+from tests.test_pool import *
+from tests.test_processors import *
 from tests.test_proxy import *
+from tests.test_replay import *
+from tests.test_resolver import *
+from tests.test_tee import *
+from tests.test_timers import *
+from tests.test_workers import *
 
 
 if __name__ == '__main__':
@@ -0,0 +1,135 @@
+'''
+Test admission control and per-client rate limits.
+'''
+import socket
+import time
+import unittest
+import trixy
+import trixy.admission
+from tests import utils
+from tests.utils import SRV_HOST, SRV_PORT, LOC_HOST, LOC_PORT
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_take(self):
+        bucket = trixy.admission.TokenBucket(2, burst=3)
+        now = bucket.updated
+        self.assertTrue(bucket.take(3, now))
+        self.assertFalse(bucket.take(1, now))
+        self.assertTrue(bucket.take(1, now + 0.5))
+        self.assertFalse(bucket.take(4, now + 100))
+
+    def test_charge(self):
+        bucket = trixy.admission.TokenBucket(100)
+        now = bucket.updated
+        self.assertEqual(bucket.charge(50, now), 0)
+        self.assertAlmostEqual(bucket.charge(100, now), 0.5)
+        self.assertEqual(bucket.charge(0, now + 0.5), 0)
+
+
+class TestAdmission(unittest.TestCase):
+    def test_client_limit(self):
+        admission = trixy.admission.Admission(connect_rate=1, max_clients=2)
+        self.assertIsNotNone(admission.admit(('10.0.0.1', 1)))
+        self.assertIsNone(admission.admit(('10.0.0.1', 2)))
+        self.assertIsNotNone(admission.admit(('10.0.0.2', 1)))
+        self.assertIsNotNone(admission.admit(('10.0.0.3', 1)))
+        self.assertEqual(list(admission.clients), ['10.0.0.2', '10.0.0.3'])
+        self.assertEqual(admission.rejected, 1)
+
+    def test_open_clients_kept(self):
+        '''
+        Test that a client with open connections is not forgotten, which
+        would give its next connection fresh limits.
+        '''
+        admission = trixy.admission.Admission(connect_rate=1, max_clients=1)
+        conn = trixy.TrixyConnection()
+        admission.opened(conn, admission.admit(('10.0.0.1', 1)))
+        self.assertIsNotNone(admission.admit(('10.0.0.2', 1)))
+        self.assertIsNone(admission.admit(('10.0.0.1', 2)))
+        self.assertEqual(list(admission.clients), ['10.0.0.2', '10.0.0.1'])
+
+        conn.close()
+        self.assertEqual(admission.clients['10.0.0.1'].connections, 0)
+        self.assertIsNotNone(admission.admit(('10.0.0.3', 1)))
+        self.assertEqual(list(admission.clients), ['10.0.0.3'])
+
+
+class AdmissionInput(trixy.TrixyInput):
+    def __init__(self, sock, addr):
+        super().__init__(sock, addr)
+        self.connect_node(trixy.TrixyOutput(LOC_HOST, LOC_PORT))
+
+
+class TestAdmissionServer(utils.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.server = None
+        self.rsock = socket.socket()
+        self.rsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.rsock.bind((LOC_HOST, LOC_PORT))
+        self.rsock.listen(8)
+        self.rsock.settimeout(2)
+
+    def tearDown(self):
+        super().tearDown()
+        self.server.close()
+        self.rsock.close()
+
+    def test_max_connections(self):
+        '''
+        Test that connections over the limit are refused, and that the
+        limit frees up when a connection closes.
+        '''
+        admission = trixy.admission.Admission(max_connections=1)
+        self.server = trixy.TrixyServer(AdmissionInput, SRV_HOST, SRV_PORT,
+                                        backlog=8, admission=admission)
+        first = socket.create_connection((SRV_HOST, SRV_PORT), timeout=2)
+        isock = self.rsock.accept()[0]
+        second = socket.create_connection((SRV_HOST, SRV_PORT), timeout=2)
+        self.assertEqual(second.recv(1), b'')
+        self.assertEqual(admission.rejected, 1)
+
+        first.close()
+        isock.close()
+        time.sleep(0.2)
+        self.assertEqual(admission.connections, 0)
+        third = socket.create_connection((SRV_HOST, SRV_PORT), timeout=2)
+        self.rsock.accept()[0].close()
+        second.close()
+        third.close()
+
+    def test_byte_rate(self):
+        '''
+        Test that a client sending faster than its limit is slowed down
+        and its data still arrives intact.
+        '''
+        admission = trixy.admission.Admission(byte_rate=200000,
+                                              byte_burst=100000)
+        self.server = trixy.TrixyServer(AdmissionInput, SRV_HOST, SRV_PORT,
+                                        admission=admission)
+        payload = bytes(range(256)) * 1024
+        osock = socket.create_connection((SRV_HOST, SRV_PORT), timeout=2)
+        isock = self.rsock.accept()[0]
+        isock.settimeout(2)
+
+        start = time.monotonic()
+        osock.sendall(payload)
+        received = b''
+        while len(received) < len(payload):
+            received += isock.recv(65536)
+        self.assertEqual(received, payload)
+        # 256 KiB at 200 KB/s after a 100 KB burst, without stalls.
+        self.assertGreater(time.monotonic() - start, 0.6)
+        self.assertLess(time.monotonic() - start, 2)
+
+        osock.close()
+        isock.close()
+
+
+class TestAdmissionAsyncoreLoop(TestAdmissionServer):
+    '''
+    Run the same tests under asyncore.loop(), which does not advance the
+    timer wheel.
+    '''
+    use_timers = False
@@ -0,0 +1,138 @@
+'''
+Test the asyncio engine: chaining through processors and close
+propagation in both directions.
+'''
+import asyncio
+import errno
+import socket
+import threading
+import time
+import unittest
+import trixy
+import trixy.aio
+from tests.utils import SRV_HOST, SRV_PORT, LOC_HOST, LOC_PORT
+
+
+class TestAioDummyOutput(trixy.aio.AsyncTrixyOutput):
+
+    def handle_packet_down(self, data):
+        self.forward_packet_up(data)
+
+
+class TestAioChainingInput(trixy.aio.AsyncTrixyInput):
+    def __init__(self, sock, addr, loop=None):
+        super().__init__(sock, addr, loop)
+
+        processor = trixy.TrixyProcessor()
+        self.connect_node(processor)
+
+        output = TestAioDummyOutput(LOC_HOST, LOC_PORT, autoconnect=False)
+        processor.connect_node(output)
+
+
+class TestAioClosingInput(trixy.aio.AsyncTrixyInput):
+    def __init__(self, sock, addr, loop=None):
+        super().__init__(sock, addr, loop)
+
+        self.connect_node(trixy.aio.AsyncTrixyOutput(LOC_HOST, LOC_PORT))
+
+
+class AioTestCase(unittest.TestCase):
+    '''
+    Run an asyncio loop in a background thread for the duration of a
+    test.
+    '''
+    tinput = None
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.server = trixy.aio.AsyncTrixyServer(self.tinput, SRV_HOST,
+                                                 SRV_PORT, loop=self.loop)
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        def stop():
+            self.server.close()
+            # Let the accept task process its cancellation first.
+            self.loop.call_soon(self.loop.stop)
+        self.loop.call_soon_threadsafe(stop)
+        self.thread.join()
+        self.loop.close()
+
+
+class TestAioChaining(AioTestCase):
+    tinput = TestAioChainingInput
+
+    def test_input_output_via_roundtrip(self):
+        sock = socket.socket()
+        sock.connect((SRV_HOST, SRV_PORT))
+
+        sock.send(b'hello world')
+        self.assertEqual(sock.recv(32), b'hello world')
+
+        sock.close()
+
+
+class TestAioClosing(AioTestCase):
+    tinput = TestAioClosingInput
+
+    def setUp(self):
+        self.rsock = socket.socket()
+        self.rsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.rsock.bind((LOC_HOST, LOC_PORT))
+        self.rsock.listen(2)
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        self.rsock.close()
+
+    def test_output_close_propagation(self):
+        sock = socket.socket()
+        sock.connect((SRV_HOST, SRV_PORT))
+
+        rs = self.rsock.accept()[0]
+        rs.close()
+        time.sleep(0.1)
+
+        sock.settimeout(1)
+        self.assertEqual(sock.recv(32), b'')
+        sock.close()
+
+    def test_input_close_propagation(self):
+        sock = socket.socket()
+        sock.connect((SRV_HOST, SRV_PORT))
+
+        rs = self.rsock.accept()[0]
+        sock.close()
+        time.sleep(0.1)
+
+        rs.settimeout(1)
+        self.assertEqual(rs.recv(32), b'')
+        rs.close()
+
+
+class TestAioAcceptErrors(unittest.TestCase):
+    def test_backoff(self):
+        '''
+        Test that running out of file descriptors makes the server wait
+        before accepting again, rather than spin.
+        '''
+        loop = asyncio.new_event_loop()
+        server = trixy.aio.AsyncTrixyServer(TestAioClosingInput, SRV_HOST,
+                                            SRV_PORT, loop=loop)
+        attempts = []
+
+        async def sock_accept(sock):
+            attempts.append(time.monotonic())
+            raise OSError(errno.EMFILE, 'Too many open files')
+        loop.sock_accept = sock_accept
+        try:
+            loop.run_until_complete(asyncio.sleep(0.35))
+        finally:
+            server.close()
+            loop.run_until_complete(asyncio.sleep(0))
+            loop.close()
+        self.assertLessEqual(len(attempts), 5)
+        self.assertGreater(len(attempts), 1)
@@ -0,0 +1,50 @@
+'''
+Test that a connection with a full send buffer pauses reading on the
+connection producing its data, and resumes it once drained.
+'''
+import socket
+import unittest
+import trixy
+from tests.utils import LOC_HOST, LOC_PORT
+
+
+class TestBackpressure(unittest.TestCase):
+    def setUp(self):
+        self.isock, self.client = socket.socketpair()
+        self.isock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        self.client.setblocking(False)
+
+        self.input = trixy.TrixyInput(self.isock, None)
+        self.processor = trixy.TrixyProcessor()
+        self.output = trixy.TrixyOutput(LOC_HOST, LOC_PORT, autoconnect=False)
+        self.input.connect_node(self.processor)
+        self.processor.connect_node(self.output)
+
+    def tearDown(self):
+        self.input.close()
+        self.output.close()
+        self.client.close()
+
+    def drain_client(self):
+        try:
+            while self.client.recv(65536):
+                pass
+        except BlockingIOError:
+            pass
+
+    def test_pause_and_resume(self):
+        self.assertTrue(self.output.readable())
+
+        chunk = b'x' * 65536
+        while not self.input.producers_paused:
+            self.output.handle_packet_up(chunk)
+        self.assertGreater(len(self.input.out_buffer),
+                           self.input.high_watermark)
+        self.assertFalse(self.output.readable())
+
+        while self.input.producers_paused:
+            self.drain_client()
+            self.input.handle_write()
+        self.assertLessEqual(len(self.input.out_buffer),
+                             self.input.low_watermark)
+        self.assertTrue(self.output.readable())
@@ -0,0 +1,157 @@
+'''
+Test the batched packet dispatch API.
+'''
+import socket
+import unittest
+import trixy
+from tests import utils
+from tests.utils import SRV_HOST, SRV_PORT, LOC_HOST, LOC_PORT
+
+
+class BatchRecorder(trixy.TrixyProcessor):
+    def __init__(self):
+        super().__init__()
+        self.batches = []
+
+    def handle_batch_down(self, batch):
+        self.batches.append(len(batch))
+        self.forward_batch_down(batch)
+
+
+class PacketRecorder(trixy.TrixyProcessor):
+    def __init__(self):
+        super().__init__()
+        self.packets = []
+
+    def handle_packet_down(self, data):
+        self.packets.append(data)
+        self.forward_packet_down(data)
+
+
+class BatchUpper(trixy.TrixyProcessor):
+    def handle_batch_down(self, batch):
+        self.forward_batch_down([bytes(data).upper() for data in batch])
+
+
+class PacketRecorderSubclass(BatchRecorder):
+    def handle_packet_down(self, data):
+        self.batches.append(data)
+
+
+class TestBatchDispatch(unittest.TestCase):
+    def test_packet_fallback(self):
+        '''
+        Test that nodes that only handle packets get each packet of a
+        batch as bytes, and that batches pass through other nodes whole.
+        '''
+        batch = [memoryview(b'hw'), memoryview(b'ft')]
+        first = trixy.TrixyNode()
+        packets = PacketRecorder()
+        batches = BatchRecorder()
+        first.connect_node(trixy.TrixyProcessor())
+        first.downstream_nodes[0].connect_node(batches)
+        batches.connect_node(packets)
+
+        first.forward_batch_down(batch)
+        self.assertEqual(batches.batches, [2])
+        self.assertEqual(packets.packets, [b'hw', b'ft'])
+        self.assertIs(type(packets.packets[0]), bytes)
+
+    def test_overriding_packet_handler(self):
+        '''
+        Test that a packet handler added by a subclass is not bypassed by
+        a batch handler it inherited.
+        '''
+        node = PacketRecorderSubclass()
+        node.handle_batch_down([b'hw', b'ft'])
+        self.assertEqual(node.batches, [b'hw', b'ft'])
+
+    def test_single_packet_to_batch_handler(self):
+        '''
+        Test that a single packet reaches a node that only handles
+        batches.
+        '''
+        first = trixy.TrixyNode()
+        upper = BatchUpper()
+        packets = PacketRecorder()
+        first.connect_node(trixy.TrixyProcessor())
+        first.downstream_nodes[0].connect_node(upper)
+        upper.connect_node(packets)
+
+        first.forward_packet_down(b'hello')
+        self.assertEqual(packets.packets, [b'HELLO'])
+
+    def test_opaque(self):
+        self.assertFalse(BatchRecorder.opaque)
+
+
+class TestReadSize(unittest.TestCase):
+    def test_adapt(self):
+        '''
+        Test that reads grow while they fill the buffer, and only
+        shrink after several small reads in a row.
+        '''
+        conn = trixy.TrixyConnection()
+        conn.adapt_recvsize(16384)
+        self.assertEqual(conn.recvsize, 32768)
+        for i in range(10):
+            conn.adapt_recvsize(conn.recvsize)
+        self.assertEqual(conn.recvsize, conn.max_recvsize)
+
+        for i in range(conn.shrink_after - 1):
+            conn.adapt_recvsize(10)
+        conn.adapt_recvsize(100000)
+        conn.adapt_recvsize(10)
+        self.assertEqual(conn.recvsize, conn.max_recvsize)
+        for i in range(1000):
+            conn.adapt_recvsize(10)
+        self.assertEqual(conn.recvsize, conn.min_recvsize)
+        conn.close()
+
+
+class TestBatchInput(trixy.TrixyInput):
+    recorders = []
+
+    def __init__(self, sock, addr):
+        super().__init__(sock, addr)
+        recorder = BatchRecorder()
+        self.recorders.append(recorder)
+        self.connect_node(recorder)
+        recorder.connect_node(trixy.TrixyOutput(LOC_HOST, LOC_PORT))
+
+
+class TestBatchedReads(utils.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.server = trixy.TrixyServer(TestBatchInput, SRV_HOST, SRV_PORT)
+
+        self.rsock = socket.socket()
+        self.rsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.rsock.bind((LOC_HOST, LOC_PORT))
+        self.rsock.listen(2)
+        self.rsock.settimeout(2)
+
+    def tearDown(self):
+        super().tearDown()
+        self.server.close()
+        self.rsock.close()
+
+    def test_burst(self):
+        '''
+        Test that a burst larger than one read reaches the chain in
+        fewer calls than reads, and arrives intact.
+        '''
+        payload = bytes(range(256)) * 1024
+        osock = socket.create_connection((SRV_HOST, SRV_PORT), timeout=2)
+        isock = self.rsock.accept()[0]
+        isock.settimeout(2)
+
+        osock.sendall(payload)
+        received = b''
+        while len(received) < len(payload):
+            received += isock.recv(65536)
+        self.assertEqual(received, payload)
+        self.assertGreater(max(TestBatchInput.recorders[-1].batches), 1)
+
+        osock.close()
+        isock.close()
@@ -0,0 +1,64 @@
+'''
+Test the chunked buffer used for send and staging buffers.
+'''
+import unittest
+from trixy.buffers import BufferPool, ChunkBuffer
+
+
+class TestChunkBuffer(unittest.TestCase):
+    def test_partial_consumption(self):
+        buf = ChunkBuffer(b'hello ')
+        buf.append(bytearray(b'wor'))
+        buf.append(memoryview(b'ld'))
+        self.assertEqual(len(buf), 11)
+
+        buf.consume(3)
+        self.assertEqual(buf.getvalue(), b'lo world')
+        self.assertEqual(bytes(buf.peek(4)), b'lo w')
+        self.assertEqual(buf.read(5), b'lo wo')
+        self.assertEqual(buf.read(), b'rld')
+        self.assertFalse(buf)
+
+    def test_appended_data_is_copied(self):
+        data = bytearray(b'abc')
+        buf = ChunkBuffer()
+        buf.append(data)
+        data[0:3] = b'xyz'
+        self.assertEqual(buf.read(), b'abc')
+
+    def test_views_of_bytes_not_copied(self):
+        data = b'x' * 100000
+        buf = ChunkBuffer()
+        buf.append(memoryview(data)[1000:])
+        self.assertIs(buf.peek().obj, data)
+        self.assertEqual(buf.read(5), b'xxxxx')
+        self.assertEqual(len(buf), 98995)
+
+    def test_large_chunks_not_coalesced(self):
+        large = b'y' * 100000
+        buf = ChunkBuffer(b'x')
+        buf.append(large)
+        self.assertEqual(bytes(buf.peek()), b'x')
+        buf.consume(1)
+        self.assertEqual(len(buf.peek()), 65536)
+
+    def test_small_chunks_coalesced(self):
+        buf = ChunkBuffer()
+        for i in range(10):
+            buf.append(b'%i' % i)
+        self.assertEqual(bytes(buf.peek()), b'0123456789')
+        buf.consume(4)
+        self.assertEqual(bytes(buf.peek(3)), b'456')
+
+
+class TestBufferPool(unittest.TestCase):
+    def test_reuse(self):
+        pool = BufferPool(max_free=1)
+        first = pool.acquire(4096)
+        second = pool.acquire(4096)
+        self.assertEqual(len(first), 4096)
+        pool.release(first)
+        pool.release(second)
+        self.assertIs(pool.acquire(4096), first)
+        self.assertIsNot(pool.acquire(4096), second)
+        self.assertEqual(len(pool.acquire(8192)), 8192)
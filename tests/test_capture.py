@@ -0,0 +1,208 @@
+'''
+Test recording traffic with a CaptureWriter.
+'''
+import os
+import socket
+import struct
+import tempfile
+import time
+import unittest
+import trixy
+import trixy.capture
+from tests import utils
+from tests.utils import SRV_HOST, SRV_PORT, LOC_HOST, LOC_PORT
+
+
+def read_pcapng(path):
+    '''
+    Return the (type, body) of each block in a pcapng file.
+    '''
+    with open(path, 'rb') as f:
+        data = f.read()
+    blocks = []
+    offset = 0
+    while offset < len(data):
+        kind, size = struct.unpack_from('<II', data, offset)
+        blocks.append((kind, data[offset + 8:offset + size - 4]))
+        offset += size
+    return blocks
+
+
+class TestCaptureWriter(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.dir.name, name)
+
+    def test_log(self):
+        '''
+        Test that records are read back as written.
+        '''
+        writer = trixy.capture.CaptureWriter(self.path('cap.log'))
+        conn = writer.new_id()
+        writer.record(conn, trixy.capture.OPEN, timestamp=1.5)
+        writer.record(conn, trixy.capture.DOWN, b'hello', timestamp=2.5)
+        writer.record(conn, trixy.capture.UP, b'world', timestamp=3.5)
+        writer.record(conn, trixy.capture.CLOSE, timestamp=4.5)
+        writer.close()
+
+        records = list(trixy.capture.read_log(self.path('cap.log')))
+        self.assertEqual(records, [
+            (1.5, conn, trixy.capture.OPEN, b''),
+            (2.5, conn, trixy.capture.DOWN, b'hello'),
+            (3.5, conn, trixy.capture.UP, b'world'),
+            (4.5, conn, trixy.capture.CLOSE, b'')])
+        self.assertEqual(writer.queued, 0)
+
+    def test_rotate(self):
+        '''
+        Test that files are rotated by size, and the oldest deleted.
+        '''
+        writer = trixy.capture.CaptureWriter(
+            self.path('cap.log'), max_size=100, max_files=2)
+        for i in range(10):
+            writer.record(1, trixy.capture.DOWN, b'%02i' % i * 20)
+        writer.close()
+
+        self.assertEqual(sorted(os.listdir(self.dir.name)),
+                         ['cap.8.log', 'cap.9.log'])
+        for name in ('cap.8.log', 'cap.9.log'):
+            self.assertLessEqual(os.path.getsize(self.path(name)), 100)
+        records = list(trixy.capture.read_log(self.path('cap.9.log')))
+        self.assertEqual(records[0].data, b'09' * 20)
+
+    def test_thread_failure(self):
+        '''
+        Test that a failure of the writer thread is reported, and that
+        no more records are taken.
+        '''
+        writer = trixy.capture.CaptureWriter(self.path('missing/cap.log'))
+        writer.record(1, trixy.capture.DOWN, b'data')
+        writer.thread.join(5)
+        self.assertFalse(writer.thread.is_alive())
+        self.assertIsInstance(writer.error, FileNotFoundError)
+        self.assertEqual(writer.queued, 0)
+        self.assertRaises(trixy.capture.CaptureError, writer.record,
+                          1, trixy.capture.DOWN, b'more')
+        self.assertEqual((writer.pending, writer.dropped), ([], 0))
+        self.assertRaises(trixy.capture.CaptureError, writer.close)
+
+    def test_pcapng(self):
+        '''
+        Test that data is written as TCP segments with consistent
+        sequence numbers.
+        '''
+        writer = trixy.capture.CaptureWriter(
+            self.path('cap.pcapng'), format=trixy.capture.PCAPNG)
+        conn = writer.new_id()
+        writer.record(conn, trixy.capture.OPEN)
+        writer.record(conn, trixy.capture.DOWN, b'ping')
+        writer.record(conn, trixy.capture.UP, b'x' * 70000)
+        writer.record(conn, trixy.capture.CLOSE)
+        writer.close()
+
+        blocks = read_pcapng(self.path('cap.pcapng'))
+        self.assertEqual([kind for kind, body in blocks[:2]],
+                         [0x0A0D0D0A, 1])
+        segments = []
+        for kind, body in blocks[2:]:
+            self.assertEqual(kind, 6)
+            length = struct.unpack_from('<I', body, 12)[0]
+            packet = body[20:20 + length]
+            self.assertEqual(trixy.capture.ip_checksum(packet[:20]), 0)
+            sport, dport, seq, ack, offset, flags = struct.unpack_from(
+                '!HHIIBB', packet, 20)
+            segments.append((sport, seq, ack, flags, packet[40:]))
+
+        syn, synack, ping, pong1, pong2, fin1, fin2 = segments
+        self.assertEqual(syn[0], 49152)
+        self.assertEqual(synack[0], 80)
+        self.assertEqual(ping[1:3], (1, 1))
+        self.assertEqual(ping[4], b'ping')
+        self.assertEqual(pong1[1:3], (1, 5))
+        self.assertEqual(pong2[1], 1 + len(pong1[4]))
+        self.assertEqual(pong1[4] + pong2[4], b'x' * 70000)
+        self.assertEqual(fin1[1], 5)
+        self.assertEqual(fin2[1], 70001)
+
+
+class CaptureInput(trixy.TrixyInput):
+    writer = None
+
+    def __init__(self, sock, addr):
+        super().__init__(sock, addr)
+        capture = trixy.capture.CaptureProcessor(self.writer)
+        self.connect_node(capture)
+        capture.connect_node(trixy.TrixyOutput(LOC_HOST, LOC_PORT))
+
+
+class TestCaptureProcessor(utils.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'cap.log')
+        CaptureInput.writer = trixy.capture.CaptureWriter(self.path)
+        self.server = trixy.TrixyServer(CaptureInput, SRV_HOST, SRV_PORT)
+        self.lsock = socket.socket()
+        self.lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.lsock.bind((LOC_HOST, LOC_PORT))
+        self.lsock.listen(1)
+        self.lsock.settimeout(2)
+
+    def tearDown(self):
+        super().tearDown()
+        self.server.close()
+        self.lsock.close()
+        self.dir.cleanup()
+
+    def test_capture(self):
+        '''
+        Test that the data moving both ways is recorded and forwarded.
+        '''
+        osock = socket.create_connection((SRV_HOST, SRV_PORT), timeout=2)
+        isock = self.lsock.accept()[0]
+        isock.settimeout(2)
+        osock.sendall(b'request')
+        self.assertEqual(isock.recv(100), b'request')
+        isock.sendall(b'response')
+        self.assertEqual(osock.recv(100), b'response')
+        osock.close()
+        isock.recv(100)
+        isock.close()
+        time.sleep(0.2)
+
+        CaptureInput.writer.close()
+        records = list(trixy.capture.read_log(self.path))
+        self.assertEqual([(r.kind, r.data) for r in records], [
+            (trixy.capture.OPEN, b''),
+            (trixy.capture.DOWN, b'request'),
+            (trixy.capture.UP, b'response'),
+            (trixy.capture.CLOSE, b'')])
+
+    def test_writer_failure(self):
+        '''
+        Test that data is still forwarded and the connection still
+        closed after the writer thread fails.
+        '''
+        writer = trixy.capture.CaptureWriter(
+            os.path.join(self.dir.name, 'missing', 'cap.log'))
+        CaptureInput.writer = writer
+        osock = socket.create_connection((SRV_HOST, SRV_PORT), timeout=2)
+        isock = self.lsock.accept()[0]
+        isock.settimeout(2)
+        writer.thread.join(5)
+        self.assertIsNotNone(writer.error)
+
+        osock.sendall(b'request')
+        self.assertEqual(isock.recv(100), b'request')
+        isock.sendall(b'response')
+        self.assertEqual(osock.recv(100), b'response')
+        osock.close()
+        self.assertEqual(isock.recv(100), b'')
+        isock.close()
+        self.assertEqual(writer.abandoned, 1)
+        self.assertRaises(trixy.capture.CaptureError, writer.close)
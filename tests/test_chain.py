@@ -0,0 +1,111 @@
+'''
+Test building chains from a ChainTemplate.
+'''
+import functools
+import socket
+import unittest
+import trixy
+import trixy.chain
+from tests import utils
+from tests.utils import SRV_HOST, SRV_PORT, LOC_HOST, LOC_PORT
+
+
+class UpperProcessor(trixy.TrixyProcessor):
+    def handle_packet_down(self, data):
+        self.forward_packet_down(bytes(data).upper())
+
+
+class BatchUpperProcessor(trixy.TrixyProcessor):
+    def handle_batch_down(self, batch):
+        self.forward_batch_down([bytes(data).upper() for data in batch])
+
+
+OUTPUT = functools.partial(trixy.TrixyOutput, LOC_HOST, LOC_PORT)
+
+
+class TestChainTemplate(unittest.TestCase):
+    def test_validation(self):
+        self.assertRaises(TypeError, trixy.chain.ChainTemplate)
+        self.assertRaises(TypeError, trixy.chain.ChainTemplate, int, OUTPUT)
+        self.assertRaises(TypeError, trixy.chain.ChainTemplate,
+                          OUTPUT, UpperProcessor)
+
+    def test_wires_left_out(self):
+        template = trixy.chain.ChainTemplate(
+            trixy.TrixyProcessor, UpperProcessor, trixy.TrixyProcessor,
+            OUTPUT)
+        self.assertEqual(template.factories, (UpperProcessor, OUTPUT))
+        self.assertFalse(template.opaque)
+        self.assertTrue(trixy.chain.ChainTemplate(
+            trixy.TrixyProcessor, OUTPUT).opaque)
+
+    def test_batch_processor_kept(self):
+        '''
+        Test that a processor that only handles batches is not taken for
+        a wire.
+        '''
+        template = trixy.chain.ChainTemplate(BatchUpperProcessor, OUTPUT)
+        self.assertEqual(template.factories, (BatchUpperProcessor, OUTPUT))
+        self.assertFalse(template.opaque)
+
+    def test_processor_attributes(self):
+        processor = trixy.TrixyProcessor()
+        processor.name = 'plain'
+        self.assertEqual(processor.name, 'plain')
+
+
+class TestTemplateInput(trixy.chain.TemplateInput):
+    template = trixy.chain.ChainTemplate(UpperProcessor, OUTPUT)
+
+
+class TestBatchTemplateInput(trixy.chain.TemplateInput):
+    template = trixy.chain.ChainTemplate(BatchUpperProcessor, OUTPUT)
+
+
+class TestOpaqueTemplateInput(trixy.chain.TemplateInput):
+    template = trixy.chain.ChainTemplate(trixy.TrixyProcessor, OUTPUT)
+
+
+class TestTemplateChains(utils.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.rsock = socket.socket()
+        self.rsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.rsock.bind((LOC_HOST, LOC_PORT))
+        self.rsock.listen(2)
+        self.rsock.settimeout(2)
+        self.server = None
+
+    def tearDown(self):
+        super().tearDown()
+        self.server.close()
+        self.rsock.close()
+
+    def round_trip(self, tinput, payload):
+        self.server = trixy.TrixyServer(tinput, SRV_HOST, SRV_PORT)
+        osock = socket.create_connection((SRV_HOST, SRV_PORT), timeout=2)
+        isock = self.rsock.accept()[0]
+        isock.settimeout(2)
+
+        osock.sendall(payload)
+        received = b''
+        while len(received) < len(payload):
+            received += isock.recv(65536)
+        isock.sendall(b'tfwh')
+        self.assertEqual(osock.recv(4), b'tfwh')
+
+        osock.close()
+        isock.close()
+        return received
+
+    def test_processing_chain(self):
+        self.assertEqual(self.round_trip(TestTemplateInput, b'hwft'), b'HWFT')
+
+    def test_batch_processing_chain(self):
+        self.assertEqual(self.round_trip(TestBatchTemplateInput, b'hwft'),
+                         b'HWFT')
+
+    def test_opaque_chain(self):
+        payload = bytes(range(256)) * 1024
+        self.assertEqual(self.round_trip(TestOpaqueTemplateInput, payload),
+                         payload)
@@ -0,0 +1,257 @@
+'''
+Test the shared SSL contexts and session resumption.
+'''
+import os
+import socket
+import ssl
+import threading
+import unittest
+import trixy.encryption
+from tests import utils
+from tests.utils import SRV_HOST, SRV_PORT, LOC_HOST, LOC_PORT
+
+
+CERTFILE = os.path.join(os.path.dirname(__file__), 'certs', 'localhost.pem')
+
+
+class TestContextRegistry(unittest.TestCase):
+    def setUp(self):
+        self.registry = trixy.encryption.ContextRegistry()
+
+    def test_contexts_are_shared(self):
+        context = self.registry.server_context(CERTFILE)
+        self.assertIs(self.registry.server_context(CERTFILE), context)
+        self.assertIsNot(
+            self.registry.server_context(CERTFILE, session_tickets=False),
+            context)
+
+        client = self.registry.client_context(cert_reqs=ssl.CERT_NONE)
+        self.assertIs(self.registry.client_context(cert_reqs=ssl.CERT_NONE),
+                      client)
+        self.assertFalse(client.check_hostname)
+
+    def test_session_resumption(self):
+        '''
+        Test that a second connection to the same server resumes the
+        session saved from the first one.
+        '''
+        server_context = self.registry.server_context(CERTFILE)
+        client_context = self.registry.client_context(
+            cert_reqs=ssl.CERT_NONE)
+
+        lsock = socket.socket()
+        lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        lsock.bind((LOC_HOST, LOC_PORT))
+        lsock.listen(2)
+
+        def serve():
+            for i in range(2):
+                sock = server_context.wrap_socket(lsock.accept()[0],
+                                                  server_side=True)
+                sock.sendall(b'hwft')
+                sock.recv(1)
+                sock.close()
+        thread = threading.Thread(target=serve)
+        thread.start()
+
+        reused = []
+        for i in range(2):
+            sock = client_context.wrap_socket(
+                socket.socket(), session=self.registry.session(
+                    client_context, LOC_HOST, LOC_PORT))
+            sock.settimeout(2)
+            sock.connect((LOC_HOST, LOC_PORT))
+            self.assertEqual(sock.recv(4), b'hwft')
+            reused.append(sock.session_reused)
+            self.registry.save_session(LOC_HOST, LOC_PORT, sock)
+            sock.close()
+
+        thread.join()
+        lsock.close()
+        self.assertEqual(reused, [False, True])
+        self.assertEqual(self.registry.stats()['resumed'], 1)
+        self.assertEqual(self.registry.stats()['full'], 1)
+
+
+class TestSSLInput(trixy.encryption.TrixySSLInput):
+    handshake_timeout = 0.5
+
+    def __init__(self, sock, addr):
+        super().__init__(sock, addr, certfile=CERTFILE)
+        self.connect_node(trixy.TrixyOutput(LOC_HOST, LOC_PORT))
+
+
+class TestTrixySSLInput(utils.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.server = trixy.TrixyServer(TestSSLInput, SRV_HOST, SRV_PORT)
+
+        self.rsock = socket.socket()
+        self.rsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.rsock.bind((LOC_HOST, LOC_PORT))
+        self.rsock.listen(2)
+        self.rsock.settimeout(2)
+
+        self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        self.context.check_hostname = False
+        self.context.verify_mode = ssl.CERT_NONE
+
+    def tearDown(self):
+        super().tearDown()
+        self.server.close()
+        self.rsock.close()
+
+    def test_stalled_handshake(self):
+        '''
+        Test that a client that never starts its handshake does not
+        hold up other clients, and is disconnected after the timeout.
+        '''
+        stalled = socket.socket()
+        stalled.settimeout(5)
+        stalled.connect((SRV_HOST, SRV_PORT))
+        stalled_output = self.rsock.accept()[0]
+
+        osock = self.context.wrap_socket(socket.socket())
+        osock.settimeout(2)
+        osock.connect((SRV_HOST, SRV_PORT))
+        osock.sendall(b'hwft')
+        isock = self.rsock.accept()[0]
+        isock.settimeout(2)
+        self.assertEqual(isock.recv(4), b'hwft')
+        isock.sendall(b'tfwh')
+        self.assertEqual(osock.recv(4), b'tfwh')
+
+        self.assertEqual(stalled.recv(4), b'')
+
+        stalled_output.close()
+        osock.close()
+        isock.close()
+        stalled.close()
+
+    def test_do_handshake_on_connect(self):
+        '''
+        Test that the old do_handshake_on_connect argument is still
+        accepted, with a warning.
+        '''
+        left, right = socket.socketpair()
+        self.addCleanup(right.close)
+        with self.assertWarns(DeprecationWarning):
+            tinput = trixy.encryption.TrixySSLInput(
+                left, ('127.0.0.1', 1), None, True, certfile=CERTFILE)
+        self.assertTrue(tinput.handshaking)
+        tinput.close()
+
+
+TEST_REGISTRY = trixy.encryption.ContextRegistry()
+
+
+class TestSSLOutput(trixy.encryption.TrixySSLOutput):
+    registry = TEST_REGISTRY
+    default_protocol = ssl.PROTOCOL_TLS_CLIENT
+
+    def setup_socket(self, host, port, autoconnect):
+        super().setup_socket(host, port, autoconnect,
+                             TEST_REGISTRY.client_context(
+                                 cert_reqs=ssl.CERT_NONE))
+
+
+class TestSSLOutputInput(trixy.TrixyInput):
+    def __init__(self, sock, addr):
+        super().__init__(sock, addr)
+        self.connect_node(TestSSLOutput(LOC_HOST, LOC_PORT))
+
+
+class TestTrixySSLOutput(utils.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.server = trixy.TrixyServer(TestSSLOutputInput,
+                                        SRV_HOST, SRV_PORT)
+
+        self.rsock = socket.socket()
+        self.rsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.rsock.bind((LOC_HOST, LOC_PORT))
+        self.rsock.listen(2)
+        self.rsock.settimeout(2)
+        self.context = TEST_REGISTRY.server_context(CERTFILE)
+
+    def tearDown(self):
+        super().tearDown()
+        self.server.close()
+        self.rsock.close()
+
+    def test_round_trip_and_resumption(self):
+        '''
+        Test data sent before the handshake finishes, and that the
+        second connection resumes the session of the first.
+        '''
+        reused = []
+        for i in range(2):
+            osock = socket.socket()
+            osock.settimeout(2)
+            osock.connect((SRV_HOST, SRV_PORT))
+            osock.sendall(b'hwft')
+
+            isock = self.context.wrap_socket(self.rsock.accept()[0],
+                                             server_side=True)
+            self.assertEqual(isock.recv(4), b'hwft')
+            reused.append(isock.session_reused)
+            isock.sendall(b'tfwh')
+            self.assertEqual(osock.recv(4), b'tfwh')
+
+            osock.close()
+            self.assertEqual(isock.recv(4), b'')
+            isock.close()
+
+        self.assertEqual(reused, [False, True])
+        self.assertEqual(TEST_REGISTRY.stats()['resumed'], 1)
+
+
+class TestTLSOutput(trixy.encryption.TrixyTLSOutput):
+    registry = trixy.encryption.ContextRegistry()
+
+
+class TestTLSOutputInput(trixy.TrixyInput):
+    def __init__(self, sock, addr):
+        super().__init__(sock, addr)
+        self.connect_node(TestTLSOutput(LOC_HOST, LOC_PORT))
+
+
+class TestTrixyTLSOutput(utils.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.server = trixy.TrixyServer(TestTLSOutputInput,
+                                        SRV_HOST, SRV_PORT)
+
+        self.rsock = socket.socket()
+        self.rsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.rsock.bind((LOC_HOST, LOC_PORT))
+        self.rsock.listen(2)
+        self.rsock.settimeout(2)
+        self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self.context.load_cert_chain(CERTFILE)
+
+    def tearDown(self):
+        super().tearDown()
+        self.server.close()
+        self.rsock.close()
+
+    def test_default_server(self):
+        '''
+        Test the handshake with a server using OpenSSL's defaults.
+        '''
+        osock = socket.create_connection((SRV_HOST, SRV_PORT), timeout=2)
+        osock.sendall(b'hwft')
+        isock = self.context.wrap_socket(self.rsock.accept()[0],
+                                         server_side=True)
+        self.assertEqual(isock.recv(4), b'hwft')
+        self.assertIn(isock.version(), ('TLSv1.2', 'TLSv1.3'))
+        isock.sendall(b'tfwh')
+        self.assertEqual(osock.recv(4), b'tfwh')
+
+        osock.close()
+        isock.close()
+
+    def test_minimum_version(self):
+        context = TestTLSOutput.registry.client_context(
+            TestTLSOutput.default_protocol, **TestTLSOutput.default_options)
+        self.assertEqual(context.minimum_version, ssl.TLSVersion.TLSv1_2)
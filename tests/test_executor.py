@@ -0,0 +1,137 @@
+'''
+Test offloading processing to a worker pool.
+'''
+import concurrent.futures
+import random
+import socket
+import time
+import unittest
+import trixy
+import trixy.executor
+from tests import utils
+from tests.utils import SRV_HOST, SRV_PORT, LOC_HOST, LOC_PORT
+
+
+class ManualPool():
+    '''
+    A pool whose work is finished by the test, in any order.
+    '''
+    def __init__(self):
+        self.calls = []
+
+    def submit(self, func, data, callback):
+        future = concurrent.futures.Future()
+        self.calls.append((func, data, callback, future))
+        return future
+
+    def complete(self, index):
+        func, data, callback, future = self.calls[index]
+        future.set_result(func(data))
+        callback(future)
+
+
+class Recorder(trixy.TrixyProcessor):
+    def __init__(self):
+        super().__init__()
+        self.packets = []
+        self.pauses = 0
+        self.closed = False
+
+    def handle_packet_down(self, data):
+        self.packets.append(data)
+
+    def handle_pause(self, direction='up'):
+        self.pauses += 1
+
+    def handle_resume(self, direction='up'):
+        self.pauses -= 1
+
+    def handle_close(self, direction='down'):
+        self.closed = True
+
+
+class TestExecutorProcessor(unittest.TestCase):
+    def setUp(self):
+        self.pool = ManualPool()
+        self.top = Recorder()
+        self.processor = trixy.executor.ExecutorProcessor(down=bytes.upper)
+        self.processor.pool = self.pool
+        self.processor.max_in_flight = 2
+        self.bottom = Recorder()
+        self.top.connect_node(self.processor)
+        self.processor.connect_node(self.bottom)
+
+    def test_order_and_pause(self):
+        '''
+        Test that results are forwarded in order whatever order they
+        finish in, and that the sender is paused while too much work
+        is in flight.
+        '''
+        self.top.forward_batch_down([memoryview(b'hw'), memoryview(b'ft')])
+        self.top.forward_packet_down(b'tf')
+        self.assertEqual(self.top.pauses, 1)
+
+        self.pool.complete(1)
+        self.assertEqual(self.bottom.packets, [])
+        self.pool.complete(0)
+        self.assertEqual(self.bottom.packets, [b'HWFT', b'TF'])
+        self.assertEqual(self.top.pauses, 0)
+
+    def test_close_waits(self):
+        '''
+        Test that a close is forwarded after the results before it.
+        '''
+        self.top.forward_packet_down(b'hwft')
+        self.processor.handle_close('down')
+        self.assertFalse(self.bottom.closed)
+        self.pool.complete(0)
+        self.assertEqual(self.bottom.packets, [b'HWFT'])
+        self.assertTrue(self.bottom.closed)
+
+
+def slow_upper(data):
+    time.sleep(random.uniform(0, 0.01))
+    return data.upper()
+
+
+class ExecutorInput(trixy.TrixyInput):
+    def __init__(self, sock, addr):
+        super().__init__(sock, addr)
+        processor = trixy.executor.ExecutorProcessor(down=slow_upper)
+        self.connect_node(processor)
+        processor.connect_node(trixy.TrixyOutput(LOC_HOST, LOC_PORT))
+
+
+class TestExecutorChain(utils.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.server = trixy.TrixyServer(ExecutorInput, SRV_HOST, SRV_PORT)
+
+        self.rsock = socket.socket()
+        self.rsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.rsock.bind((LOC_HOST, LOC_PORT))
+        self.rsock.listen(2)
+        self.rsock.settimeout(2)
+
+    def tearDown(self):
+        super().tearDown()
+        self.server.close()
+        self.rsock.close()
+
+    def test_ordering(self):
+        payload = b''.join(b'%06i,' % i for i in range(20000)) + b'end'
+        osock = socket.create_connection((SRV_HOST, SRV_PORT), timeout=2)
+        isock = self.rsock.accept()[0]
+        isock.settimeout(2)
+
+        for i in range(0, len(payload), 1000):
+            osock.sendall(payload[i:i + 1000])
+        osock.close()
+        received = b''
+        while True:
+            data = isock.recv(65536)
+            if not data:
+                break
+            received += data
+        self.assertEqual(received, payload.upper())
+        isock.close()
@@ -0,0 +1,260 @@
+'''
+Test the streaming HTTP/1.1 processor.
+'''
+import socket
+import unittest
+import trixy
+import trixy.http
+from tests import utils
+from tests.utils import SRV_HOST, SRV_PORT, LOC_HOST, LOC_PORT
+
+
+REQUESTS = (
+    b'GET /a HTTP/1.1\r\nHost: a\r\n\r\n'
+    b'POST /b HTTP/1.1\r\nHost: b\r\nContent-Length: 5\r\n\r\nhello'
+    b'POST /c HTTP/1.1\r\nHost: c\r\nTransfer-Encoding: chunked\r\n\r\n'
+    b'5;ext=1\r\nworld\r\n0\r\nTrailer: 1\r\n\r\n'
+    b'HEAD /d HTTP/1.1\r\nHost: d\r\n\r\n')
+
+RESPONSES = (
+    b'HTTP/1.1 100 Continue\r\n\r\n'
+    b'HTTP/1.1 200 OK\r\nServer: s\r\nContent-Length: 2\r\n\r\nok'
+    b'HTTP/1.1 204 No Content\r\nServer: s\r\n\r\n'
+    b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n2\r\nhi\r\n0\r\n\r\n'
+    b'HTTP/1.1 200 OK\r\nContent-Length: 99\r\nServer: s\r\n\r\n')
+
+
+class Recorder(trixy.TrixyProcessor):
+    def __init__(self):
+        super().__init__()
+        self.down = []
+        self.up = []
+
+    def handle_packet_down(self, data):
+        self.down.append(data)
+
+    def handle_packet_up(self, data):
+        self.up.append(data)
+
+
+class HostRewriter(trixy.http.HTTPProcessor):
+    def __init__(self):
+        super().__init__()
+        self.seen = []
+
+    def handle_request(self, request):
+        request.set(b'Host', b'trixy')
+
+    def handle_response(self, response, request):
+        self.seen.append((response.status, request and request.target))
+        response.remove(b'Server')
+
+
+class TestHTTPHead(unittest.TestCase):
+    def test_unchanged(self):
+        raw = b'GET  / HTTP/1.1\r\nhost:example\r\n\r\n'
+        self.assertRaises(trixy.http.HTTPProtocolError,
+                          trixy.http.HTTPRequest.parse, raw)
+        raw = b'GET / HTTP/1.1\r\nhost:example\r\nX:  y \r\n\r\n'
+        head = trixy.http.HTTPRequest.parse(raw)
+        self.assertEqual(head.get(b'Host'), b'example')
+        self.assertEqual(head.get(b'x'), b'y')
+        self.assertIs(head.to_bytes(), raw)
+
+    def test_changed(self):
+        head = trixy.http.HTTPResponse.parse(
+            b'HTTP/1.1 200 OK\r\nA: 1\r\nB: 2\r\na: 3\r\n\r\n')
+        head.set(b'A', b'4')
+        head.add(b'C', b'5')
+        head.status = 203
+        self.assertEqual(head.to_bytes(),
+                         b'HTTP/1.1 203 OK\r\nA: 4\r\nB: 2\r\nC: 5\r\n\r\n')
+
+    def test_invalid(self):
+        for raw in (b'HTTP/1.1 2000 OK\r\n\r\n',
+                    b'HTTP/1.1 200 OK\r\nA : 1\r\n\r\n',
+                    b'HTTP/1.1 200 OK\r\nA: 1\r\n folded\r\n\r\n'):
+            self.assertRaises(trixy.http.HTTPProtocolError,
+                              trixy.http.HTTPResponse.parse, raw)
+
+
+class TestHTTPProcessor(unittest.TestCase):
+    def setUp(self):
+        self.top = Recorder()
+        self.processor = HostRewriter()
+        self.bottom = Recorder()
+        self.top.connect_node(self.processor)
+        self.processor.connect_node(self.bottom)
+
+    def test_pipelining(self):
+        '''
+        Test that pipelined messages are each found and rewritten, and
+        that everything else is passed along unchanged, whatever the
+        packet size.
+        '''
+        requests = REQUESTS
+        for host in (b'a', b'b', b'c', b'd'):
+            requests = requests.replace(b'Host: ' + host, b'Host: trixy')
+        responses = RESPONSES.replace(b'Server: s\r\n', b'')
+
+        for size in (1, 2, 3, 7, 64, len(REQUESTS)):
+            self.setUp()
+            for i in range(0, len(REQUESTS), size):
+                self.top.forward_packet_down(REQUESTS[i:i + size])
+            for i in range(0, len(RESPONSES), size):
+                self.bottom.forward_packet_up(RESPONSES[i:i + size])
+            self.assertEqual(b''.join(self.bottom.down), requests)
+            self.assertEqual(b''.join(self.top.up), responses)
+            self.assertEqual(self.processor.seen,
+                             [(100, b'/a'), (200, b'/a'), (204, b'/b'),
+                              (200, b'/c'), (200, b'/d')])
+
+    def test_body_not_copied(self):
+        '''
+        Test that body data is forwarded as views of the data read.
+        '''
+        data = b'PUT / HTTP/1.1\r\nContent-Length: 10\r\n\r\n0123456789'
+        batches = []
+        self.processor.forward_batch_down = batches.append
+        self.processor.handle_packet_down(data)
+        body = batches[0][-1]
+        self.assertIsInstance(body, memoryview)
+        self.assertIs(body.obj, data)
+        self.assertEqual(body, b'0123456789')
+
+    def test_upgrade(self):
+        '''
+        Test that nothing is parsed after a switch of protocols.
+        '''
+        self.top.forward_packet_down(
+            b'GET / HTTP/1.1\r\nUpgrade: websocket\r\n\r\n\x81\x00')
+        self.bottom.forward_packet_up(
+            b'HTTP/1.1 101 Switching Protocols\r\n\r\n\x81\x00')
+        self.top.forward_packet_down(b'not http')
+        self.assertEqual(b''.join(self.bottom.down)[-10:], b'\x81\x00not http')
+        self.assertEqual(b''.join(self.top.up)[-2:], b'\x81\x00')
+
+    def test_chunked_with_content_length(self):
+        '''
+        Test that Content-Length is removed from a chunked message, so
+        that the next hop cannot frame it differently.
+        '''
+        self.top.forward_packet_down(
+            b'POST / HTTP/1.1\r\nHost: a\r\nContent-Length: 3\r\n'
+            b'Transfer-Encoding: chunked\r\n\r\n0\r\n\r\n'
+            b'GET /b HTTP/1.1\r\n\r\n')
+        self.assertEqual(
+            b''.join(self.bottom.down),
+            b'POST / HTTP/1.1\r\nHost: trixy\r\n'
+            b'Transfer-Encoding: chunked\r\n\r\n0\r\n\r\n'
+            b'GET /b HTTP/1.1\r\nHost: trixy\r\n\r\n')
+        self.bottom.forward_packet_up(
+            b'HTTP/1.1 200 OK\r\nContent-Length: 9\r\n'
+            b'Transfer-Encoding: chunked\r\n\r\n0\r\n\r\n')
+        self.assertEqual(
+            b''.join(self.top.up),
+            b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n'
+            b'0\r\n\r\n')
+
+    def test_connect_accepted(self):
+        '''
+        Test that data sent after a CONNECT request is held back until
+        it is accepted, then tunneled.
+        '''
+        self.top.forward_packet_down(
+            b'CONNECT a:443 HTTP/1.1\r\n\r\n\x16\x03\x01')
+        self.assertEqual(b''.join(self.bottom.down),
+                         b'CONNECT a:443 HTTP/1.1\r\nHost: trixy\r\n\r\n')
+        self.bottom.forward_packet_up(b'HTTP/1.1 200 OK\r\n\r\n\x16')
+        self.top.forward_packet_down(b'GET / HTTP/1.1\r\n\r\n')
+        self.assertEqual(b''.join(self.bottom.down)[-21:],
+                         b'\x16\x03\x01GET / HTTP/1.1\r\n\r\n')
+        self.assertEqual(b''.join(self.top.up)[-1:], b'\x16')
+
+    def test_connect_refused(self):
+        '''
+        Test that requests pipelined after a refused CONNECT request are
+        still parsed.
+        '''
+        self.top.forward_packet_down(
+            b'CONNECT a:443 HTTP/1.1\r\n\r\nGET /b HTTP/1.1\r\n')
+        self.top.forward_packet_down(b'Host: b\r\n\r\n')
+        self.bottom.forward_packet_up(
+            b'HTTP/1.1 407 Proxy Authentication Required\r\n'
+            b'Content-Length: 0\r\n\r\n')
+        self.top.forward_packet_down(b'GET /c HTTP/1.1\r\nHost: c\r\n\r\n')
+        self.assertEqual(
+            b''.join(self.bottom.down),
+            b'CONNECT a:443 HTTP/1.1\r\nHost: trixy\r\n\r\n'
+            b'GET /b HTTP/1.1\r\nHost: trixy\r\n\r\n'
+            b'GET /c HTTP/1.1\r\nHost: trixy\r\n\r\n')
+        self.bottom.forward_packet_up(
+            b'HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n')
+        self.assertEqual(self.processor.seen,
+                         [(407, b'a:443'), (200, b'/b')])
+
+    def test_invalid_framing(self):
+        self.assertRaises(trixy.http.HTTPProtocolError,
+                          self.top.forward_packet_down,
+                          b'POST / HTTP/1.1\r\nContent-Length: x\r\n\r\n')
+        self.setUp()
+        self.assertRaises(trixy.http.HTTPProtocolError,
+                          self.top.forward_packet_down,
+                          b'POST / HTTP/1.1\r\nTransfer-Encoding: chunked'
+                          b'\r\n\r\n+5\r\n')
+
+    def test_head_too_large(self):
+        self.processor.down.max_head_size = 100
+        self.assertRaises(trixy.http.HTTPProtocolError,
+                          self.top.forward_packet_down,
+                          b'GET / HTTP/1.1\r\n' + b'X: y\r\n' * 30)
+
+
+class TestHTTPInput(trixy.TrixyInput):
+    def __init__(self, sock, addr):
+        super().__init__(sock, addr)
+        processor = HostRewriter()
+        self.connect_node(processor)
+        processor.connect_node(trixy.TrixyOutput(LOC_HOST, LOC_PORT))
+
+
+class TestHTTPChain(utils.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.server = trixy.TrixyServer(TestHTTPInput, SRV_HOST, SRV_PORT)
+
+        self.rsock = socket.socket()
+        self.rsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.rsock.bind((LOC_HOST, LOC_PORT))
+        self.rsock.listen(2)
+        self.rsock.settimeout(2)
+
+    def tearDown(self):
+        super().tearDown()
+        self.server.close()
+        self.rsock.close()
+
+    def test_large_body(self):
+        body = bytes(range(256)) * 1024
+        osock = socket.create_connection((SRV_HOST, SRV_PORT), timeout=2)
+        isock = self.rsock.accept()[0]
+        isock.settimeout(2)
+
+        osock.sendall(b'GET / HTTP/1.1\r\nHost: a\r\n\r\n')
+        expected = b'GET / HTTP/1.1\r\nHost: trixy\r\n\r\n'
+        received = b''
+        while len(received) < len(expected):
+            received += isock.recv(65536)
+        self.assertEqual(received, expected)
+
+        isock.sendall(b'HTTP/1.1 200 OK\r\nServer: s\r\nContent-Length: %i'
+                      b'\r\n\r\n' % len(body) + body)
+        expected = b'HTTP/1.1 200 OK\r\nContent-Length: %i\r\n\r\n' % (
+            len(body)) + body
+        received = b''
+        while len(received) < len(expected):
+            received += osock.recv(65536)
+        self.assertEqual(received, expected)
+
+        osock.close()
+        isock.close()
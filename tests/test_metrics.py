@@ -0,0 +1,136 @@
+'''
+Test the instrumentation of chains and the metrics endpoint.
+'''
+import socket
+import time
+import unittest
+import trixy
+import trixy.metrics
+from tests import utils
+from tests.utils import SRV_HOST, SRV_PORT, LOC_HOST, LOC_PORT
+
+
+class TestHistogram(unittest.TestCase):
+    def test_bucket_bounds(self):
+        hist = trixy.metrics.Histogram(lowest=1, highest=1024, sub_buckets=4)
+        for value in (0.5, 1, 1.3, 3, 100, 1000, 5000):
+            hist.record(value)
+            index = max(i for i, c in enumerate(hist.counts) if c)
+            self.assertLess(value, hist.upper_bound(index))
+            if index > 0:
+                self.assertGreaterEqual(value, hist.upper_bound(index - 1))
+            hist.counts[index] -= 1
+
+    def test_percentile(self):
+        hist = trixy.metrics.Histogram(lowest=1, highest=1024, sub_buckets=8)
+        for value in range(1, 101):
+            hist.record(value)
+        self.assertAlmostEqual(hist.percentile(0.5), 50, delta=50 / 8)
+        self.assertAlmostEqual(hist.percentile(0.99), 99, delta=99 / 8)
+        self.assertEqual(hist.count, 100)
+
+
+class SlowProcessor(trixy.TrixyProcessor):
+    delay = 0.02
+
+    def handle_packet_down(self, data):
+        time.sleep(self.delay)
+        self.forward_packet_down(data)
+
+
+class SlowerProcessor(SlowProcessor):
+    delay = 0.05
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.metrics = trixy.metrics.enable(trixy.metrics.Metrics())
+
+    def tearDown(self):
+        trixy.metrics.disable()
+
+    def test_forwarded_time_excluded(self):
+        '''
+        Test that a node is not charged for the time spent by the nodes
+        it forwards data to.
+        '''
+        first = trixy.TrixyNode()
+        slow = SlowProcessor()
+        first.connect_node(slow)
+        slow.connect_node(SlowerProcessor())
+
+        first.forward_packet_down(b'hwft')
+
+        slow_stats = self.metrics.nodes[('SlowProcessor', 'down')]
+        slower_stats = self.metrics.nodes[('SlowerProcessor', 'down')]
+        self.assertEqual(slow_stats.packets, 1)
+        self.assertEqual(slow_stats.bytes, 4)
+        self.assertLess(slow_stats.seconds.sum, 0.045)
+        self.assertGreaterEqual(slower_stats.seconds.sum, 0.05)
+
+
+class TestMetricsInput(trixy.TrixyInput):
+    def __init__(self, sock, addr):
+        super().__init__(sock, addr)
+        processor = SlowProcessor()
+        processor.delay = 0
+        self.connect_node(processor)
+        processor.connect_node(trixy.TrixyOutput(LOC_HOST, LOC_PORT))
+
+
+class TestMetricsServer(utils.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.metrics = trixy.metrics.enable(trixy.metrics.Metrics())
+        self.server = trixy.TrixyServer(TestMetricsInput, SRV_HOST, SRV_PORT)
+        self.metrics_server = trixy.metrics.MetricsServer(
+            SRV_HOST, SRV_PORT + 2, self.metrics)
+
+        self.rsock = socket.socket()
+        self.rsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.rsock.bind((LOC_HOST, LOC_PORT))
+        self.rsock.listen(2)
+
+    def tearDown(self):
+        super().tearDown()
+        trixy.metrics.disable()
+        self.server.close()
+        self.metrics_server.close()
+        self.rsock.close()
+
+    def scrape(self):
+        sock = socket.create_connection((SRV_HOST, SRV_PORT + 2), timeout=2)
+        sock.sendall(b'GET /metrics HTTP/1.1\r\nHost: trixy\r\n\r\n')
+        response = b''
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                break
+            response += data
+        sock.close()
+        return response.decode('utf-8')
+
+    def test_scrape(self):
+        osock = socket.create_connection((SRV_HOST, SRV_PORT), timeout=2)
+        isock = self.rsock.accept()[0]
+        isock.settimeout(2)
+        osock.sendall(b'hwft')
+        self.assertEqual(isock.recv(4), b'hwft')
+
+        response = self.scrape()
+        self.assertTrue(response.startswith('HTTP/1.0 200 OK\r\n'))
+        self.assertIn('trixy_node_bytes_total{node="SlowProcessor",'
+                      'direction="down"} 4\n', response)
+        self.assertIn('trixy_connections_open{node="TestMetricsInput"} 1\n',
+                      response)
+        self.assertIn('trixy_node_handle_seconds_count{'
+                      'node="SlowProcessor",direction="down"} 1\n', response)
+
+        osock.close()
+        isock.close()
+        time.sleep(0.2)
+        response = self.scrape()
+        self.assertIn('trixy_connections_open{node="TestMetricsInput"} 0\n',
+                      response)
+        self.assertIn('trixy_connection_lifetime_seconds_count{'
+                      'node="TestMetricsInput"} 1\n', response)
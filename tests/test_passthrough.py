@@ -0,0 +1,94 @@
+'''
+Test that chains made of opaque nodes move data correctly through the
+splice() and reused buffer fast paths.
+'''
+import socket
+import threading
+import unittest
+from unittest import mock
+import trixy
+from tests import utils
+from tests.utils import SRV_HOST, SRV_PORT, LOC_HOST, LOC_PORT
+
+
+class TestPassthroughInput(trixy.TrixyInput):
+    def __init__(self, sock, addr):
+        super().__init__(sock, addr)
+
+        processor = trixy.TrixyProcessor()
+        self.connect_node(processor)
+        processor.connect_node(trixy.TrixyOutput(LOC_HOST, LOC_PORT))
+
+
+class TestOpaque(unittest.TestCase):
+    def test_overriding_handler_clears_opaque(self):
+        class Inspector(trixy.TrixyProcessor):
+            def handle_packet_down(self, data):
+                self.forward_packet_down(data)
+
+        class Declared(trixy.TrixyProcessor):
+            opaque = True
+
+            def handle_packet_down(self, data):
+                self.forward_packet_down(data)
+
+        self.assertTrue(trixy.TrixyProcessor.opaque)
+        self.assertFalse(Inspector.opaque)
+        self.assertTrue(Declared.opaque)
+
+
+class TestPassthrough(utils.TestCase):
+    payload = bytes(range(256)) * 4096  # 1 MiB
+
+    def setUp(self):
+        super().setUp()
+        self.server = trixy.TrixyServer(TestPassthroughInput,
+                                        SRV_HOST, SRV_PORT)
+
+        self.rsock = socket.socket()
+        self.rsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.rsock.bind((LOC_HOST, LOC_PORT))
+        self.rsock.listen(2)
+
+    def tearDown(self):
+        super().tearDown()
+        self.server.close()
+        self.rsock.close()
+
+    def recv_exactly(self, sock, size):
+        chunks = []
+        while size:
+            chunk = sock.recv(min(size, 65536))
+            self.assertTrue(chunk, 'Connection closed early')
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b''.join(chunks)
+
+    def bulk_roundtrip(self):
+        osock = socket.create_connection((SRV_HOST, SRV_PORT))
+        isock = self.rsock.accept()[0]
+        osock.settimeout(5)
+        isock.settimeout(5)
+
+        sender = threading.Thread(target=osock.sendall, args=(self.payload,))
+        sender.start()
+        self.assertEqual(self.recv_exactly(isock, len(self.payload)),
+                         self.payload)
+        sender.join()
+
+        sender = threading.Thread(target=isock.sendall, args=(self.payload,))
+        sender.start()
+        self.assertEqual(self.recv_exactly(osock, len(self.payload)),
+                         self.payload)
+        sender.join()
+
+        osock.close()
+        self.assertEqual(isock.recv(32), b'')
+        isock.close()
+
+    def test_bulk_transfer(self):
+        self.bulk_roundtrip()
+
+    def test_bulk_transfer_without_splice(self):
+        with mock.patch('trixy.splice_supported', False):
+            self.bulk_roundtrip()
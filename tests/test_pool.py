@@ -0,0 +1,102 @@
+'''
+Test that pooled outputs reuse upstream connections.
+'''
+import socket
+import time
+import trixy
+import trixy.pool
+from tests import utils
+from tests.utils import SRV_HOST, SRV_PORT, LOC_HOST, LOC_PORT
+
+
+TEST_POOL = trixy.pool.ConnectionPool(max_per_host=1)
+
+
+class BoundaryProcessor(trixy.TrixyProcessor):
+    '''
+    Mark the output reusable once a complete response has arrived.
+    '''
+    def __init__(self, output):
+        super().__init__()
+        self.output = output
+
+    def handle_packet_up(self, data):
+        self.forward_packet_up(data)
+        if data.endswith(b'pong'):
+            self.output.mark_reusable()
+
+
+class TestPoolInput(trixy.TrixyInput):
+    def __init__(self, sock, addr):
+        super().__init__(sock, addr)
+        output = trixy.pool.PooledTrixyOutput(LOC_HOST, LOC_PORT,
+                                              pool=TEST_POOL)
+        processor = BoundaryProcessor(output)
+        self.connect_node(processor)
+        processor.connect_node(output)
+
+
+class TestPooledOutput(utils.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.server = trixy.TrixyServer(TestPoolInput, SRV_HOST, SRV_PORT)
+
+        self.rsock = socket.socket()
+        self.rsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.rsock.bind((LOC_HOST, LOC_PORT))
+        self.rsock.listen(2)
+        self.rsock.settimeout(0.5)
+
+    def tearDown(self):
+        super().tearDown()
+        self.server.close()
+        self.rsock.close()
+        TEST_POOL.close()
+
+    def roundtrip(self, isock=None):
+        osock = socket.create_connection((SRV_HOST, SRV_PORT))
+        osock.settimeout(2)
+        if isock is None:
+            isock = self.rsock.accept()[0]
+            isock.settimeout(2)
+        osock.send(b'ping')
+        self.assertEqual(isock.recv(8), b'ping')
+        isock.send(b'pong')
+        self.assertEqual(osock.recv(8), b'pong')
+        osock.close()
+        return isock
+
+    def test_connection_reused(self):
+        isock = self.roundtrip()
+        time.sleep(0.1)
+        self.assertEqual(TEST_POOL.stats()['idle'], 1)
+
+        self.assertIs(self.roundtrip(isock), isock)
+        self.assertRaises(socket.timeout, self.rsock.accept)
+        self.assertEqual(TEST_POOL.stats()['hits'], 1)
+        isock.close()
+
+    def test_closed_connection_not_reused(self):
+        isock = self.roundtrip()
+        time.sleep(0.1)
+        isock.close()
+        time.sleep(0.1)
+
+        self.roundtrip().close()
+        self.assertEqual(TEST_POOL.stats()['hits'], 0)
+
+    def test_unfinished_exchange_not_reused(self):
+        '''
+        Test that a connection closed in the middle of an exchange is
+        closed rather than pooled.
+        '''
+        osock = socket.create_connection((SRV_HOST, SRV_PORT))
+        isock = self.rsock.accept()[0]
+        isock.settimeout(2)
+        osock.send(b'ping')
+        self.assertEqual(isock.recv(8), b'ping')
+        osock.close()
+
+        self.assertEqual(isock.recv(8), b'')
+        self.assertEqual(TEST_POOL.stats()['idle'], 0)
+        isock.close()
@@ -0,0 +1,115 @@
+'''
+Test the ready-made processors.
+'''
+import socket
+import time
+import unittest
+import trixy
+import trixy.processors
+from tests import utils
+from tests.utils import SRV_HOST, SRV_PORT, LOC_HOST, LOC_PORT
+
+
+REPLACER = trixy.processors.Replacer({
+    b'Example Domain': b'Win Domain!',
+    b'tracker.js': b'',
+    b'Domain': b'Site',
+})
+
+
+def stream_in_pieces(replacer, data, size):
+    stream = replacer.stream()
+    output = b''
+    for i in range(0, len(data), size):
+        output += b''.join(stream.feed(data[i:i + size]))
+    return output + stream.flush()
+
+
+class TestReplacer(unittest.TestCase):
+    def test_replace(self):
+        self.assertEqual(
+            REPLACER.replace(b'<h1>Example Domain</h1><script src=tracker.js>'),
+            b'<h1>Win Domain!</h1><script src=>')
+
+    def test_overlapping(self):
+        '''
+        Test that the match ending first wins, and the longest of the
+        matches ending at the same place.
+        '''
+        replacer = trixy.processors.Replacer({b'abcd': b'1', b'bc': b'2',
+                                              b'c': b'3', b'bcd': b'4'})
+        self.assertEqual(replacer.replace(b'abcd'), b'a2d')
+        self.assertEqual(replacer.replace(b'bcd'), b'2d')
+        self.assertEqual(replacer.replace(b'xcd'), b'x3d')
+
+    def test_split_matches(self):
+        '''
+        Test that matches split between packets are found, whatever
+        the packet size.
+        '''
+        data = b'An Example Domain, an Example Domai, tracker.js' * 10
+        expected = REPLACER.replace(data)
+        self.assertEqual(expected.count(b'Win Domain!'), 10)
+        for size in range(1, 20):
+            self.assertEqual(stream_in_pieces(REPLACER, data, size), expected)
+
+    def test_unfinished_match(self):
+        '''
+        Test that bytes held back for a match that never completes are
+        returned when the stream ends.
+        '''
+        stream = REPLACER.stream()
+        self.assertEqual(b''.join(stream.feed(b'hw Exam')), b'hw ')
+        self.assertEqual(stream.flush(), b'Exam')
+
+    def test_empty_pattern(self):
+        self.assertRaises(ValueError, trixy.processors.Replacer, {b'': b'x'})
+
+
+class TestReplaceInput(trixy.TrixyInput):
+    def __init__(self, sock, addr):
+        super().__init__(sock, addr)
+        processor = trixy.processors.ReplaceProcessor(up=REPLACER)
+        self.connect_node(processor)
+        processor.connect_node(trixy.TrixyOutput(LOC_HOST, LOC_PORT))
+
+
+class TestReplaceProcessor(utils.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.server = trixy.TrixyServer(TestReplaceInput, SRV_HOST, SRV_PORT)
+
+        self.rsock = socket.socket()
+        self.rsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.rsock.bind((LOC_HOST, LOC_PORT))
+        self.rsock.listen(2)
+        self.rsock.settimeout(2)
+
+    def tearDown(self):
+        super().tearDown()
+        self.server.close()
+        self.rsock.close()
+
+    def test_split_response(self):
+        '''
+        Test that a response split between several sends is rewritten,
+        and that held back bytes are sent before the connection closes.
+        '''
+        osock = socket.create_connection((SRV_HOST, SRV_PORT), timeout=2)
+        isock = self.rsock.accept()[0]
+
+        osock.sendall(b'hwft')
+        self.assertEqual(isock.recv(4), b'hwft')
+        for piece in (b'<h1>Exam', b'ple Dom', b'ain</h1> Exa'):
+            isock.sendall(piece)
+            time.sleep(0.05)
+        isock.close()
+
+        received = b''
+        while True:
+            data = osock.recv(65536)
+            if not data:
+                break
+            received += data
+        self.assertEqual(received, b'<h1>Win Domain!</h1> Exa')
+        osock.close()
@@ -4,11 +4,21 @@ Test the functionality of the proxy implementations.
 import asyncore
 import socket
 import struct
+import time
 import trixy.proxy
 from tests import utils
 from tests.utils import SRV_HOST, SRV_PORT, LOC_HOST, LOC_PORT
 
 
+class Recorder(trixy.TrixyProcessor):
+    def __init__(self):
+        super().__init__()
+        self.down = []
+
+    def handle_packet_down(self, data):
+        self.down.append(data)
+
+
 class TestSocks4Input(utils.TestCase):
     def setUp(self):
         super().setUp()
@@ -70,3 +80,374 @@ class TestSocks4Input(utils.TestCase):
         self.assertRaises(socket.error, osock.send,
                           b'so this should cause an error')
 
+
+    def test_fragmented_request_with_payload(self):
+        '''
+        Test a request split across several sends, with the start of the
+        payload sent in the same segment as the end of the request.
+        '''
+        request_host = socket.inet_aton(LOC_HOST)
+        request_port = struct.pack('!H', LOC_PORT)
+        request_packet = (b'\x04\x01' + request_port +
+                          request_host + b'trixy\x00')
+        osock = socket.socket()
+        osock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        osock.connect((SRV_HOST, SRV_PORT))
+        for i in range(0, len(request_packet) - 1, 3):
+            osock.send(request_packet[i:min(i + 3, len(request_packet) - 1)])
+            time.sleep(0.02)
+        osock.send(request_packet[-1:] + b'early')
+
+        isock = self.rsock.accept()[0]
+        self.assertEqual(osock.recv(8)[1], 90)
+        self.assertEqual(isock.recv(16), b'early')
+
+        isock.close()
+        osock.close()
+
+    def test_refused_request(self):
+        '''
+        Test that a request to a port nobody listens on is answered
+        with a failure reply rather than being granted.
+        '''
+        request_port = struct.pack('!H', LOC_PORT + 1)
+        request_packet = (b'\x04\x01' + request_port +
+                          socket.inet_aton(LOC_HOST) + b'trixy\x00')
+        osock = socket.socket()
+        osock.settimeout(2)
+        osock.connect((SRV_HOST, SRV_PORT))
+        osock.send(request_packet)
+
+        self.assertEqual(osock.recv(8)[1], 91)
+        self.assertEqual(osock.recv(8), b'')
+        osock.close()
+
+    def test_payload_after_rejected_request(self):
+        '''
+        Test that data following a rejected request is not forwarded.
+        '''
+        class RejectingInput(trixy.proxy.Socks4Input):
+            def __init__(self, sock, addr):
+                super().__init__(sock, addr)
+                self.connect_node(recorder)
+
+            def handle_connect_request(self, addr, port, userid):
+                self.reply_request_rejected_id_mismatch(addr, port)
+
+        recorder = Recorder()
+        left, right = socket.socketpair()
+        self.addCleanup(right.close)
+        tinput = RejectingInput(left, ('127.0.0.1', 1))
+        self.addCleanup(tinput.close)
+        tinput.handle_packet_down(b'\x04\x01\x00\x50\x7f\x00\x00\x01'
+                                  b'trixy\x00hwft')
+        tinput.handle_packet_down(b'more')
+        self.assertEqual(recorder.down, [])
+
+    def test_close_after_refusal(self):
+        '''
+        Test that the connection is closed once a refusal is sent, even
+        with no output attached.
+        '''
+        class RefusingInput(trixy.proxy.Socks4Input):
+            def handle_connect_request(self, addr, port, userid):
+                self.reply_request_failed(addr, port)
+
+        left, right = socket.socketpair()
+        self.addCleanup(right.close)
+        right.settimeout(2)
+        tinput = RefusingInput(left, ('127.0.0.1', 1))
+        self.addCleanup(tinput.close)
+        tinput.handle_packet_down(b'\x04\x01\x00\x50\x7f\x00\x00\x01'
+                                  b'trixy\x00')
+        self.assertTrue(tinput.closed)
+        self.assertEqual(right.recv(100),
+                         b'\x00\x5b\x00\x50\x7f\x00\x00\x01')
+        self.assertEqual(right.recv(100), b'')
+
+
+class TestSocks4aInput(TestSocks4Input):
+    def setUp(self):
+        utils.TestCase.setUp(self)
+        self.server = trixy.TrixyServer(trixy.proxy.Socks4aInput,
+                                        SRV_HOST, SRV_PORT)
+
+        self.rsock = socket.socket()
+        self.rsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.rsock.bind((LOC_HOST, LOC_PORT))
+        self.rsock.listen(2)
+
+    def test_hostname_request(self):
+        request_port = struct.pack('!H', LOC_PORT)
+        request_packet = (b'\x04\x01' + request_port + b'\x00\x00\x00\x01' +
+                          b'trixy\x00' + LOC_HOST.encode('ascii') + b'\x00')
+        osock = socket.socket()
+        osock.connect((SRV_HOST, SRV_PORT))
+        osock.send(request_packet + b'hwft')
+
+        isock = self.rsock.accept()[0]
+        self.assertEqual(osock.recv(8)[1], 90)
+        self.assertEqual(isock.recv(6), b'hwft')
+
+        isock.close()
+        osock.close()
+
+
+class TestSocks5Input(utils.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.server = trixy.TrixyServer(trixy.proxy.Socks5Input,
+                                        SRV_HOST, SRV_PORT)
+
+        self.rsock = socket.socket()
+        self.rsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.rsock.bind((LOC_HOST, LOC_PORT))
+        self.rsock.listen(2)
+
+    def tearDown(self):
+        super().tearDown()
+        self.server.close()
+        self.rsock.close()
+
+    def request_packet(self):
+        return (b'\x05\x01\x00\x01' + socket.inet_aton(LOC_HOST) +
+                struct.pack('!H', LOC_PORT))
+
+    def test_coalesced_handshake(self):
+        '''
+        Test the method selection, request, and payload all arriving in
+        a single segment.
+        '''
+        osock = socket.socket()
+        osock.connect((SRV_HOST, SRV_PORT))
+        osock.send(b'\x05\x01\x00' + self.request_packet() + b'hwft')
+
+        isock = self.rsock.accept()[0]
+        self.assertEqual(isock.recv(6), b'hwft')
+
+        reply = b''
+        while len(reply) < 12:
+            reply += osock.recv(12 - len(reply))
+        self.assertEqual(reply[:2], b'\x05\x00')
+        self.assertEqual(reply[2:4], b'\x05\x00')
+
+        isock.close()
+        osock.close()
+
+    def test_fragmented_handshake(self):
+        osock = socket.socket()
+        osock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        osock.connect((SRV_HOST, SRV_PORT))
+        for part in (b'\x05', b'\x01\x00'):
+            osock.send(part)
+            time.sleep(0.02)
+        self.assertEqual(osock.recv(2), b'\x05\x00')
+
+        request = self.request_packet()
+        for i in range(len(request)):
+            osock.send(request[i:i + 1])
+            time.sleep(0.02)
+
+        isock = self.rsock.accept()[0]
+        self.assertEqual(osock.recv(10)[:2], b'\x05\x00')
+        osock.send(b'hwft')
+        self.assertEqual(isock.recv(6), b'hwft')
+
+        isock.close()
+        osock.close()
+
+    def test_refused_request(self):
+        osock = socket.socket()
+        osock.settimeout(2)
+        osock.connect((SRV_HOST, SRV_PORT))
+        osock.send(b'\x05\x01\x00\x05\x01\x00\x01' +
+                   socket.inet_aton(LOC_HOST) + struct.pack('!H', LOC_PORT + 1))
+
+        reply = b''
+        while len(reply) < 12:
+            reply += osock.recv(12 - len(reply))
+        self.assertEqual(reply[2:4], b'\x05\x05')
+        self.assertEqual(osock.recv(8), b'')
+        osock.close()
+
+    def test_refused_method(self):
+        '''
+        Test that nothing sent after a refused method selection is acted
+        on.
+        '''
+        left, right = socket.socketpair()
+        self.addCleanup(right.close)
+        tinput = trixy.proxy.Socks5Input(left, ('127.0.0.1', 1))
+        self.addCleanup(tinput.close)
+        requests = []
+        tinput.handle_connect_request = lambda *args: requests.append(args)
+        tinput.handle_packet_down(b'\x05\x01\x02' + b'\x05\x01\x00' +
+                                  self.request_packet() + b'hwft')
+        self.assertTrue(tinput.closed)
+        self.assertEqual(requests, [])
+        self.assertEqual(tinput.handshake_buffer, b'')
+
+
+class TestSocks5OutputInput(trixy.TrixyInput):
+    def __init__(self, sock, addr):
+        super().__init__(sock, addr)
+        self.connect_node(trixy.proxy.Socks5Output(
+            '10.0.0.1', 80, proxyhost=LOC_HOST, proxyport=LOC_PORT))
+
+
+class TestSocks5Output(utils.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.server = trixy.TrixyServer(TestSocks5OutputInput,
+                                        SRV_HOST, SRV_PORT)
+
+        self.rsock = socket.socket()
+        self.rsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.rsock.bind((LOC_HOST, LOC_PORT))
+        self.rsock.listen(2)
+
+    def tearDown(self):
+        super().tearDown()
+        self.server.close()
+        self.rsock.close()
+
+    def test_coalesced_replies(self):
+        '''
+        Test the proxy server sending its method selection, its reply,
+        and the first payload bytes in a single segment.
+        '''
+        osock = socket.socket()
+        osock.connect((SRV_HOST, SRV_PORT))
+        osock.send(b'early')
+
+        psock = self.rsock.accept()[0]
+        psock.settimeout(2)
+        osock.settimeout(2)
+        self.assertEqual(psock.recv(3), b'\x05\x01\x00')
+        psock.send(b'\x05\x00')
+        request = b'\x05\x01\x00\x01' + socket.inet_aton('10.0.0.1') + b'\x00P'
+        self.assertEqual(psock.recv(len(request)), request)
+
+        psock.send(b'\x05\x00\x00\x01\x7f\x00\x00\x01\x00Phwft')
+        self.assertEqual(osock.recv(6), b'hwft')
+        self.assertEqual(psock.recv(5), b'early')
+
+        psock.close()
+        osock.close()
+
+
+class TestSocks4OutputInput(trixy.TrixyInput):
+    output = trixy.proxy.Socks4Output
+    host = '10.0.0.1'
+
+    def __init__(self, sock, addr):
+        super().__init__(sock, addr)
+        self.connect_node(self.output(
+            self.host, 80, proxyhost=LOC_HOST, proxyport=LOC_PORT))
+
+
+class TestSocks4Output(utils.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.server = trixy.TrixyServer(TestSocks4OutputInput,
+                                        SRV_HOST, SRV_PORT)
+
+        self.rsock = socket.socket()
+        self.rsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.rsock.bind((LOC_HOST, LOC_PORT))
+        self.rsock.listen(2)
+        self.rsock.settimeout(2)
+
+    def tearDown(self):
+        super().tearDown()
+        self.server.close()
+        self.rsock.close()
+        TestSocks4OutputInput.output = trixy.proxy.Socks4Output
+        TestSocks4OutputInput.host = '10.0.0.1'
+
+    def connect(self):
+        osock = socket.create_connection((SRV_HOST, SRV_PORT), timeout=2)
+        osock.send(b'early')
+        psock = self.rsock.accept()[0]
+        psock.settimeout(2)
+        return osock, psock
+
+    def recv_exactly(self, sock, size):
+        data = b''
+        while len(data) < size:
+            chunk = sock.recv(size - len(data))
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+    def test_pipelined(self):
+        '''
+        Test that the request and the early data are sent before the
+        server replies, and that payload coalesced with the reply is
+        forwarded.
+        '''
+        osock, psock = self.connect()
+        request = (b'\x04\x01\x00P' + socket.inet_aton('10.0.0.1') +
+                   b'\x00')
+        self.assertEqual(self.recv_exactly(psock, len(request) + 5),
+                         request + b'early')
+
+        psock.send(b'\x00\x5a\x00P\x0a\x00\x00\x01hwft')
+        self.assertEqual(self.recv_exactly(osock, 4), b'hwft')
+        osock.send(b'late')
+        self.assertEqual(self.recv_exactly(psock, 4), b'late')
+
+        psock.close()
+        osock.close()
+
+    def test_split_reply(self):
+        osock, psock = self.connect()
+        self.recv_exactly(psock, 14)
+        psock.send(b'\x00\x5a\x00')
+        time.sleep(0.1)
+        psock.send(b'P\x0a\x00\x00\x01hwft')
+        self.assertEqual(self.recv_exactly(osock, 4), b'hwft')
+
+        psock.close()
+        osock.close()
+
+    def test_rejected(self):
+        '''
+        Test that a rejected request closes the chain.
+        '''
+        osock, psock = self.connect()
+        self.recv_exactly(psock, 14)
+        psock.send(b'\x00\x5b\x00P\x0a\x00\x00\x01')
+        self.assertEqual(osock.recv(10), b'')
+
+        psock.close()
+        osock.close()
+
+    def test_socks4a_hostname(self):
+        '''
+        Test that SOCKS4a sends hostnames to the server to look up.
+        '''
+        TestSocks4OutputInput.output = trixy.proxy.Socks4aOutput
+        TestSocks4OutputInput.host = 'example.com'
+        osock, psock = self.connect()
+        request = b'\x04\x01\x00P\x00\x00\x00\x01\x00example.com\x00'
+        self.assertEqual(self.recv_exactly(psock, len(request) + 5),
+                         request + b'early')
+
+        psock.close()
+        osock.close()
+
+    def test_socks4_hostname(self):
+        '''
+        Test that SOCKS4 looks hostnames up locally.
+        '''
+        TestSocks4OutputInput.host = 'localhost'
+        osock, psock = self.connect()
+        request = (b'\x04\x01\x00P' + socket.inet_aton('127.0.0.1') +
+                   b'\x00')
+        self.assertEqual(self.recv_exactly(psock, len(request) + 5),
+                         request + b'early')
+
+        psock.close()
+        osock.close()
@@ -0,0 +1,234 @@
+'''
+Test replaying captured sessions.
+'''
+import os
+import socket
+import tempfile
+import threading
+import time
+import unittest
+import trixy
+import trixy.capture
+import trixy.replay
+import trixy.timers
+from tests.utils import LOC_HOST, LOC_PORT
+from trixy.capture import OPEN, DOWN, UP, CLOSE
+
+
+class Server(trixy.TrixyProcessor):
+    '''
+    Record the data moving down, and answer each packet with 'ok'.
+    '''
+    def __init__(self):
+        super().__init__()
+        self.packets = []
+        self.closed = False
+
+    def handle_packet_down(self, data):
+        self.packets.append(bytes(data))
+        self.forward_packet_up(b'ok')
+
+    def handle_close(self, direction='down'):
+        self.closed = True
+
+
+class ServerSession(trixy.replay.ReplaySession):
+    wait_connected = False
+    servers = []
+
+    def __init__(self, replay, conn_id):
+        super().__init__(replay, conn_id)
+        self.server = Server()
+        self.servers.append((conn_id, time.monotonic(), self.server))
+        self.connect_node(self.server)
+
+
+class Keeper(trixy.TrixyProcessor):
+    '''
+    Keep the packets moving down without copying them.
+    '''
+    def __init__(self):
+        super().__init__()
+        self.batches = []
+
+    def handle_batch_down(self, batch):
+        self.batches.append(batch)
+
+
+class KeepingSession(trixy.replay.ReplaySession):
+    wait_connected = False
+
+    def __init__(self, replay, conn_id):
+        super().__init__(replay, conn_id)
+        self.connect_node(Keeper())
+
+
+class SilentSession(trixy.replay.ReplaySession):
+    wait_connected = False
+
+    def __init__(self, replay, conn_id):
+        super().__init__(replay, conn_id)
+        self.connect_node(trixy.TrixyProcessor())
+
+
+class TestReplay(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'cap.log')
+        writer = trixy.capture.CaptureWriter(self.path)
+        for conn, start in ((1, 100.0), (2, 100.5)):
+            writer.record(conn, OPEN, timestamp=start)
+            writer.record(conn, DOWN, b'one%i' % conn, timestamp=start)
+            writer.record(conn, UP, b'ok', timestamp=start + 0.1)
+            writer.record(conn, DOWN, b'two%i' % conn, timestamp=start + 1)
+            writer.record(conn, UP, b'ok', timestamp=start + 1.1)
+            writer.record(conn, CLOSE, timestamp=start + 1.2)
+        writer.close()
+        ServerSession.servers = []
+        self.wheel = trixy.timers.TimerWheel(resolution=0.01)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def replay(self, **kwargs):
+        replay = trixy.replay.Replay(self.path, ServerSession,
+                                     wheel=self.wheel, **kwargs)
+        self.addCleanup(replay.close)
+        return replay
+
+    def test_index(self):
+        replay = self.replay()
+        self.assertEqual(list(replay.connections), [1, 2])
+        self.assertEqual([len(offsets) for offsets in
+                          replay.connections.values()], [6, 6])
+
+    def test_fast(self):
+        '''
+        Test that every session is replayed through its chain.
+        '''
+        replay = self.replay(speed=None)
+        replay.run()
+        self.assertTrue(replay.done)
+        self.assertEqual((replay.opened, replay.finished, replay.failed),
+                         (2, 2, 0))
+        self.assertEqual(
+            [(conn, server.packets, server.closed)
+             for conn, started, server in ServerSession.servers],
+            [(1, [b'one1', b'two1'], True), (2, [b'one2', b'two2'], True)])
+        self.assertEqual(replay.bytes_sent, 16)
+        self.assertEqual(replay.bytes_received, 8)
+
+    def test_close_after_kept_data(self):
+        '''
+        Test that the file can be unmapped while the chain still holds
+        the data it was sent.
+        '''
+        replay = trixy.replay.Replay(self.path, KeepingSession, speed=None,
+                                     wheel=self.wheel)
+        replay.start()
+        self.assertEqual(replay.opened, 2)
+        replay.close()
+
+    def test_timing(self):
+        '''
+        Test that sessions start and send at the scaled times.
+        '''
+        replay = self.replay(speed=10)
+        began = time.monotonic()
+        replay.run()
+        elapsed = time.monotonic() - began
+        self.assertGreaterEqual(elapsed, 0.15)
+        self.assertLess(elapsed, 1.0)
+        first, second = ServerSession.servers
+        self.assertGreaterEqual(second[1] - first[1], 0.04)
+        self.assertEqual(second[2].packets, [b'one2', b'two2'])
+
+    def test_concurrency(self):
+        '''
+        Test that sessions past the concurrency limit wait their turn.
+        '''
+        replay = self.replay(speed=None, concurrency=1)
+        replay.start()
+        self.assertEqual(replay.opened, 2)
+        self.assertEqual(replay.active, 0)
+
+        # Sessions that get no answer linger, holding their place.
+        replay = trixy.replay.Replay(self.path, SilentSession, speed=None,
+                                     concurrency=1, wheel=self.wheel)
+        self.addCleanup(replay.close)
+        replay.start()
+        self.assertEqual((replay.opened, replay.active), (1, 1))
+
+
+class Backend(threading.Thread):
+    '''
+    Accept connections and echo what they send.
+    '''
+    def __init__(self, sock):
+        super().__init__(daemon=True)
+        self.sock = sock
+        self.received = []
+
+    def run(self):
+        while True:
+            try:
+                conn = self.sock.accept()[0]
+            except OSError:
+                return
+            with conn:
+                data = b''
+                while True:
+                    chunk = conn.recv(65536)
+                    if not chunk:
+                        break
+                    data += chunk
+                    conn.sendall(chunk)
+                self.received.append(data)
+
+
+class OutputSession(trixy.replay.ReplaySession):
+    linger = 2.0
+
+    def __init__(self, replay, conn_id):
+        super().__init__(replay, conn_id)
+        self.connect_node(trixy.TrixyOutput(LOC_HOST, LOC_PORT))
+
+
+class TestReplayOutput(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'cap.log')
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((LOC_HOST, LOC_PORT))
+        self.sock.listen(10)
+        self.backend = Backend(self.sock)
+        self.backend.start()
+
+    def tearDown(self):
+        # Wake the backend from accept().
+        self.sock.shutdown(socket.SHUT_RDWR)
+        self.backend.join()
+        self.sock.close()
+        self.dir.cleanup()
+
+    def test_replay(self):
+        '''
+        Test replaying large sessions against a server.
+        '''
+        payload = bytes(range(256)) * 4096
+        writer = trixy.capture.CaptureWriter(self.path)
+        for conn in range(1, 4):
+            writer.record(conn, OPEN, timestamp=0)
+            writer.record(conn, DOWN, payload, timestamp=0)
+            writer.record(conn, UP, payload, timestamp=0)
+            writer.record(conn, CLOSE, timestamp=0)
+        writer.close()
+
+        replay = trixy.replay.Replay(self.path, OutputSession, speed=None)
+        replay.run()
+        replay.close()
+        self.assertEqual((replay.finished, replay.failed), (3, 0))
+        self.assertEqual(replay.bytes_received, 3 * len(payload))
+        time.sleep(0.2)
+        self.assertEqual(self.backend.received, [payload] * 3)
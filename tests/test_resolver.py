@@ -0,0 +1,119 @@
+'''
+Test the caching, non-blocking hostname resolver.
+'''
+import asyncio
+import asyncore
+import socket
+import threading
+import unittest
+from unittest import mock
+from trixy.resolver import Resolver
+
+
+FAKE_RESULT = [(socket.AF_INET, socket.SOCK_STREAM, 6, '',
+                ('127.1.1.1', 80))]
+
+
+class TestResolver(unittest.TestCase):
+    def setUp(self):
+        self.release = threading.Event()
+        self.calls = []
+
+        def getaddrinfo(host, *args, **kwargs):
+            if kwargs.get('flags') or len(args) > 3:
+                raise socket.gaierror(socket.EAI_NONAME, 'not numeric')
+            self.calls.append(host)
+            self.release.wait(5)
+            if host == 'bad.test':
+                raise socket.gaierror(socket.EAI_NONAME, 'unknown host')
+            return FAKE_RESULT
+
+        patcher = mock.patch('socket.getaddrinfo', getaddrinfo)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.resolver = Resolver()
+
+    def run_until(self, condition):
+        for i in range(50):
+            if condition():
+                return
+            asyncore.loop(0.1, count=1)
+        self.fail('Lookup did not finish')
+
+    def test_lookups_coalesced_and_cached(self):
+        results = []
+        self.resolver.resolve('host.test', 80, results.append)
+        self.resolver.resolve('host.test', 80, results.append)
+        self.assertEqual(results, [])
+        self.release.set()
+        self.run_until(lambda: len(results) == 2)
+
+        self.resolver.resolve('host.test', 80, results.append)
+        self.assertEqual(len(results), 3)
+        self.assertEqual(self.calls, ['host.test'])
+        self.assertEqual(self.resolver.stats()['hits'], 1)
+        self.assertEqual(self.resolver.stats()['misses'], 1)
+        self.assertEqual(self.resolver.stats()['coalesced'], 1)
+        self.assertIsNone(self.resolver.waker)
+
+    def test_failures_cached(self):
+        self.release.set()
+        results = []
+        self.resolver.resolve('bad.test', 80, results.append)
+        self.run_until(lambda: results)
+        self.resolver.resolve('bad.test', 80, results.append)
+        self.assertIsInstance(results[0], socket.gaierror)
+        self.assertIs(results[0], results[1])
+        self.assertEqual(self.calls, ['bad.test'])
+
+    def test_numeric_hosts_skip_lookup(self):
+        mock.patch.stopall()
+        results = []
+        self.resolver.resolve('127.0.0.1', 80, results.append)
+        self.assertEqual(results[0][0][4], ('127.0.0.1', 80))
+        self.assertEqual(self.resolver.stats()['misses'], 0)
+
+    def test_resolve_async(self):
+        self.release.set()
+
+        async def lookup():
+            return await asyncio.gather(
+                self.resolver.resolve_async('host.test', 80),
+                self.resolver.resolve_async('host.test', 80))
+        self.assertEqual(asyncio.run(lookup()), [FAKE_RESULT, FAKE_RESULT])
+        self.assertEqual(self.calls, ['host.test'])
+        self.assertEqual(self.resolver.stats()['coalesced'], 1)
+
+    def test_resolve_async_failure_not_reraised(self):
+        self.release.set()
+
+        async def lookup():
+            try:
+                await self.resolver.resolve_async('bad.test', 80)
+            except socket.gaierror as e:
+                return e
+        errors = [asyncio.run(lookup()) for i in range(5)]
+        self.assertEqual(self.calls, ['bad.test'])
+        self.assertEqual(len(set(map(id, errors))), 5)
+        depths = []
+        for error in errors[1:]:
+            depth, tb = 0, error.__traceback__
+            while tb is not None:
+                depth, tb = depth + 1, tb.tb_next
+            depths.append(depth)
+        self.assertEqual(len(set(depths)), 1)
+
+    def test_raising_callback(self):
+        results = []
+
+        def fail(result):
+            raise ValueError('callback failed')
+        self.resolver.resolve('host.test', 80, fail)
+        self.resolver.resolve('host.test', 80, results.append)
+        self.resolver.resolve('other.test', 80, results.append)
+        self.release.set()
+        with mock.patch('asyncore.dispatcher.log_info') as log_info:
+            self.run_until(lambda: len(results) == 2)
+        self.assertEqual(log_info.call_args[0][1], 'error')
+        self.assertEqual(self.resolver.pending, {})
+        self.assertIsNone(self.resolver.waker)
@@ -0,0 +1,155 @@
+'''
+Test mirroring data with a TeeProcessor.
+'''
+import socket
+import unittest
+import trixy
+import trixy.tee
+from tests import utils
+from tests.utils import SRV_HOST, SRV_PORT, LOC_HOST, LOC_PORT
+
+
+class Recorder(trixy.TrixyProcessor):
+    def __init__(self):
+        super().__init__()
+        self.packets = []
+        self.closed = False
+
+    def handle_packet_down(self, data):
+        self.packets.append(data)
+
+    def handle_close(self, direction='down'):
+        self.closed = True
+
+
+class TestTeeProcessor(unittest.TestCase):
+    def setUp(self):
+        self.tee = trixy.tee.TeeProcessor()
+        self.primary = Recorder()
+        self.tee.connect_node(self.primary)
+
+    def add_mirror(self, policy):
+        mirror = Recorder()
+        branch = self.tee.add_mirror(mirror, max_queued=6, policy=policy)
+        return mirror, branch
+
+    def test_shared(self):
+        '''
+        Test that every mirror gets the same copy of the data.
+        '''
+        first, branch = self.add_mirror(trixy.tee.CLOSE)
+        second, branch = self.add_mirror(trixy.tee.CLOSE)
+        self.tee.handle_batch_down([memoryview(bytearray(b'hwft'))])
+        self.assertEqual(first.packets, [b'hwft'])
+        self.assertIs(first.packets[0], second.packets[0])
+        self.assertEqual(bytes(self.primary.packets[0]), b'hwft')
+
+    def test_queue(self):
+        '''
+        Test that a paused mirror does not pause the primary path, and
+        gets its queued data in order once it resumes.
+        '''
+        mirror, branch = self.add_mirror(trixy.tee.DROP_NEWEST)
+        paused = []
+        self.tee.handle_pause = lambda direction='up': paused.append(1)
+        mirror.handle_pause('up')
+        for data in (b'ab', b'cd', b'ef', b'gh'):
+            self.tee.handle_packet_down(data)
+        self.assertEqual(paused, [])
+        self.assertEqual(len(self.primary.packets), 4)
+        self.assertEqual(mirror.packets, [])
+        self.assertEqual(branch.dropped, 2)
+
+        self.tee.handle_close()
+        self.assertFalse(mirror.closed)
+        mirror.handle_resume('up')
+        self.assertEqual(mirror.packets, [b'ab', b'cd', b'ef'])
+        self.assertTrue(mirror.closed)
+
+    def test_close_up(self):
+        '''
+        Test that the mirrors are closed when the primary path closes
+        from below, once their queues are sent.
+        '''
+        mirror, branch = self.add_mirror(trixy.tee.DROP_NEWEST)
+        mirror.handle_pause('up')
+        self.tee.handle_packet_down(b'ab')
+        self.tee.handle_close('up')
+        self.assertFalse(mirror.closed)
+        mirror.handle_resume('up')
+        self.assertEqual(mirror.packets, [b'ab'])
+        self.assertTrue(mirror.closed)
+
+    def test_drop_oldest(self):
+        mirror, branch = self.add_mirror(trixy.tee.DROP_OLDEST)
+        mirror.handle_pause('up')
+        for data in (b'ab', b'cd', b'ef', b'gh'):
+            self.tee.handle_packet_down(data)
+        mirror.handle_resume('up')
+        self.assertEqual(mirror.packets, [b'cd', b'ef', b'gh'])
+
+    def test_close_policy(self):
+        mirror, branch = self.add_mirror(trixy.tee.CLOSE)
+        mirror.handle_pause('up')
+        for data in (b'ab', b'cd', b'ef', b'gh'):
+            self.tee.handle_packet_down(data)
+        self.assertTrue(mirror.closed)
+        self.assertEqual(mirror.packets, [])
+        self.assertEqual(len(self.primary.packets), 4)
+
+
+class TeeInput(trixy.TrixyInput):
+    def __init__(self, sock, addr):
+        super().__init__(sock, addr)
+        tee = trixy.tee.TeeProcessor()
+        self.connect_node(tee)
+        tee.connect_node(trixy.TrixyOutput(LOC_HOST, LOC_PORT))
+        tee.add_mirror(trixy.TrixyOutput(LOC_HOST, LOC_PORT + 1),
+                       max_queued=65536)
+
+
+class TestStalledMirror(utils.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.server = trixy.TrixyServer(TeeInput, SRV_HOST, SRV_PORT)
+        self.socks = []
+        for port in (LOC_PORT, LOC_PORT + 1):
+            sock = socket.socket()
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((LOC_HOST, port))
+            sock.listen(2)
+            sock.settimeout(2)
+            self.socks.append(sock)
+
+    def tearDown(self):
+        super().tearDown()
+        self.server.close()
+        for sock in self.socks:
+            sock.close()
+
+    def test_primary_unaffected(self):
+        '''
+        Test that a mirror that never reads does not hold up the
+        primary output.
+        '''
+        payload = bytes(range(256)) * 4096 * 8
+        osock = socket.create_connection((SRV_HOST, SRV_PORT), timeout=2)
+        isock = self.socks[0].accept()[0]
+        isock.settimeout(2)
+        msock = self.socks[1].accept()[0]
+
+        osock.setblocking(False)
+        sent = 0
+        received = 0
+        while received < len(payload):
+            if sent < len(payload):
+                try:
+                    sent += osock.send(payload[sent:sent + 65536])
+                except BlockingIOError:
+                    pass
+            received += len(isock.recv(1 << 20))
+        self.assertEqual(received, len(payload))
+
+        osock.close()
+        isock.close()
+        msock.close()
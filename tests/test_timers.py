@@ -0,0 +1,246 @@
+'''
+Test the timer wheel and connection timeouts.
+'''
+import asyncore
+import os
+import random
+import socket
+import time
+import unittest
+import trixy
+import trixy.encryption
+import trixy.proxy
+import trixy.timers
+from tests import utils
+from tests.utils import SRV_HOST, SRV_PORT, LOC_HOST, LOC_PORT
+
+
+CERTFILE = os.path.join(os.path.dirname(__file__), 'certs', 'localhost.pem')
+
+
+class Item():
+    timer_slot = None
+
+    def __init__(self, fired, deadline):
+        self.fired = fired
+        self.deadline = deadline
+
+    def handle_timer(self):
+        self.fired.append(self)
+
+
+class TestTimerWheel(unittest.TestCase):
+    def test_deadlines(self):
+        '''
+        Test that items on every level fire after their deadline, and
+        within one tick of it.
+        '''
+        wheel = trixy.timers.TimerWheel(resolution=1, slot_bits=2, levels=3)
+        start = wheel.tick
+        fired = []
+        random.seed(3)
+        deadlines = [start + random.uniform(0, 200) for i in range(300)]
+        items = [Item(fired, deadline) for deadline in deadlines]
+        for item in items:
+            wheel.schedule(item, item.deadline)
+        cancelled = items[::7]
+        for item in cancelled:
+            wheel.cancel(item)
+        self.assertEqual(len(wheel), len(items) - len(cancelled))
+
+        now = start
+        while wheel:
+            now += wheel.next_timeout(now)
+            fired.clear()
+            wheel.advance(now)
+            for item in fired:
+                self.assertGreaterEqual(now, item.deadline)
+                self.assertLess(now - item.deadline, 1)
+        self.assertLess(now, start + 202)
+
+    def test_next_timeout(self):
+        wheel = trixy.timers.TimerWheel(resolution=0.5)
+        now = wheel.tick * 0.5
+        self.assertIsNone(wheel.next_timeout(now))
+        wheel.schedule(Item([], 0), now + 2)
+        # The wait can end early, where a higher level moves down.
+        self.assertGreater(wheel.next_timeout(now), 0)
+        self.assertLessEqual(wheel.next_timeout(now), 2)
+
+    def test_defer(self):
+        '''
+        Test that a deferred item fires from the loop rather than at
+        once, and that the loop can exit afterwards.
+        '''
+        wheel = trixy.timers.TimerWheel()
+        fired = []
+        item = Item(fired, 0)
+        wheel.schedule(item, time.monotonic() + 60)
+        wheel.defer(item)
+        self.assertEqual((fired, len(wheel)), ([], 0))
+        self.assertIn(wheel.waker.socket.fileno(), asyncore.socket_map)
+        asyncore.loop(0.1, count=1)
+        self.assertEqual(fired, [item])
+        self.assertIsNone(wheel.waker)
+
+
+class IdleInput(trixy.TrixyInput):
+    idle_timeout = 0.5
+
+    def __init__(self, sock, addr):
+        super().__init__(sock, addr)
+        self.connect_node(trixy.TrixyOutput(LOC_HOST, LOC_PORT))
+
+
+class LifetimeInput(IdleInput):
+    idle_timeout = None
+    lifetime_timeout = 0.5
+
+
+class TestSocks5Input(trixy.proxy.Socks5Input):
+    handshake_timeout = 0.5
+
+
+class HandshakeSSLInput(trixy.encryption.TrixySSLInput):
+    handshake_timeout = 0.5
+
+    def __init__(self, sock, addr):
+        super().__init__(sock, addr, certfile=CERTFILE)
+        self.connect_node(trixy.TrixyOutput(LOC_HOST, LOC_PORT))
+
+
+class WheelOnlyOutput(trixy.TrixyOutput):
+    def set_user_timeout(self, timeout):
+        pass  # Leave the timeout to the wheel alone.
+
+
+class ConnectTimeoutInput(trixy.TrixyInput):
+    def __init__(self, sock, addr):
+        super().__init__(sock, addr)
+        self.connect_node(WheelOnlyOutput(LOC_HOST, LOC_PORT + 1,
+                                          connect_timeout=0.5))
+
+
+class TestConnectionTimeouts(utils.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.server = None
+        self.rsock = socket.socket()
+        self.rsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.rsock.bind((LOC_HOST, LOC_PORT))
+        self.rsock.listen(2)
+        self.rsock.settimeout(2)
+
+    def tearDown(self):
+        super().tearDown()
+        self.server.close()
+        self.rsock.close()
+
+    def assert_closed_after(self, sock, low, high):
+        start = time.monotonic()
+        sock.settimeout(high + 1)
+        self.assertEqual(sock.recv(1), b'')
+        self.assertGreaterEqual(time.monotonic() - start, low)
+        self.assertLess(time.monotonic() - start, high)
+
+    def test_idle(self):
+        '''
+        Test that activity holds off the idle timeout.
+        '''
+        self.server = trixy.TrixyServer(IdleInput, SRV_HOST, SRV_PORT)
+        osock = socket.create_connection((SRV_HOST, SRV_PORT), timeout=2)
+        isock = self.rsock.accept()[0]
+        isock.settimeout(2)
+        for i in range(4):
+            time.sleep(0.25)
+            osock.sendall(b'hwft')
+            self.assertEqual(isock.recv(4), b'hwft')
+        self.assert_closed_after(osock, 0.4, 1)
+        osock.close()
+        isock.close()
+
+    def test_lifetime(self):
+        self.server = trixy.TrixyServer(LifetimeInput, SRV_HOST, SRV_PORT)
+        osock = socket.create_connection((SRV_HOST, SRV_PORT), timeout=2)
+        isock = self.rsock.accept()[0]
+        osock.sendall(b'hwft')
+        self.assert_closed_after(osock, 0.3, 1)
+        osock.close()
+        isock.close()
+
+    def test_socks5_handshake(self):
+        '''
+        Test that a client that never sends its SOCKS5 request is
+        disconnected, and one that does is not.
+        '''
+        self.server = trixy.TrixyServer(TestSocks5Input, SRV_HOST, SRV_PORT)
+        stalled = socket.create_connection((SRV_HOST, SRV_PORT), timeout=2)
+        stalled.sendall(b'\x05\x01\x00')
+        self.assertEqual(stalled.recv(2), b'\x05\x00')
+
+        client = socket.create_connection((SRV_HOST, SRV_PORT), timeout=2)
+        client.sendall(b'\x05\x01\x00\x05\x01\x00\x01' +
+                       socket.inet_aton(LOC_HOST) +
+                       LOC_PORT.to_bytes(2, 'big'))
+        self.assertEqual(client.recv(2), b'\x05\x00')
+        self.assertEqual(client.recv(10)[:2], b'\x05\x00')
+        isock = self.rsock.accept()[0]
+
+        self.assert_closed_after(stalled, 0.2, 1)
+        time.sleep(0.5)
+        client.sendall(b'hwft')
+        isock.settimeout(2)
+        self.assertEqual(isock.recv(4), b'hwft')
+
+        stalled.close()
+        client.close()
+        isock.close()
+
+    def test_connect(self):
+        '''
+        Test that a connection attempt the server never answers is
+        given up after connect_timeout.
+        '''
+        # Fill the accept queue, so that further connection requests are
+        # dropped rather than refused.
+        blocked = socket.socket()
+        self.addCleanup(blocked.close)
+        blocked.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        blocked.bind((LOC_HOST, LOC_PORT + 1))
+        blocked.listen(0)
+        for i in range(8):
+            filler = socket.socket()
+            self.addCleanup(filler.close)
+            filler.setblocking(False)
+            filler.connect_ex((LOC_HOST, LOC_PORT + 1))
+
+        self.server = trixy.TrixyServer(ConnectTimeoutInput, SRV_HOST,
+                                        SRV_PORT)
+        osock = socket.create_connection((SRV_HOST, SRV_PORT), timeout=2)
+        self.assert_closed_after(osock, 0.4, 1)
+        osock.close()
+
+    def test_tls_handshake(self):
+        '''
+        Test that a client that never starts its TLS handshake is
+        disconnected.
+        '''
+        self.server = trixy.TrixyServer(HandshakeSSLInput, SRV_HOST,
+                                        SRV_PORT)
+        stalled = socket.create_connection((SRV_HOST, SRV_PORT), timeout=2)
+        isock = self.rsock.accept()[0]
+        self.assert_closed_after(stalled, 0.4, 1)
+        stalled.close()
+        isock.close()
+
+
+class TestAsyncoreLoopTimeouts(TestConnectionTimeouts):
+    '''
+    Run the timeout tests under asyncore.loop(), which never advances
+    the timer wheel.
+    '''
+    use_timers = False
+
+    def assert_closed_after(self, sock, low, high):
+        # Connections fire their own timers once they notice the stall.
+        super().assert_closed_after(sock, low, high + 1.5)
@@ -0,0 +1,75 @@
+'''
+Test the pre-forking worker pool.
+'''
+import os
+import signal
+import socket
+import sys
+import time
+import unittest
+import trixy
+import trixy.workers
+from tests.utils import SRV_HOST, SRV_PORT
+
+
+class TestWorkersEchoInput(trixy.TrixyInput):
+    def handle_packet_down(self, data):
+        self.send(data)
+
+
+class TestReusePort(unittest.TestCase):
+    def test_two_servers_share_port(self):
+        first = trixy.TrixyServer(TestWorkersEchoInput, SRV_HOST, SRV_PORT,
+                                  reuse_port=True)
+        second = trixy.TrixyServer(TestWorkersEchoInput, SRV_HOST, SRV_PORT,
+                                   reuse_port=True)
+        first.close()
+        second.close()
+
+
+class CrashingWorkerPool(trixy.workers.TrixyWorkerPool):
+    def __init__(self, stderr):
+        super().__init__(TestWorkersEchoInput, SRV_HOST, SRV_PORT)
+        self.stderr = stderr
+
+    def run_worker(self):
+        sys.stderr = os.fdopen(self.stderr, 'w', buffering=1)
+        raise ValueError('worker crashed')
+
+
+class TestWorkerCrash(unittest.TestCase):
+    def test_traceback_printed(self):
+        read_fd, write_fd = os.pipe()
+        pid = CrashingWorkerPool(write_fd).spawn_worker()
+        os.close(write_fd)
+        with os.fdopen(read_fd) as output:
+            report = output.read()
+        self.assertEqual(os.waitpid(pid, 0)[1] >> 8, 1)
+        self.assertIn('Traceback', report)
+        self.assertIn('ValueError: worker crashed', report)
+
+
+class TestWorkerPool(unittest.TestCase):
+    def setUp(self):
+        self.pool = trixy.workers.TrixyWorkerPool(
+            TestWorkersEchoInput, SRV_HOST, SRV_PORT, workers=2,
+            drain_timeout=2, restart_delay=0)
+        self.supervisor = os.fork()
+        if self.supervisor == 0:
+            try:
+                self.pool.run()
+            finally:
+                os._exit(0)
+        time.sleep(0.5)
+
+    def tearDown(self):
+        os.kill(self.supervisor, signal.SIGTERM)
+        pid, status = os.waitpid(self.supervisor, 0)
+        self.assertEqual(status, 0)
+
+    def test_roundtrip(self):
+        for i in range(4):
+            sock = socket.create_connection((SRV_HOST, SRV_PORT))
+            sock.send(b'hello world')
+            self.assertEqual(sock.recv(32), b'hello world')
+            sock.close()
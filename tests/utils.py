@@ -3,6 +3,7 @@ import threading
 import unittest
 
 import trixy
+import trixy.timers
 
 
 SRV_HOST = '127.1.1.1'  # This is the proxy to connect to
@@ -16,14 +17,17 @@ class AsyncorePoller(threading.Thread):
     Ensure that asyncore continues processing connections until the
     until the test that is using it has completed.
     '''
-    def __init__(self):
+    def __init__(self, use_timers=True):
         super().__init__()
         self.continue_running = True
+        self.use_timers = use_timers
 
     def run(self):
         while self.continue_running:
-            #  asyncore.poll()
-            asyncore.loop(1, count=1)
+            if self.use_timers:
+                trixy.timers.loop(1, count=1)
+            else:
+                asyncore.loop(0.2, count=1)
         asyncore.close_all()
 
     def stop(self):
@@ -31,8 +35,11 @@ class AsyncorePoller(threading.Thread):
 
 
 class TestCase(unittest.TestCase):
+    #: Run the loop with trixy.timers.loop() rather than asyncore.loop().
+    use_timers = True
+
     def setUp(self):
-        self.async_poller = AsyncorePoller()
+        self.async_poller = AsyncorePoller(self.use_timers)
         self.async_poller.start()
 
     def tearDown(self):
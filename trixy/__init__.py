@@ -18,7 +18,14 @@
 
 import asyncore
 import asynchat
+import os
 import socket
+import time
+
+from trixy.buffers import ChunkBuffer, as_bytes, default_pool
+from trixy.resolver import address_family, default_resolver
+from trixy.splice import DISCONNECTED, SpliceChannel, splice_supported
+from trixy.timers import default_wheel
 
 
 class TrixyNode():
@@ -26,6 +33,39 @@ class TrixyNode():
     A base class for TrixyNodes that implements some default packet
     forwarding and node linking.
     '''
+    #: Set to True on nodes that never inspect or alter the data passing
+    #: through them. Chains made only of opaque nodes can move data
+    #: between sockets without handing it to Python. A subclass that
+    #: overrides handle_packet_down or handle_packet_up is assumed to
+    #: not be opaque unless it sets this attribute itself.
+    opaque = False
+    #: The trixy.metrics.Metrics that packets handed between nodes and
+    #: connection lifetimes are recorded in, or None to record nothing.
+    #: Set by trixy.metrics.enable().
+    metrics = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        handlers = ('handle_packet_down', 'handle_packet_up',
+                    'handle_batch_down', 'handle_batch_up')
+        if 'opaque' not in cls.__dict__ and any(
+                name in cls.__dict__ for name in handlers):
+            cls.opaque = False
+        # A batch handler inherited from a class that handled packets
+        # differently must not bypass this class's packet handler.
+        if ('handle_packet_down' in cls.__dict__ and
+                'handle_batch_down' not in cls.__dict__):
+            cls.handle_batch_down = TrixyNode.handle_each_down
+        if ('handle_packet_up' in cls.__dict__ and
+                'handle_batch_up' not in cls.__dict__):
+            cls.handle_batch_up = TrixyNode.handle_each_up
+        # Likewise, single packets must reach a batch-only handler.
+        if ('handle_batch_down' in cls.__dict__ and
+                'handle_packet_down' not in cls.__dict__):
+            cls.handle_packet_down = TrixyNode.handle_single_down
+        if ('handle_batch_up' in cls.__dict__ and
+                'handle_packet_up' not in cls.__dict__):
+            cls.handle_packet_up = TrixyNode.handle_single_up
 
     def __init__(self):
         self.downstream_nodes = []
@@ -66,6 +106,10 @@ class TrixyNode():
 
         :param bytes data: The data to forward.
         '''
+        if self.metrics is not None:
+            for node in self.downstream_nodes:
+                self.metrics.call(node, 'down', data)
+            return
         for node in self.downstream_nodes:
             node.handle_packet_down(data)
 
@@ -75,9 +119,39 @@ class TrixyNode():
 
         :param bytes data: The data to forward.
         '''
+        if self.metrics is not None:
+            for node in self.upstream_nodes:
+                self.metrics.call(node, 'up', data)
+            return
         for node in self.upstream_nodes:
             node.handle_packet_up(data)
 
+    def forward_batch_down(self, batch):
+        '''
+        Forward a batch of packets to all downstream nodes.
+
+        :param list batch: The packets to forward.
+        '''
+        if self.metrics is not None:
+            for node in self.downstream_nodes:
+                self.metrics.call_batch(node, 'down', batch)
+            return
+        for node in self.downstream_nodes:
+            node.handle_batch_down(batch)
+
+    def forward_batch_up(self, batch):
+        '''
+        Forward a batch of packets to all upstream nodes.
+
+        :param list batch: The packets to forward.
+        '''
+        if self.metrics is not None:
+            for node in self.upstream_nodes:
+                self.metrics.call_batch(node, 'up', batch)
+            return
+        for node in self.upstream_nodes:
+            node.handle_batch_up(batch)
+
     def handle_close(self, direction='down'):
         '''
         The connection has closed on one end. So, shutdown what we are
@@ -93,6 +167,64 @@ class TrixyNode():
             for node in self.upstream_nodes:
                 node.handle_close(direction='up')
 
+    def handle_output_connected(self, output):
+        '''
+        An output further down the chain has connected and is ready to
+        carry data. By default the notice is passed to upstream nodes so
+        that it reaches the input; proxy inputs override this to tell
+        their client that the request succeeded.
+
+        :param TrixyOutput output: The output that connected.
+        '''
+        for node in self.upstream_nodes:
+            node.handle_output_connected(output)
+
+    def handle_output_failed(self, output, error):
+        '''
+        An output further down the chain could not connect. By default
+        the notice is passed to upstream nodes so that it reaches the
+        input; proxy inputs override this to tell their client that the
+        request failed. The output closes itself afterwards.
+
+        :param TrixyOutput output: The output that failed to connect.
+        :param Exception error: The reason the connection failed.
+        '''
+        for node in self.upstream_nodes:
+            node.handle_output_failed(output, error)
+
+    def handle_pause(self, direction='up'):
+        '''
+        A connection further along the chain has more data waiting to
+        be sent than it is willing to buffer. Pass the request along so
+        that the connection producing the data stops reading until
+        handle_resume is called.
+
+        :param str direction: 'up' or 'down' depending on if the
+          request travels to upstream nodes or downstream nodes.
+        '''
+        if direction == 'down':
+            for node in self.downstream_nodes:
+                node.handle_pause(direction='down')
+        elif direction == 'up':
+            for node in self.upstream_nodes:
+                node.handle_pause()
+
+    def handle_resume(self, direction='up'):
+        '''
+        A connection that requested a pause with handle_pause has
+        drained its send buffer. Pass the request along so that the
+        connection producing the data starts reading again.
+
+        :param str direction: 'up' or 'down' depending on if the
+          request travels to upstream nodes or downstream nodes.
+        '''
+        if direction == 'down':
+            for node in self.downstream_nodes:
+                node.handle_resume(direction='down')
+        elif direction == 'up':
+            for node in self.upstream_nodes:
+                node.handle_resume()
+
     def handle_packet_down(self, data):
         '''
         Hadle data moving downwards. TrixyProcessor children should
@@ -127,102 +259,884 @@ class TrixyNode():
         '''
         self.forward_packet_up(data)
 
+    def handle_batch_down(self, batch):
+        '''
+        Handle several packets moving downwards at once: everything a
+        connection read in one pass of the loop, as a list of
+        memoryviews. Processors that can work on many packets per call
+        may override this (and forward with forward_batch_down) instead
+        of, or as well as, handle_packet_down.
+
+        The memoryviews are only valid until this call returns, because
+        the memory they refer to is reused for later reads. Copy any
+        data that must be kept, for example with bytes().
+
+        A class that overrides handle_packet_down but not this method
+        gets handle_each_down instead, which hands the packets to
+        handle_packet_down one at a time. Otherwise the batch is
+        forwarded unchanged. In the same way, a class that overrides
+        this method but not handle_packet_down gets handle_single_down,
+        so single packets reach this method too.
+
+        :param list batch: The packets that are being handled.
+        '''
+        self.forward_batch_down(batch)
+
+    def handle_batch_up(self, batch):
+        '''
+        Handle several packets moving upwards at once. See
+        handle_batch_down.
+
+        :param list batch: The packets that are being handled.
+        '''
+        self.forward_batch_up(batch)
+
+    def handle_each_down(self, batch):
+        '''
+        Pass each packet of a batch to handle_packet_down as bytes.
+        '''
+        for data in batch:
+            self.handle_packet_down(as_bytes(data))
+
+    def handle_each_up(self, batch):
+        '''
+        Pass each packet of a batch to handle_packet_up as bytes.
+        '''
+        for data in batch:
+            self.handle_packet_up(as_bytes(data))
+
+    def handle_single_down(self, data):
+        '''
+        Pass a single packet to handle_batch_down as a batch of one.
+        '''
+        self.handle_batch_down((data,))
+
+    def handle_single_up(self, data):
+        '''
+        Pass a single packet to handle_batch_up as a batch of one.
+        '''
+        self.handle_batch_up((data,))
+
 
 class TrixyServer(asyncore.dispatcher):
     '''
     Main server to grab incoming connections and forward them.
     '''
 
-    def __init__(self, tinput, host, port):
+    #: The length of the queue of connections waiting to be accepted.
+    backlog = 100
+    #: A trixy.admission.Admission that decides which connections are
+    #: accepted, or None to accept all of them.
+    admission = None
+
+    def __init__(self, tinput, host, port, reuse_port=False, backlog=None,
+                 admission=None):
         '''
         :param TrixyInput tinput: instantiated every time an incoming
           connection is grabbed.
+        :param bool reuse_port: Set SO_REUSEPORT on the listening socket
+          so that several processes can listen on the same host and
+          port, with the kernel balancing connections between them.
+        :param int backlog: Overrides the backlog class attribute.
+        :param trixy.admission.Admission admission: Overrides the
+          admission class attribute.
         '''
         super().__init__()
         self.tinput = tinput
+        self.reuse_port = reuse_port
+        if backlog is not None:
+            self.backlog = backlog
+        if admission is not None:
+            self.admission = admission
         self.setup_socket(host, port)
 
     def setup_socket(self, host, port):
         self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
         self.set_reuse_addr()
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         # self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.bind((host, port))
-        self.listen(100)
+        self.listen(self.backlog)
 
     def handle_accepted(self, sock, addr):
+        if self.admission is None:
+            self.tinput(sock, addr)
+            return
+        # Refuse connections before any work is done for them.
+        client = self.admission.admit(addr)
+        if client is None:
+            sock.close()
+            return
         handler = self.tinput(sock, addr)
+        self.admission.opened(handler, client)
 
     def handle_close(self):
         super().handle_close()
         self.close()
 
 
-class TrixyInput(TrixyNode, asyncore.dispatcher_with_send):
+class TrixyConnection(TrixyNode, asyncore.dispatcher_with_send):
     '''
-    Once a connection is open, establish an output chain.
+    Shared socket handling for TrixyInput and TrixyOutput.
     '''
-    def __init__(self, sock, addr):
+    #: 'down' if data read from this connection travels to downstream
+    #: nodes, 'up' if it travels to upstream nodes. Data sent by this
+    #: connection comes from the nodes in the same direction.
+    read_direction = 'down'
+
+    #: When more than this many bytes are waiting to be sent, the
+    #: connections producing the data are asked to stop reading.
+    high_watermark = 262144
+    #: Once the send buffer has drained to this many bytes, the
+    #: producing connections are asked to start reading again.
+    low_watermark = 65536
+    #: The most reads made for one readable event. The data is passed
+    #: to the chain together, as a batch.
+    max_batch = 16
+    #: The BufferPool to read into, or None to use the default pool.
+    buffer_pool = None
+    #: The size of reads grows up to max_recvsize while each read fills
+    #: the buffer, and shrinks down to min_recvsize after several reads
+    #: in a row that use less than a quarter of it.
+    min_recvsize = 4096
+    max_recvsize = 262144
+    #: The number of small reads in a row that shrink the read size.
+    shrink_after = 4
+    #: Seconds the connection may go without reading or sending before
+    #: it is closed, or None for no limit.
+    idle_timeout = None
+    #: Seconds the connection may stay open, or None for no limit.
+    lifetime_timeout = None
+    #: Seconds a protocol handshake (such as TLS or SOCKS) may take, or
+    #: None for no limit. See start_handshake_timer.
+    handshake_timeout = None
+    #: The TimerWheel for the timeouts, or None to use the default
+    #: wheel. Timeouts only fire while trixy.timers.loop() runs.
+    timer_wheel = None
+    timer_slot = None
+    #: A trixy.admission.TokenBucket charged with every byte read. While
+    #: it is in debt the connection stops reading. Set by the server's
+    #: Admission, or None for no limit.
+    rate_limit = None
+    #: The Admission that accepted the connection, or None.
+    admission = None
+    #: The trixy.admission.Client of the address the connection is from,
+    #: if it was accepted by an Admission.
+    admission_client = None
+
+    def __init__(self, sock=None):
         super().__init__()
         asyncore.dispatcher_with_send.__init__(self, sock)
 
         self.recvsize = 16384
+        #: The number of small reads in a row so far.
+        self.small_reads = 0
+        self.out_buffer = ChunkBuffer()
+
+        #: The number of outstanding handle_pause requests.
+        self.pause_count = 0
+        #: True while this connection has paused its producers.
+        self.producers_paused = False
+        #: True once the connection has been closed.
+        self.closed = False
+
+        #: Pipe for data being spliced into this connection's socket.
+        self.splice_channel = None
+        #: True while data read from this socket waits to be spliced out.
+        self.splice_waiting = False
+        #: Maps a direction to the passthrough peer, for chains whose
+        #: shape is known in advance (see trixy.chain), or None to
+        #: search the chain on every read.
+        self.passthrough_peers = None
+
+        #: When the connection was opened, from time.monotonic().
+        self.opened_at = time.monotonic()
+        #: When data was last read or sent, if idle_timeout is set.
+        self.last_active = self.opened_at
+        #: When a handshake in progress times out, or None.
+        self.handshake_deadline = None
+        #: When reading resumes after exceeding rate_limit, or None.
+        self.throttled_until = None
+        self.schedule_timeout()
+
+        if self.metrics is not None:
+            self.metrics.connection_opened(self)
+
+    def passthrough_peer(self, direction):
+        '''
+        Find the connection at the other end of the chain if data read
+        from this connection can be moved straight to it. That is the
+        case when there is a single path to it and every node on the
+        path, including both ends, is opaque.
+
+        :param str direction: 'down' or 'up'; the direction data read
+          from this connection travels in.
+        :returns: The peer TrixyConnection, or None.
+        '''
+        if not self.opaque:
+            return None
+        if self.passthrough_peers is not None:
+            peer = self.passthrough_peers.get(direction)
+            if peer is not None and peer.connected:
+                return peer
+            return None
+        node = self
+        while True:
+            if direction == 'down':
+                nodes = node.downstream_nodes
+            else:
+                nodes = node.upstream_nodes
+            if len(nodes) != 1:
+                return None
+            node = nodes[0]
+            if not node.opaque:
+                return None
+            if isinstance(node, TrixyConnection):
+                if node.connected:
+                    return node
+                return None
+
+    def passthrough_read(self, direction):
+        '''
+        Move readable data directly to the passthrough peer, if there
+        is one, using splice() or a reused read buffer.
+
+        :param str direction: 'down' or 'up'; see passthrough_peer.
+        :returns: True if the read was handled, False if the data must
+          be passed through the chain instead.
+        '''
+        peer = self.passthrough_peer(direction)
+        if peer is None:
+            return False
+
+        try:
+            if (splice_supported and not peer.out_buffer and
+                    type(self.socket) is socket.socket and
+                    type(peer.socket) is socket.socket):
+                self.splice_to(peer)
+            else:
+                self.copy_to(peer)
+        except ConnectionError:
+            self.handle_close()
+        return True
+
+    def splice_to(self, peer):
+        '''
+        Move data from this connection to `peer` inside the kernel.
+        '''
+        if peer.splice_channel is None:
+            peer.splice_channel = SpliceChannel()
+        channel = peer.splice_channel
+
+        num = channel.fill(self.socket.fileno(), self.recvsize)
+        if num is None:
+            return
+        if num == 0:
+            self.handle_close()
+            return
+        self.mark_active()
+        self.charge_read(num)
+        peer.flush_splice_channel(source=self)
+
+    def flush_splice_channel(self, source=None):
+        '''
+        Write pending spliced data to the socket. While data remains,
+        the connection it came from stops reading.
+
+        :param TrixyConnection source: The connection the data was
+          most recently read from.
+        '''
+        channel = self.splice_channel
+        if source is not None:
+            channel.source = source
+        try:
+            remaining = channel.drain(self.socket.fileno())
+        except ConnectionError:
+            self.handle_close()
+            return
+        self.mark_active()
+        if channel.source is not None:
+            channel.source.splice_waiting = bool(remaining)
+
+    def copy_to(self, peer):
+        '''
+        Receive into a pooled buffer and send straight to `peer`,
+        skipping the nodes in between.
+        '''
+        pool = self.get_buffer_pool()
+        buffer = pool.acquire(self.recvsize)
+        try:
+            self.copy_with(peer, buffer)
+        finally:
+            pool.release(buffer)
+
+    def copy_with(self, peer, buffer):
+        try:
+            num = self.socket.recv_into(buffer)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            if e.errno in DISCONNECTED:
+                raise ConnectionError(e.errno, e.strerror)
+            raise
+        if num == 0:
+            self.handle_close()
+            return
+        self.adapt_recvsize(num)
+        self.mark_active()
+        self.charge_read(num)
+
+        data = memoryview(buffer)[:num]
+        if not peer.out_buffer:
+            try:
+                sent = peer.socket.send(data)
+            except BlockingIOError:
+                sent = 0
+            except OSError as e:
+                if e.errno in DISCONNECTED:
+                    peer.handle_close()
+                    return
+                raise
+            data = data[sent:]
+            peer.mark_active()
+        if data:
+            peer.send(data)
+
+    def producers(self):
+        '''
+        Return the nodes that send data to this connection.
+        '''
+        if self.read_direction == 'down':
+            return self.downstream_nodes
+        return self.upstream_nodes
+
+    def pause_producers(self):
+        self.producers_paused = True
+        for node in self.producers():
+            node.handle_pause(self.read_direction)
+
+    def resume_producers(self):
+        self.producers_paused = False
+        for node in self.producers():
+            node.handle_resume(self.read_direction)
+
+    def handle_pause(self, direction='up'):
+        self.pause_count += 1
+
+    def handle_resume(self, direction='up'):
+        if self.pause_count:
+            self.pause_count -= 1
+
+    def get_timer_wheel(self):
+        if self.timer_wheel is None:
+            return default_wheel
+        return self.timer_wheel
+
+    def mark_active(self):
+        '''
+        Note that data was read or sent, for the idle timeout.
+        '''
+        if self.idle_timeout is not None:
+            self.last_active = time.monotonic()
+
+    def start_handshake_timer(self):
+        '''
+        Start timing a protocol handshake, which handshake_timeout
+        limits. Call stop_handshake_timer once it has finished.
+        '''
+        if self.handshake_timeout is not None:
+            self.handshake_deadline = (time.monotonic() +
+                                       self.handshake_timeout)
+            self.schedule_timeout()
+
+    def stop_handshake_timer(self):
+        self.handshake_deadline = None
+
+    def next_deadline(self):
+        '''
+        Return the earliest time at which a timeout could expire, or
+        None if no timeouts are set.
+        '''
+        deadlines = []
+        if self.handshake_deadline is not None:
+            deadlines.append(self.handshake_deadline)
+        if self.lifetime_timeout is not None:
+            deadlines.append(self.opened_at + self.lifetime_timeout)
+        if self.idle_timeout is not None:
+            deadlines.append(self.last_active + self.idle_timeout)
+        if self.throttled_until is not None:
+            deadlines.append(self.throttled_until)
+        return min(deadlines) if deadlines else None
+
+    def schedule_timeout(self):
+        '''
+        Schedule the connection in its timer wheel for next_deadline.
+        '''
+        deadline = self.next_deadline()
+        if deadline is None:
+            if self.timer_slot is not None:
+                self.get_timer_wheel().cancel(self)
+        else:
+            self.get_timer_wheel().schedule(self, deadline)
+
+    def handle_timer(self):
+        '''
+        Called by the timer wheel once next_deadline has passed. Find
+        out which timeout expired, if any; the idle deadline may have
+        moved since the connection was scheduled.
+        '''
+        if self.closed:
+            return
+        now = time.monotonic()
+        if self.throttled_until is not None and now >= self.throttled_until:
+            self.throttled_until = None
+            self.handle_resume()
+        if (self.handshake_deadline is not None and
+                now >= self.handshake_deadline):
+            self.handshake_deadline = None
+            self.handle_timeout('handshake')
+        elif (self.lifetime_timeout is not None and
+                now >= self.opened_at + self.lifetime_timeout):
+            self.handle_timeout('lifetime')
+        elif (self.idle_timeout is not None and
+                now >= self.last_active + self.idle_timeout):
+            self.handle_timeout('idle')
+        if not self.closed:
+            self.schedule_timeout()
+
+    def poll_timer(self):
+        '''
+        Have the wheel fire the timer if it is overdue because nothing
+        advances the wheel, as under asyncore.loop(). Called every time
+        the loop asks whether the connection is readable.
+
+        :returns: False if the connection has been closed.
+        '''
+        if self.timer_slot is not None:
+            wheel = self.get_timer_wheel()
+            if wheel.overdue(self):
+                wheel.defer(self)
+        if (self.throttled_until is not None and
+                time.monotonic() >= self.throttled_until):
+            # Don't wait for the wheel to resume reading.
+            self.throttled_until = None
+            self.handle_resume()
+            self.schedule_timeout()
+        return not self.closed
+
+    def handle_timeout(self, kind):
+        '''
+        A timeout expired. By default, the connection is closed.
+
+        :param str kind: 'handshake', 'idle', 'lifetime', or 'connect'
+          for outputs.
+        '''
+        self.handle_close()
+
+    def charge_read(self, num):
+        '''
+        Charge `num` bytes read to rate_limit, and stop reading until
+        the limit allows more.
+        '''
+        if self.rate_limit is None:
+            return
+        delay = self.rate_limit.charge(num)
+        if delay and self.throttled_until is None:
+            self.handle_pause()
+            self.throttled_until = time.monotonic() + delay
+            self.schedule_timeout()
+
+    def get_buffer_pool(self):
+        if self.buffer_pool is None:
+            return default_pool
+        return self.buffer_pool
+
+    def adapt_recvsize(self, num):
+        '''
+        Adjust the size of the next read after one that returned `num`
+        bytes. Streams that keep the socket full get larger reads, and
+        so fewer system calls per byte; interactive ones go back to
+        small buffers.
+        '''
+        if num >= self.recvsize:
+            self.small_reads = 0
+            if self.recvsize < self.max_recvsize:
+                self.recvsize *= 2
+        elif num < self.recvsize // 4:
+            self.small_reads += 1
+            if (self.small_reads >= self.shrink_after and
+                    self.recvsize > self.min_recvsize):
+                self.small_reads = 0
+                self.recvsize //= 2
+        else:
+            self.small_reads = 0
+
+    def recv_chunk(self, buffer):
+        '''
+        Read the next chunk of data from the socket into `buffer`.
+
+        :param bytearray buffer: The buffer to read into.
+        :returns: The number of bytes read, 0 at the end of the stream,
+          or None if there is nothing to read right now.
+        '''
+        try:
+            return self.socket.recv_into(buffer)
+        except BlockingIOError:
+            return None
+        except OSError as e:
+            if e.errno in DISCONNECTED:
+                return 0
+            raise
+
+    def read_batch(self, direction):
+        '''
+        Read everything available, up to max_batch reads, and pass it
+        to this connection's batch handler for `direction`. The end of
+        the stream is handled after the data read before it.
+
+        :param str direction: 'down' or 'up'; see read_direction.
+        '''
+        pool = self.get_buffer_pool()
+        buffers = []
+        batch = []
+        end = False
+        try:
+            while len(batch) < self.max_batch:
+                buffer = pool.acquire(self.recvsize)
+                buffers.append(buffer)
+                num = self.recv_chunk(buffer)
+                if num is None:
+                    break
+                if not num:
+                    end = True
+                    break
+                batch.append(memoryview(buffer)[:num])
+                self.adapt_recvsize(num)
+                if num < len(buffer):
+                    break  # Nothing more is waiting.
+            if batch:
+                self.mark_active()
+                self.charge_read(sum(map(len, batch)))
+
+            if batch:
+                if self.metrics is not None:
+                    self.metrics.call_batch(self, direction, batch)
+                elif direction == 'down':
+                    self.handle_batch_down(batch)
+                else:
+                    self.handle_batch_up(batch)
+        finally:
+            for buffer in buffers:
+                pool.release(buffer)
+        if end and not self.closed:
+            self.handle_close()
+
+    def send_batch(self, batch):
+        '''
+        Queue several packets to be sent and try to send them.
+
+        :param list batch: The packets to send.
+        '''
+        out_buffer = self.out_buffer
+        for data in batch:
+            if not out_buffer and self.connected and self.socket is not None:
+                # Send straight from the packet, and only copy what the
+                # socket does not take.
+                data = memoryview(data)
+                data = data[self.send_some(data):]
+            out_buffer.append(data)
+        self.initiate_send()
+
+    def send(self, data):
+        '''
+        Queue data to be sent and try to send it right away.
+
+        :param bytes data: The data to send.
+        '''
+        if self.debug:
+            self.log_info('sending %s' % repr(data))
+        self.out_buffer.append(data)
+        self.initiate_send()
+
+    def send_some(self, data):
+        '''
+        Send as much of `data` as the socket accepts right now.
+
+        :param bytes data: The data to send.
+        :returns: The number of bytes sent.
+        '''
+        sent = asyncore.dispatcher.send(self, data)
+        if sent:
+            self.mark_active()
+        return sent
+
+    def initiate_send(self):
+        if self.out_buffer and self.socket is not None:
+            num_sent = self.send_some(self.out_buffer.peek())
+            self.out_buffer.consume(num_sent)
+        buffered = len(self.out_buffer)
+        if self.producers_paused:
+            if buffered <= self.low_watermark:
+                self.resume_producers()
+        elif buffered > self.high_watermark:
+            self.pause_producers()
+
+    def readable(self):
+        if not self.poll_timer():
+            return False
+        return not (self.splice_waiting or self.pause_count)
+
+    def writable(self):
+        if self.closed:
+            return False
+        if self.splice_channel is not None and self.splice_channel.pending:
+            return True
+        return super().writable()
+
+    def handle_write(self):
+        if self.splice_channel is not None and self.splice_channel.pending:
+            self.flush_splice_channel()
+            return
+        super().handle_write()
+
+    def close(self):
+        if self.metrics is not None and not self.closed:
+            self.metrics.connection_closed(self)
+        if self.admission is not None and not self.closed:
+            self.admission.closed(self)
+        self.closed = True
+        if self.timer_slot is not None:
+            self.get_timer_wheel().cancel(self)
+        if self.splice_channel is not None:
+            self.splice_channel.close()
+            self.splice_channel = None
+        super().close()
+
+
+class TrixyInput(TrixyConnection):
+    '''
+    Once a connection is open, establish an output chain.
+    '''
+    opaque = True
+
+    def __init__(self, sock, addr):
+        super().__init__(sock)
 
     def handle_close(self, direction='down'):
         super().handle_close(direction)
         self.close()
 
     def handle_read(self):
-        data = self.recv(self.recvsize)
-        self.handle_packet_down(data)
+        if self.passthrough_read('down'):
+            return
+        self.read_batch('down')
 
     def handle_packet_up(self, data):
         self.send(data)
 
+    def handle_batch_up(self, batch):
+        self.send_batch(batch)
+
 
 class TrixyProcessor(TrixyNode):
     '''
     Perform processing on data moving through Trixy.
     '''
-    pass
+    opaque = True
 
 
-class TrixyOutput(TrixyNode, asyncore.dispatcher_with_send):
+class TrixyOutput(TrixyConnection):
     '''
     Output the data, generally to another network service.
     '''
+    opaque = True
+    read_direction = 'up'
+
     #: Denotes whether assumed connections are assumed by the class.
     supports_assumed_connections = True
+    #: The trixy.resolver.Resolver used to look up hostnames. (Default:
+    #: trixy.resolver.default_resolver.)
+    resolver = None
+    #: When a connection attempt in progress times out, or None.
+    connect_deadline = None
 
-    def __init__(self, host, port, autoconnect=True):
+    def __init__(self, host, port, autoconnect=True, connect_timeout=None):
         '''
         :param str host: The hostname to connect to.
         :param int port: The port on the host to connect to.
         :param bool autoconnect: Should we automatically connect to the
           host and port when the object is made? (Default: yes.)
+        :param float connect_timeout: The number of seconds to wait for
+          the connection to be established before giving up. (Default:
+          the operating system's limit.)
         '''
         super().__init__()
-        asyncore.dispatcher_with_send.__init__(self)
-
-        self.recvsize = 16384
 
         self.host = host
         self.port = port
+        self.connect_timeout = connect_timeout
+        #: None while connecting, True once connected, or the exception
+        #: that explains why the connection failed.
+        self.connect_result = None
 
         self.setup_socket(host, port, autoconnect)
 
     def setup_socket(self, host, port, autoconnect=True):
         '''
-        Establish the outbound connection.
+        Establish the outbound connection. Hostnames are looked up
+        without blocking the loop; see trixy.resolver.
 
         :param str host: The hostname to connect to.
         :param int port: The port on the host to connect to.
         :param bool autoconnect: Should the connection be established
           now, or should it be manually triggered later?
         '''
-        addr_info = socket.getaddrinfo(host, port)
-        self.create_socket(addr_info[0][0], addr_info[0][1])
         if autoconnect:
             self.connect((host, port))
+        else:
+            self.create_connection_socket(address_family(host))
+
+    def create_connection_socket(self, family):
+        '''
+        Create the socket used for the outbound connection.
+
+        :param int family: The address family of the socket.
+        '''
+        self.create_socket(family, socket.SOCK_STREAM)
+
+    def connect(self, address):
+        '''
+        Start connecting to `address` without blocking. The result is
+        reported to upstream nodes with handle_output_connected or
+        handle_output_failed.
+
+        :param tuple address: The (host, port) to connect to.
+        '''
+        resolver = self.resolver or default_resolver
+        resolver.resolve(address[0], address[1], self.handle_resolved)
+
+    def handle_resolved(self, result):
+        '''
+        The address to connect to has been looked up.
+
+        :param result: A getaddrinfo() result list, or the exception
+          the lookup failed with.
+        '''
+        if self.closed:
+            return
+        if isinstance(result, Exception):
+            self.fail_connect(result)
+            return
+
+        family, socktype, proto, canonname, sockaddr = result[0]
+        if self.socket is not None and self.socket.family != family:
+            self.del_channel()
+            self.socket.close()
+            self.socket = None
+        if self.socket is None:
+            self.create_connection_socket(family)
+
+        if self.connect_timeout:
+            # The kernel limit only bounds the retries of the connection
+            # request; the deadline bounds the attempt as a whole.
+            self.set_user_timeout(self.connect_timeout)
+            self.connect_deadline = time.monotonic() + self.connect_timeout
+            self.schedule_timeout()
+        try:
+            super().connect(sockaddr)
+        except OSError as e:
+            self.fail_connect(e)
+
+    def fail_connect(self, error):
+        '''
+        Report a connection failure, or hold on to it until an upstream
+        node is connected if there is none yet.
+
+        :param Exception error: The reason the connection failed.
+        '''
+        if self.upstream_nodes:
+            self.report_connect_failed(error)
+        else:
+            self.connect_result = error
+
+    def set_user_timeout(self, timeout):
+        '''
+        Limit how long the kernel waits for sent data (or a connection
+        request) to be acknowledged before failing the connection.
+
+        :param float timeout: The limit in seconds, or 0 for the
+          system default.
+        '''
+        if hasattr(socket, 'TCP_USER_TIMEOUT'):
+            self.socket.setsockopt(socket.IPPROTO_TCP,
+                                   socket.TCP_USER_TIMEOUT,
+                                   int(timeout * 1000))
+
+    def next_deadline(self):
+        deadline = super().next_deadline()
+        if self.connect_deadline is not None and (
+                deadline is None or self.connect_deadline < deadline):
+            return self.connect_deadline
+        return deadline
+
+    def handle_timer(self):
+        if (self.connect_deadline is not None and not self.closed and
+                time.monotonic() >= self.connect_deadline):
+            self.connect_deadline = None
+            self.handle_timeout('connect')
+        super().handle_timer()
+
+    def handle_timeout(self, kind):
+        if kind == 'connect':
+            self.report_connect_failed(TimeoutError('connect timed out'))
+            return
+        super().handle_timeout(kind)
+
+    def handle_connect_event(self):
+        self.connect_deadline = None
+        err = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err != 0:
+            self.report_connect_failed(OSError(err, os.strerror(err)))
+            return
+        if self.connect_timeout:
+            # It would otherwise limit unacknowledged data for the rest
+            # of the connection.
+            self.set_user_timeout(0)
+        super().handle_connect_event()
+
+    def handle_connect(self):
+        self.report_connected()
+
+    def report_connected(self):
+        '''
+        Tell upstream nodes that this output is ready to carry data.
+        Outputs that perform a handshake of their own should call this
+        once the handshake has finished.
+        '''
+        self.connect_result = True
+        for node in self.upstream_nodes:
+            node.handle_output_connected(self)
+
+    def report_connect_failed(self, error):
+        '''
+        Tell upstream nodes that this output could not connect, then
+        close it.
+
+        :param Exception error: The reason the connection failed.
+        '''
+        self.connect_result = error
+        for node in self.upstream_nodes:
+            node.handle_output_failed(self, error)
+        self.handle_close()
+
+    def add_upstream_node(self, node):
+        super().add_upstream_node(node)
+        # Report a result that arrived before anything was linked to us.
+        if self.connect_result is True:
+            node.handle_output_connected(self)
+        elif isinstance(self.connect_result, Exception):
+            self.report_connect_failed(self.connect_result)
 
     def assume_connected(self, host, port, sock):
         '''
@@ -245,8 +1159,12 @@ class TrixyOutput(TrixyNode, asyncore.dispatcher_with_send):
         self.close()
 
     def handle_read(self):
-        data = self.recv(self.recvsize)
-        self.handle_packet_up(data)
+        if self.passthrough_read('up'):
+            return
+        self.read_batch('up')
 
     def handle_packet_down(self, data):
         self.send(data)
+
+    def handle_batch_down(self, batch):
+        self.send_batch(batch)
@@ -0,0 +1,203 @@
+'''
+Limit the connections a TrixyServer accepts and how fast clients send.
+
+Without limits, a burst of connections or a single noisy client can
+keep the loop busy enough to hold up everyone else. An Admission
+object decides, as each connection is accepted and before its chain is
+built, whether to take it: it caps the number of connections open at
+once, and how often each client address may connect. It can also give
+each client address a budget of bytes per second, shared by all of its
+connections; a connection that overspends stops reading until the
+budget has refilled.
+
+For example::
+
+   import trixy
+   import trixy.admission
+   import trixy.timers
+
+   admission = trixy.admission.Admission(
+       max_connections=10000, connect_rate=20, byte_rate=1 << 20)
+   trixy.TrixyServer(ExampleInput, '0.0.0.0', 8080, admission=admission)
+   trixy.timers.loop()
+
+A connection that overspends resumes reading from the timer wheel, or
+at the first poll after its budget has refilled. Under a plain
+asyncore.loop(), that can be as late as the loop's timeout, so
+trixy.timers.loop() keeps the limits more accurate.
+'''
+import collections
+import time
+
+
+class TokenBucket():
+    '''
+    A rate limit that allows bursts: tokens are added at `rate` per
+    second, up to `burst`, and each use takes some away.
+    '''
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst=None):
+        '''
+        :param float rate: Tokens added per second.
+        :param float burst: The most tokens held; `rate` if None.
+        '''
+        self.rate = rate
+        self.burst = rate if burst is None else burst
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, amount=1, now=None):
+        '''
+        Take `amount` tokens if there are that many.
+
+        :returns: True if they were taken.
+        '''
+        self.refill(time.monotonic() if now is None else now)
+        if self.tokens < amount:
+            return False
+        self.tokens -= amount
+        return True
+
+    def charge(self, amount, now=None):
+        '''
+        Take `amount` tokens even if that leaves the bucket in debt.
+
+        :returns: The number of seconds until the debt is paid off, or 0.
+        '''
+        self.refill(time.monotonic() if now is None else now)
+        self.tokens -= amount
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+
+class Client():
+    '''
+    The limits for one client address.
+    '''
+    __slots__ = ('connects', 'data', 'connections')
+
+    def __init__(self, connects, data):
+        '''
+        :param TokenBucket connects: Limits connections, or None.
+        :param TokenBucket data: Limits bytes read, or None.
+        '''
+        self.connects = connects
+        self.data = data
+        #: The number of its connections that are open.
+        self.connections = 0
+
+
+class Admission():
+    '''
+    Admission control for a TrixyServer.
+    '''
+
+    def __init__(self, max_connections=None, connect_rate=None,
+                 connect_burst=None, byte_rate=None, byte_burst=None,
+                 max_clients=65536):
+        '''
+        :param int max_connections: The most connections open at once.
+        :param float connect_rate: Connections per second allowed from
+          each client address.
+        :param float connect_burst: Connections allowed from a client
+          address in a burst; `connect_rate` if None.
+        :param float byte_rate: Bytes per second each client address may
+          send, over all of its connections.
+        :param float byte_burst: Bytes a client address may send in a
+          burst; `byte_rate` if None.
+        :param int max_clients: The most client addresses remembered.
+          The least recently seen without open connections is forgotten
+          to make room.
+        '''
+        self.max_connections = max_connections
+        self.connect_rate = connect_rate
+        self.connect_burst = connect_burst
+        self.byte_rate = byte_rate
+        self.byte_burst = byte_burst
+        self.max_clients = max_clients
+
+        #: The number of admitted connections that are still open.
+        self.connections = 0
+        #: The number of connections turned away.
+        self.rejected = 0
+        #: Maps a client address to its Client, least recently seen
+        #: first.
+        self.clients = collections.OrderedDict()
+
+    def client(self, host):
+        '''
+        Return the Client for the address `host`, creating it if needed.
+        '''
+        client = self.clients.get(host)
+        if client is not None:
+            self.clients.move_to_end(host)
+            return client
+        client = Client(
+            TokenBucket(self.connect_rate, self.connect_burst)
+            if self.connect_rate is not None else None,
+            TokenBucket(self.byte_rate, self.byte_burst)
+            if self.byte_rate is not None else None)
+        self.clients[host] = client
+        self.forget()
+        return client
+
+    def forget(self):
+        '''
+        Forget the least recently seen clients, down to max_clients.
+        Clients with open connections are kept, so that their next
+        connection does not get fresh limits; they are moved to the end
+        so that they are not looked at again soon.
+        '''
+        for i in range(len(self.clients) - 1):
+            if len(self.clients) <= self.max_clients:
+                break
+            host, client = next(iter(self.clients.items()))
+            if client.connections:
+                self.clients.move_to_end(host)
+            else:
+                del self.clients[host]
+
+    def admit(self, addr):
+        '''
+        Decide whether to accept a connection from `addr`.
+
+        :param tuple addr: The address of the client.
+        :returns: The Client to apply to the connection, or None if it
+          must be refused.
+        '''
+        if (self.max_connections is not None and
+                self.connections >= self.max_connections):
+            self.rejected += 1
+            return None
+        client = self.client(addr[0])
+        if client.connects is not None and not client.connects.take():
+            self.rejected += 1
+            return None
+        return client
+
+    def opened(self, conn, client):
+        '''
+        Apply the limits to an admitted connection.
+
+        :param trixy.TrixyConnection conn: The connection.
+        :param Client client: The value returned by admit().
+        '''
+        if conn.closed:
+            return  # It closed itself while starting up.
+        self.connections += 1
+        client.connections += 1
+        conn.admission = self
+        conn.admission_client = client
+        if client.data is not None:
+            conn.rate_limit = client.data
+
+    def closed(self, conn):
+        self.connections -= 1
+        conn.admission_client.connections -= 1
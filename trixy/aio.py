@@ -0,0 +1,372 @@
+'''
+The asyncio engine provides counterparts to the TrixyServer,
+TrixyInput, and TrixyOutput classes that run on an asyncio event loop
+instead of asyncore. On Linux the default loop is backed by epoll
+rather than select(), so a single process can carry many thousands of
+proxied connections.
+
+Processors do not need to change to run on this engine. The input and
+output classes here speak the same TrixyNode handle_packet_down and
+handle_packet_up contract, so any chain built from TrixyProcessor
+subclasses can be connected between them exactly as it would be
+between the asyncore classes.
+'''
+import asyncio
+import errno
+import socket
+import weakref
+import trixy
+from trixy.resolver import default_resolver
+
+
+def get_loop(loop=None):
+    '''
+    Return the given event loop, or the loop that is currently running
+    if no loop is given.
+
+    :param asyncio.AbstractEventLoop loop: An optional loop to return.
+    '''
+    if loop is not None:
+        return loop
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.get_event_loop()
+
+
+class AsyncTrixyServer():
+    '''
+    Main server to grab incoming connections and forward them. This
+    is the asyncio version of TrixyServer.
+    '''
+    #: Seconds to stop accepting for when the process or system runs out
+    #: of file descriptors or memory, instead of retrying at once.
+    accept_backoff = 0.1
+
+    def __init__(self, tinput, host, port, reuse_port=False, loop=None):
+        '''
+        :param AsyncTrixyInput tinput: instantiated every time an
+          incoming connection is grabbed.
+        :param bool reuse_port: Set SO_REUSEPORT on the listening socket.
+          See TrixyServer.
+        :param asyncio.AbstractEventLoop loop: The loop that the server
+          should accept connections on. (Default: the current loop.)
+        '''
+        self.loop = get_loop(loop)
+        self.tinput = tinput
+        self.reuse_port = reuse_port
+        self.socket = None
+        #: The inputs created by this server that are still referenced.
+        self.connections = weakref.WeakSet()
+        self.setup_socket(host, port)
+        self.accept_task = self.loop.create_task(self.accept_connections())
+
+    def setup_socket(self, host, port):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.socket.setblocking(False)
+        self.socket.bind((host, port))
+        self.socket.listen(100)
+
+    async def accept_connections(self):
+        '''
+        Accept connections until the server is closed, passing each of
+        them to handle_accepted.
+        '''
+        while self.socket is not None:
+            try:
+                sock, addr = await self.loop.sock_accept(self.socket)
+            except OSError as e:
+                if e.errno in (errno.EMFILE, errno.ENFILE, errno.ENOBUFS,
+                               errno.ENOMEM):
+                    # The connection stays queued; retrying straight away
+                    # would only spin until descriptors are freed.
+                    await asyncio.sleep(self.accept_backoff)
+                continue
+            self.handle_accepted(sock, addr)
+
+    def handle_accepted(self, sock, addr):
+        handler = self.tinput(sock, addr, loop=self.loop)
+        self.connections.add(handler)
+
+    def close(self):
+        '''
+        Stop accepting connections. Connections which have already been
+        accepted are left open.
+        '''
+        if self.socket is None:
+            return
+        self.accept_task.cancel()
+        self.socket.close()
+        self.socket = None
+
+
+class AsyncTrixyConnection(trixy.TrixyNode, asyncio.Protocol):
+    '''
+    Shared transport handling for AsyncTrixyInput and AsyncTrixyOutput.
+
+    Data sent before the transport is ready is held until the
+    connection is made, which mirrors the way dispatcher_with_send
+    buffers data for a socket that has not connected yet.
+    '''
+    #: See TrixyConnection.read_direction.
+    read_direction = 'down'
+
+    #: See TrixyConnection.high_watermark.
+    high_watermark = 262144
+    #: See TrixyConnection.low_watermark.
+    low_watermark = 65536
+
+    def __init__(self, loop=None):
+        super().__init__()
+        self.loop = get_loop(loop)
+        self.transport = None
+        self.connect_task = None
+        self.pending = []
+        self.closed = False
+        self.pause_count = 0
+
+    def attach_socket(self, sock):
+        '''
+        Start driving an already connected socket with this protocol.
+
+        :param socket.socket sock: The connected socket.
+        '''
+        self.connect_task = self.loop.create_task(
+            self.loop.connect_accepted_socket(lambda: self, sock))
+        self.connect_task.add_done_callback(self.handle_connect_result)
+
+    def handle_connect_result(self, task):
+        '''
+        Close the node if the transport could not be created.
+        '''
+        if task.cancelled() or task.exception() is not None:
+            if not self.closed:
+                self.handle_close()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self.closed:
+            transport.close()
+            return
+        transport.set_write_buffer_limits(high=self.high_watermark,
+                                          low=self.low_watermark)
+        if self.pause_count:
+            transport.pause_reading()
+        if self.pending:
+            transport.writelines(self.pending)
+            self.pending = []
+        self.handle_connect()
+
+    def connection_lost(self, exc):
+        if not self.closed:
+            self.handle_close()
+
+    def handle_connect(self):
+        '''
+        Called once the connection has been established.
+        '''
+        pass
+
+    def producers(self):
+        '''
+        Return the nodes that send data to this connection.
+        '''
+        if self.read_direction == 'down':
+            return self.downstream_nodes
+        return self.upstream_nodes
+
+    def pause_writing(self):
+        for node in self.producers():
+            node.handle_pause(self.read_direction)
+
+    def resume_writing(self):
+        for node in self.producers():
+            node.handle_resume(self.read_direction)
+
+    def handle_pause(self, direction='up'):
+        self.pause_count += 1
+        if self.pause_count == 1 and self.transport is not None:
+            self.transport.pause_reading()
+
+    def handle_resume(self, direction='up'):
+        if not self.pause_count:
+            return
+        self.pause_count -= 1
+        if not self.pause_count and self.transport is not None:
+            self.transport.resume_reading()
+
+    def send(self, data):
+        '''
+        Queue data to be written to the connection.
+
+        :param bytes data: The data to send.
+        '''
+        if self.closed:
+            return
+        if self.transport is None:
+            self.pending.append(bytes(data))
+        else:
+            self.transport.write(data)
+
+    def close(self):
+        '''
+        Close the connection once any queued data has been written.
+        '''
+        if self.closed:
+            return
+        self.closed = True
+        self.pending = []
+        if self.transport is not None:
+            self.transport.close()
+        elif self.connect_task is not None:
+            self.connect_task.cancel()
+
+
+class AsyncTrixyInput(AsyncTrixyConnection):
+    '''
+    Once a connection is open, establish an output chain. This is the
+    asyncio version of TrixyInput.
+    '''
+
+    def __init__(self, sock, addr, loop=None):
+        super().__init__(loop)
+        self.addr = addr
+        self.attach_socket(sock)
+
+    def handle_close(self, direction='down'):
+        super().handle_close(direction)
+        self.close()
+
+    def data_received(self, data):
+        self.handle_packet_down(data)
+
+    def handle_packet_up(self, data):
+        self.send(data)
+
+
+class AsyncTrixyOutput(AsyncTrixyConnection):
+    '''
+    Output the data, generally to another network service. This is the
+    asyncio version of TrixyOutput.
+    '''
+    #: Denotes whether assumed connections are assumed by the class.
+    supports_assumed_connections = True
+    read_direction = 'up'
+    #: The trixy.resolver.Resolver used to look up hostnames. (Default:
+    #: trixy.resolver.default_resolver.)
+    resolver = None
+
+    def __init__(self, host, port, autoconnect=True, connect_timeout=None,
+                 loop=None):
+        '''
+        :param str host: The hostname to connect to.
+        :param int port: The port on the host to connect to.
+        :param bool autoconnect: Should we automatically connect to the
+          host and port when the object is made? (Default: yes.)
+        :param float connect_timeout: The number of seconds to wait for
+          the connection to be established before giving up.
+        :param asyncio.AbstractEventLoop loop: The loop that the output
+          should run on. (Default: the current loop.)
+        '''
+        super().__init__(loop)
+
+        self.host = host
+        self.port = port
+        self.connect_timeout = connect_timeout
+        #: None while connecting, True once connected, or the exception
+        #: that explains why the connection failed.
+        self.connect_result = None
+
+        self.setup_socket(host, port, autoconnect)
+
+    def setup_socket(self, host, port, autoconnect=True):
+        '''
+        Establish the outbound connection. Hostnames are looked up
+        without blocking the loop; see trixy.resolver.
+
+        :param str host: The hostname to connect to.
+        :param int port: The port on the host to connect to.
+        :param bool autoconnect: Should the connection be established
+          now, or should it be manually triggered later?
+        '''
+        if autoconnect:
+            self.connect((host, port))
+
+    def connect(self, address):
+        '''
+        Start connecting to the given address.
+
+        :param tuple address: A (host, port) tuple.
+        '''
+        self.connect_task = self.loop.create_task(asyncio.wait_for(
+            self.open_connection(address), self.connect_timeout))
+        self.connect_task.add_done_callback(self.handle_connect_result)
+
+    async def open_connection(self, address):
+        '''
+        Look up and connect to `address`.
+
+        :param tuple address: A (host, port) tuple.
+        '''
+        resolver = self.resolver or default_resolver
+        addr_info = await resolver.resolve_async(*address)
+        family, socktype, proto, canonname, sockaddr = addr_info[0]
+        await self.loop.create_connection(lambda: self, sockaddr[0],
+                                          sockaddr[1], family=family)
+
+    def handle_connect_result(self, task):
+        if task.cancelled():
+            error = ConnectionAbortedError('Connection attempt cancelled')
+        else:
+            error = task.exception()
+        if error is not None and not self.closed:
+            self.report_connect_failed(error)
+
+    def handle_connect(self):
+        self.report_connected()
+
+    def report_connected(self):
+        '''
+        Tell upstream nodes that this output is ready to carry data.
+        See TrixyOutput.report_connected.
+        '''
+        self.connect_result = True
+        for node in self.upstream_nodes:
+            node.handle_output_connected(self)
+
+    def report_connect_failed(self, error):
+        '''
+        Tell upstream nodes that this output could not connect, then
+        close it.
+
+        :param Exception error: The reason the connection failed.
+        '''
+        self.connect_result = error
+        for node in self.upstream_nodes:
+            node.handle_output_failed(self, error)
+        self.handle_close()
+
+    def assume_connected(self, host, port, sock):
+        '''
+        Assume that the connection has already been made. Setup all
+        state accordingly. See TrixyOutput.assume_connected.
+        '''
+        if not self.supports_assumed_connections:
+            raise NotImplementedError('No support for assumed connections')
+
+        self.host = host
+        self.port = port
+        self.attach_socket(sock)
+
+    def handle_close(self, direction='up'):
+        super().handle_close(direction)
+        self.close()
+
+    def data_received(self, data):
+        self.handle_packet_up(data)
+
+    def handle_packet_down(self, data):
+        self.send(data)
@@ -0,0 +1,201 @@
+'''
+Buffers for data waiting to be sent or processed.
+
+Growing a bytes object with `+=` and slicing sent data off the front
+of it copies the whole backlog every time, so the cost of buffering
+grows with the square of its size. ChunkBuffer keeps the data as a
+queue of chunks instead and hands out memoryviews of the front chunk,
+so appending and consuming data costs the same per byte no matter how
+large the backlog is.
+
+Reads work the other way around: a BufferPool lends out bytearrays to
+receive into and takes them back once the data has been handled, so
+reading does not allocate a new object every time.
+'''
+import collections
+
+
+def as_bytes(data):
+    '''
+    Return `data` as a bytes object, without copying it if it is one
+    already or is a memoryview of all of one.
+
+    :param data: A bytes-like object.
+    '''
+    if type(data) is bytes:
+        return data
+    if (type(data) is memoryview and type(data.obj) is bytes and
+            data.nbytes == len(data.obj)):
+        return data.obj
+    return bytes(data)
+
+
+class ChunkBuffer():
+    '''
+    A first-in, first-out byte buffer stored as a queue of chunks.
+    '''
+    __slots__ = ('chunks', 'offset', 'size')
+
+    #: Front chunks smaller than this are merged with the chunks behind
+    #: them by peek(), so that many tiny writes do not turn into many
+    #: tiny send() calls.
+    coalesce_size = 4096
+
+    def __init__(self, data=b''):
+        '''
+        :param bytes data: Optional data to start the buffer with.
+        '''
+        self.chunks = collections.deque()
+        #: The number of bytes of the front chunk already consumed.
+        self.offset = 0
+        #: The number of unconsumed bytes in the buffer.
+        self.size = 0
+        if data:
+            self.append(data)
+
+    def __len__(self):
+        return self.size
+
+    def __bool__(self):
+        return self.size > 0
+
+    def append(self, data):
+        '''
+        Add data to the end of the buffer. Memoryviews of bytes objects
+        are kept without copying them. Mutable objects such as
+        bytearrays, and memoryviews of them, are copied because their
+        contents could change before the data is consumed.
+
+        :param bytes data: The data to add.
+        '''
+        if not data:
+            return
+        if type(data) is not bytes and not (
+                type(data) is memoryview and type(data.obj) is bytes):
+            data = as_bytes(data)
+        self.chunks.append(data)
+        self.size += len(data)
+
+    def peek(self, maxsize=65536):
+        '''
+        Return a memoryview of up to `maxsize` bytes from the front of
+        the buffer without consuming them.
+
+        :param int maxsize: The maximum number of bytes to return.
+        '''
+        if not self.size:
+            return memoryview(b'')
+        chunks = self.chunks
+        first = chunks[0]
+        total = len(first) - self.offset
+        if (total < self.coalesce_size and len(chunks) > 1 and
+                total + len(chunks[1]) <= self.coalesce_size):
+            # Merge small chunks at the front into a single chunk.
+            parts = [first[self.offset:]]
+            chunks.popleft()
+            while chunks and total + len(chunks[0]) <= self.coalesce_size:
+                chunk = chunks.popleft()
+                parts.append(chunk)
+                total += len(chunk)
+            first = b''.join(parts)
+            chunks.appendleft(first)
+            self.offset = 0
+        return memoryview(first)[self.offset:self.offset + maxsize]
+
+    def consume(self, size):
+        '''
+        Remove `size` bytes from the front of the buffer.
+
+        :param int size: The number of bytes to remove.
+        '''
+        size = min(size, self.size)
+        self.size -= size
+        chunks = self.chunks
+        while size:
+            remaining = len(chunks[0]) - self.offset
+            if size < remaining:
+                self.offset += size
+                return
+            chunks.popleft()
+            self.offset = 0
+            size -= remaining
+
+    def read(self, size=-1):
+        '''
+        Remove and return up to `size` bytes from the front of the
+        buffer, or everything if `size` is negative.
+
+        :param int size: The number of bytes to read.
+        '''
+        if size < 0 or size > self.size:
+            size = self.size
+        data = self.getvalue(size)
+        self.consume(size)
+        return data
+
+    def getvalue(self, size=-1):
+        '''
+        Return up to `size` bytes from the front of the buffer (or all
+        of it) as a bytes object without consuming them.
+
+        :param int size: The number of bytes to return.
+        '''
+        if size < 0 or size > self.size:
+            size = self.size
+        parts = []
+        offset = self.offset
+        for chunk in self.chunks:
+            if not size:
+                break
+            part = chunk[offset:offset + size]
+            offset = 0
+            parts.append(part)
+            size -= len(part)
+        return b''.join(parts)
+
+    def clear(self):
+        self.chunks.clear()
+        self.offset = 0
+        self.size = 0
+
+
+class BufferPool():
+    '''
+    Bytearrays to receive data into, kept for reuse between reads. The
+    pool is only used from the thread running the event loop.
+    '''
+    __slots__ = ('free', 'max_free')
+
+    def __init__(self, max_free=16):
+        '''
+        :param int max_free: The most unused buffers kept of each size.
+        '''
+        #: Maps a size to the unused buffers of that size.
+        self.free = {}
+        self.max_free = max_free
+
+    def acquire(self, size):
+        '''
+        Return a bytearray of `size` bytes. Its contents are undefined.
+
+        :param int size: The size of the buffer.
+        '''
+        free = self.free.get(size)
+        if free:
+            return free.pop()
+        return bytearray(size)
+
+    def release(self, buffer):
+        '''
+        Give back a buffer returned by acquire(). Nothing may use it, or
+        a memoryview of it, afterwards.
+
+        :param bytearray buffer: The buffer.
+        '''
+        free = self.free.setdefault(len(buffer), [])
+        if len(free) < self.max_free:
+            free.append(buffer)
+
+
+#: The pool used by connections that do not set their own.
+default_pool = BufferPool()
@@ -0,0 +1,434 @@
+'''
+Record the traffic passing through a chain to files.
+
+Writing to a file from a processor's handlers makes the loop wait for
+the disk, and every connection waits with it. A CaptureWriter instead
+takes each record, a timestamp, connection id, kind and data, into a
+list in memory, and a background thread writes them out in large
+buffered writes. When the thread falls behind by more than
+`max_queued` bytes, new records are dropped and counted rather than
+making the loop wait.
+
+Add a CaptureProcessor to each chain to record the data moving through
+it, in both directions::
+
+   import trixy.capture
+
+   writer = trixy.capture.CaptureWriter('traffic.pcapng',
+                                        format=trixy.capture.PCAPNG)
+
+   class ExampleInput(trixy.TrixyInput):
+       def __init__(self, sock, addr):
+           super().__init__(sock, addr)
+           capture = trixy.capture.CaptureProcessor(writer)
+           self.connect_node(capture)
+           capture.connect_node(trixy.TrixyOutput('127.0.0.1', 8000))
+
+A CaptureProcessor with nothing downstream of it only records, so it
+can also be used as a mirror of a trixy.tee.TeeProcessor.
+
+Two formats are written. LOG files start with LOG_MAGIC and hold
+records made of a RECORD header followed by the data; read_log() reads
+them back. PCAPNG files can be opened in Wireshark: each connection
+appears as a TCP connection from a 10.0.0.0/8 address, made up from
+its id, to `server_address`, with data moving down the chain sent by
+the client.
+
+Call CaptureWriter.close() to write out the last records before the
+program exits. If the thread fails, for example because the disk is
+full, the writer stops taking records, and record() and close() raise
+CaptureError. A CaptureProcessor then stops recording its connection
+but keeps forwarding and closing it, so a failed capture never breaks
+the traffic it was recording; close() still raises.
+'''
+import collections
+import itertools
+import os
+import socket
+import struct
+import threading
+import time
+import trixy
+from trixy.buffers import as_bytes
+
+
+#: The format of a length-prefixed log.
+LOG = 'log'
+#: The pcapng format read by Wireshark and tcpdump.
+PCAPNG = 'pcapng'
+
+#: A connection was opened. Its data is empty.
+OPEN = 0
+#: Data moving down the chain, from the client.
+DOWN = 1
+#: Data moving up the chain, from the server.
+UP = 2
+#: The connection was closed. Its data is empty.
+CLOSE = 3
+
+#: The bytes at the start of a LOG file.
+LOG_MAGIC = b'TRIXYCAP'
+#: The header of each LOG record: the time.time() of the record, the
+#: connection id, the kind and the length of the data that follows.
+RECORD = struct.Struct('!dIBI')
+
+Record = collections.namedtuple(
+    'Record', ('timestamp', 'conn_id', 'kind', 'data'))
+
+# The pcapng blocks used: a section header, the description of a single
+# interface carrying raw IP packets, and an enhanced packet block.
+SECTION_HEADER = struct.pack('<IIIHHqI', 0x0A0D0D0A, 28, 0x1A2B3C4D,
+                             1, 0, -1, 28)
+INTERFACE = struct.pack('<IIHHII', 1, 20, 101, 0, 0, 20)
+PACKET = struct.Struct('<IIIIIII')
+IPV4 = struct.Struct('!BBHHHBBH4s4s')
+TCP = struct.Struct('!HHIIBBHHH')
+TCP_FIN, TCP_SYN, TCP_PSH, TCP_ACK = 0x01, 0x02, 0x08, 0x10
+#: The most data in one made up TCP segment.
+MAX_SEGMENT = 65535 - IPV4.size - TCP.size
+
+
+class CaptureError(Exception):
+    '''
+    The writer thread failed, and records can no longer be written.
+    '''
+    pass
+
+
+def read_log(path):
+    '''
+    Read the records of a LOG file.
+
+    :param str path: The file.
+    :returns: An iterator of Record tuples.
+    '''
+    with open(path, 'rb') as f:
+        if f.read(len(LOG_MAGIC)) != LOG_MAGIC:
+            raise ValueError('not a capture log: %s' % path)
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            timestamp, conn_id, kind, length = RECORD.unpack(header)
+            yield Record(timestamp, conn_id, kind, f.read(length))
+
+
+def ip_checksum(header):
+    total = sum(struct.unpack('!%iH' % (len(header) // 2), header))
+    while total >> 16:
+        total = (total & 0xFFFF) + (total >> 16)
+    return ~total & 0xFFFF
+
+
+class CaptureWriter():
+    '''
+    Write capture records to files from a background thread.
+    '''
+    #: The address made up connections are to in PCAPNG files.
+    server_address = ('192.0.2.1', 80)
+
+    def __init__(self, path, format=LOG, max_size=None, max_files=None,
+                 max_queued=64 << 20, buffer_size=1 << 20):
+        '''
+        :param str path: The file to write. When files are rotated, a
+          number is added before its extension: traffic.pcapng becomes
+          traffic.0.pcapng, traffic.1.pcapng and so on.
+        :param str format: LOG or PCAPNG.
+        :param int max_size: Start a new file once the current one would
+          grow past this many bytes, or None to never rotate.
+        :param int max_files: The most rotated files kept; the oldest is
+          deleted to make room. None keeps all of them.
+        :param int max_queued: The most bytes of data waiting to be
+          written before new records are dropped.
+        :param int buffer_size: The size of the file's write buffer.
+        '''
+        if format not in (LOG, PCAPNG):
+            raise ValueError('unknown capture format: %r' % format)
+        self.path = path
+        self.format = format
+        self.max_size = max_size
+        self.max_files = max_files
+        self.max_queued = max_queued
+        self.buffer_size = buffer_size
+
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        self.pending = []
+        #: The number of bytes of data waiting to be written.
+        self.queued = 0
+        #: The number of records dropped because the queue was full.
+        self.dropped = 0
+        self.closed = False
+        self.thread = None
+        #: The exception that stopped the writer thread, or None.
+        self.error = None
+        #: The number of connections that stopped recording because the
+        #: thread failed.
+        self.abandoned = 0
+
+        # Used only by the writer thread.
+        self.file = None
+        self.file_size = 0
+        #: The files written so far, oldest first.
+        self.files = []
+        self.sequence = 0
+        self.tcp = {}
+
+    def new_id(self):
+        '''
+        Return an id for a new connection.
+        '''
+        return next(self.ids)
+
+    def record(self, conn_id, kind, data=b'', timestamp=None):
+        '''
+        Queue a record to be written. Called on the loop thread.
+
+        :param int conn_id: The connection, from new_id().
+        :param int kind: OPEN, DOWN, UP or CLOSE.
+        :param bytes data: The data, which must not be changed later.
+        :param float timestamp: The time.time() of the record; now if
+          None.
+        :raises CaptureError: If the writer thread failed.
+        '''
+        if timestamp is None:
+            timestamp = time.time()
+        with self.lock:
+            self.check()
+            if self.closed:
+                return
+            if data and self.queued + len(data) > self.max_queued:
+                self.dropped += 1
+                return
+            self.pending.append((timestamp, conn_id, kind, data))
+            self.queued += len(data)
+            if len(self.pending) == 1:
+                self.ready.notify()
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self.run, name='trixy-capture', daemon=True)
+                self.thread.start()
+
+    def close(self):
+        '''
+        Write the queued records, then close the file. Records queued
+        after this are ignored.
+
+        :raises CaptureError: If the writer thread failed.
+        '''
+        with self.lock:
+            self.closed = True
+            self.ready.notify()
+            thread = self.thread
+        if thread is not None:
+            thread.join()
+        if self.file is not None:
+            file, self.file = self.file, None
+            try:
+                file.close()
+            except OSError:
+                if self.error is None:
+                    raise
+        self.check()
+
+    def check(self):
+        if self.error is not None:
+            raise CaptureError('capture writer failed: %s' %
+                               self.error) from self.error
+
+    def run(self):
+        try:
+            while True:
+                with self.lock:
+                    while not self.pending and not self.closed:
+                        self.ready.wait()
+                    records = self.pending
+                    self.pending = []
+                    if not records:
+                        return
+                size = 0
+                for record in records:
+                    self.write(record)
+                    size += len(record[3])
+                with self.lock:
+                    self.queued -= size
+                    idle = not self.pending
+                if idle:
+                    self.file.flush()
+        except BaseException as e:
+            with self.lock:
+                self.error = e
+                # Nothing is left to write these.
+                self.pending = []
+                self.queued = 0
+
+    def write(self, record):
+        if self.format == LOG:
+            timestamp, conn_id, kind, data = record
+            chunks = (RECORD.pack(timestamp, conn_id, kind, len(data)), data)
+        else:
+            chunks = self.packets(*record)
+        size = sum(len(chunk) for chunk in chunks)
+        if self.file is None or (
+                self.max_size is not None and
+                self.file_size + size > self.max_size and
+                self.file_size > self.header_size()):
+            self.rotate()
+        for chunk in chunks:
+            self.file.write(chunk)
+        self.file_size += size
+
+    def header_size(self):
+        if self.format == LOG:
+            return len(LOG_MAGIC)
+        return len(SECTION_HEADER) + len(INTERFACE)
+
+    def rotate(self):
+        if self.file is not None:
+            self.file.close()
+        if self.max_size is None:
+            path = self.path
+        else:
+            base, ext = os.path.splitext(self.path)
+            path = '%s.%i%s' % (base, self.sequence, ext)
+            self.sequence += 1
+        self.files.append(path)
+        if self.max_files is not None:
+            while len(self.files) > self.max_files:
+                try:
+                    os.remove(self.files.pop(0))
+                except OSError:
+                    pass
+        self.file = open(path, 'wb', buffering=self.buffer_size)
+        if self.format == LOG:
+            self.file.write(LOG_MAGIC)
+        else:
+            self.file.write(SECTION_HEADER)
+            self.file.write(INTERFACE)
+        self.file_size = self.header_size()
+
+    def packets(self, timestamp, conn_id, kind, data):
+        '''
+        Return the pcapng blocks for a record, as a list of bytes.
+        '''
+        state = self.tcp.get(conn_id)
+        if state is None:
+            # The client's and the server's next sequence numbers.
+            state = self.tcp[conn_id] = [0, 0]
+            if kind != OPEN:
+                state[:] = [1, 1]
+        blocks = []
+        if kind == OPEN:
+            blocks.append(self.segment(timestamp, conn_id, True, state,
+                                       TCP_SYN, b''))
+            blocks.append(self.segment(timestamp, conn_id, False, state,
+                                       TCP_SYN | TCP_ACK, b''))
+        elif kind == CLOSE:
+            blocks.append(self.segment(timestamp, conn_id, True, state,
+                                       TCP_FIN | TCP_ACK, b''))
+            blocks.append(self.segment(timestamp, conn_id, False, state,
+                                       TCP_FIN | TCP_ACK, b''))
+            del self.tcp[conn_id]
+        else:
+            view = memoryview(data)
+            for start in range(0, len(view), MAX_SEGMENT):
+                blocks.append(self.segment(
+                    timestamp, conn_id, kind == DOWN, state,
+                    TCP_PSH | TCP_ACK, view[start:start + MAX_SEGMENT]))
+        return blocks
+
+    def segment(self, timestamp, conn_id, from_client, state, flags,
+                payload):
+        client = (10, conn_id >> 16 & 0xFF, conn_id >> 8 & 0xFF,
+                  conn_id & 0xFF)
+        client = (bytes(client), 49152)
+        server = (socket.inet_aton(self.server_address[0]),
+                  self.server_address[1])
+        if from_client:
+            src, dst, seq, ack = client, server, state[0], state[1]
+        else:
+            src, dst, seq, ack = server, client, state[1], state[0]
+        if not flags & TCP_ACK:
+            ack = 0
+        length = len(payload) + (1 if flags & (TCP_SYN | TCP_FIN) else 0)
+        state[0 if from_client else 1] = (seq + length) & 0xFFFFFFFF
+
+        total = IPV4.size + TCP.size + len(payload)
+        ip = IPV4.pack(0x45, 0, total, 0, 0x4000, 64, socket.IPPROTO_TCP,
+                       0, src[0], dst[0])
+        ip = ip[:10] + struct.pack('!H', ip_checksum(ip)) + ip[12:]
+        tcp = TCP.pack(src[1], dst[1], seq, ack, 5 << 4, flags, 65535,
+                       0, 0)
+
+        padding = -total % 4
+        block_size = PACKET.size + total + padding + 4
+        usec = int(timestamp * 1000000)
+        return b''.join((
+            PACKET.pack(6, block_size, 0, usec >> 32, usec & 0xFFFFFFFF,
+                        total, total),
+            ip, tcp, payload, b'\x00' * padding,
+            struct.pack('<I', block_size)))
+
+
+class CaptureProcessor(trixy.TrixyProcessor):
+    '''
+    Record the data moving through a chain, in both directions, with a
+    CaptureWriter, and forward it unchanged.
+    '''
+
+    def __init__(self, writer):
+        '''
+        :param CaptureWriter writer: The writer to record with.
+        '''
+        super().__init__()
+        self.writer = writer
+        #: The id of the connection in the capture.
+        self.conn_id = writer.new_id()
+        #: False once the writer failed and this connection stopped
+        #: being recorded.
+        self.recording = True
+        self.recorded_close = False
+        self.record(OPEN)
+
+    def record(self, kind, data=b''):
+        if not self.recording:
+            return
+        try:
+            self.writer.record(self.conn_id, kind, data)
+        except CaptureError:
+            # Never let the capture stop the traffic; the error is
+            # raised again by CaptureWriter.close().
+            self.recording = False
+            self.writer.abandoned += 1
+
+    def capture(self, kind, batch):
+        if not self.recording:
+            return
+        # Copy the data; the batch's memory is reused after this call.
+        if len(batch) == 1:
+            data = as_bytes(batch[0])
+        else:
+            data = b''.join(batch)
+        if data:
+            self.record(kind, data)
+
+    def handle_packet_down(self, data):
+        self.handle_batch_down((data,))
+
+    def handle_packet_up(self, data):
+        self.handle_batch_up((data,))
+
+    def handle_batch_down(self, batch):
+        self.capture(DOWN, batch)
+        self.forward_batch_down(batch)
+
+    def handle_batch_up(self, batch):
+        self.capture(UP, batch)
+        self.forward_batch_up(batch)
+
+    def handle_close(self, direction='down'):
+        if not self.recorded_close:
+            self.recorded_close = True
+            self.record(CLOSE)
+        super().handle_close(direction)
@@ -0,0 +1,148 @@
+'''
+Describe a chain once and build it for every connection.
+
+Inputs usually build their chain in __init__, creating and linking
+each node one at a time, and data read by a connection is passed
+through the chain by walking each node's list of neighbours. A
+ChainTemplate checks the shape of the chain once, when it is made, and
+then builds and links the nodes for each connection the same way a
+hand-built chain is linked. On top of that:
+
+* The node classes are checked to fit together, so mistakes show up
+  at startup rather than on the first connection.
+* Processors that do nothing but pass everything along are left out of
+  the built chain entirely.
+* If every node is opaque, the two ends of the chain are told about
+  each other, so reads do not need to walk the chain to find out where
+  their data can be moved to.
+
+For example::
+
+   import functools
+   import trixy
+   import trixy.chain
+
+   class ExampleInput(trixy.chain.TemplateInput):
+       template = trixy.chain.ChainTemplate(
+           ExampleProcessor,
+           functools.partial(trixy.TrixyOutput, '127.0.0.1', 9999))
+
+   trixy.TrixyServer(ExampleInput, '0.0.0.0', 8080)
+
+Chains built from a template are not searched again, so nodes must not
+be linked to them or removed from them afterwards. A template does not
+change how data moves through a chain that is not opaque: each packet
+is still passed from node to node by walking its neighbours, and each
+connection still creates its own nodes.
+'''
+import functools
+import trixy
+
+
+#: The TrixyNode methods a processor must not override to be left out
+#: of a built chain.
+NODE_METHODS = ('__init__', 'handle_packet_down', 'handle_packet_up',
+                'handle_batch_down', 'handle_batch_up', 'handle_each_down',
+                'handle_each_up', 'forward_packet_down', 'forward_packet_up',
+                'forward_batch_down', 'forward_batch_up', 'handle_close',
+                'handle_output_connected', 'handle_output_failed',
+                'handle_pause', 'handle_resume', 'add_downstream_node',
+                'add_upstream_node', 'connect_node')
+
+
+def node_class(factory):
+    '''
+    Return the class `factory` creates, if it can be told without
+    calling it, or None.
+    '''
+    while isinstance(factory, functools.partial):
+        factory = factory.func
+    if isinstance(factory, type):
+        return factory
+    return None
+
+
+def is_wire(factory):
+    '''
+    Return True if the nodes `factory` creates only pass everything
+    along unchanged, so leaving them out changes nothing.
+    '''
+    if not isinstance(factory, type):
+        return False  # It might be given arguments that matter.
+    if not issubclass(factory, trixy.TrixyProcessor) or not factory.opaque:
+        return False
+    return all(getattr(factory, name) is getattr(trixy.TrixyProcessor, name)
+               for name in NODE_METHODS)
+
+
+class ChainTemplate():
+    '''
+    A linear chain of nodes, from the node after the input to the
+    output, that can be built for any number of inputs.
+    '''
+
+    def __init__(self, *factories):
+        '''
+        :param factories: In order, a callable for each node after the
+          input, each returning a new node when called without
+          arguments. Node classes and functools.partial objects made
+          from them both work. The last must create the output.
+        :raises TypeError: If the chain cannot be built.
+        '''
+        if not factories:
+            raise TypeError('A chain needs at least an output')
+        for factory in factories:
+            if not callable(factory):
+                raise TypeError('%r cannot create a node' % (factory,))
+            cls = node_class(factory)
+            if cls is not None and not issubclass(cls, trixy.TrixyNode):
+                raise TypeError('%r is not a TrixyNode' % (cls,))
+        output_class = node_class(factories[-1])
+        if output_class is not None and not issubclass(
+                output_class, trixy.TrixyOutput):
+            raise TypeError('The chain must end with a TrixyOutput')
+
+        #: The factories of the nodes that are built for each input.
+        self.factories = tuple(f for f in factories[:-1] if not is_wire(f))
+        self.factories += (factories[-1],)
+
+        #: True if every node is known to be opaque, so data can move
+        #: between the ends of the chain without passing through it.
+        self.opaque = True
+        for factory in self.factories:
+            cls = node_class(factory)
+            if cls is None or not cls.opaque:
+                self.opaque = False
+
+    def build(self, tinput):
+        '''
+        Create the nodes for `tinput` and link them to it.
+
+        :param trixy.TrixyInput tinput: The input at the top of the
+          chain.
+        :returns: The list of created nodes, ending with the output.
+        '''
+        nodes = [factory() for factory in self.factories]
+        previous = tinput
+        for node in nodes:
+            previous.connect_node(node)
+            previous = node
+
+        output = nodes[-1]
+        if self.opaque and tinput.opaque:
+            tinput.passthrough_peers = {'down': output}
+            output.passthrough_peers = {'up': tinput}
+        return nodes
+
+
+class TemplateInput(trixy.TrixyInput):
+    '''
+    A TrixyInput that builds its chain from the `template` class
+    attribute.
+    '''
+    #: The ChainTemplate to build for each connection.
+    template = None
+
+    def __init__(self, sock, addr):
+        super().__init__(sock, addr)
+        self.template.build(self)
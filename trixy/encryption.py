@@ -1,29 +1,360 @@
+'''
+Inputs and outputs that speak SSL/TLS.
+
+Building an SSLContext (and loading its certificates) is expensive, and
+a TLS session can only be resumed by a connection that uses the same
+context as the connection that established it. Contexts are therefore
+built once by a ContextRegistry and shared by every connection with the
+same settings. The registry also remembers the sessions that outputs
+established with each upstream host, so that later connections to the
+same host can resume them with an abbreviated handshake. Inputs share
+their server context too, which lets clients resume their sessions
+with session tickets or the context's session cache.
+
+Handshakes never block the loop. Each step of a handshake runs when
+the socket is ready for it, so a slow or silent peer only holds up its
+own connection, and connections whose handshake takes longer than
+handshake_timeout seconds are closed.
+'''
+import collections
 import socket
 import ssl
+import warnings
 import trixy
+from trixy.resolver import address_family
 
 
-class TrixySSLInput(trixy.TrixyInput):
+class ContextRegistry():
     '''
-    Acts like a normal TrixyInput, but uses Python's ssl.wrap_socket()
-    code to speak the SSL protocol back to applications that expect it.
+    SSLContexts shared between connections with the same settings, and
+    the client sessions established with them.
+
+    Session tickets are encrypted with keys that each server context
+    generates when it is built. When running several worker processes,
+    build the server contexts before the workers are started (for
+    example by calling server_context before TrixyWorkerPool.run) so
+    that every worker can resume sessions issued by the others.
     '''
-    def __init__(self, sock, addr, **kwargs):
+
+    def __init__(self, max_sessions=1024):
+        '''
+        :param int max_sessions: The maximum number of client sessions
+          kept. The least recently used session is forgotten to make
+          room for a new one.
+        '''
+        self.max_sessions = max_sessions
+
+        #: Maps a settings tuple to the context built for it.
+        self.contexts = {}
+        #: Maps a (context, host, port) tuple to the session to resume.
+        self.sessions = collections.OrderedDict()
+
+        #: Client handshakes that resumed a session.
+        self.resumed = 0
+        #: Client handshakes that had to negotiate a new session.
+        self.full = 0
+
+    def stats(self):
+        '''
+        Return the registry's counters as a dictionary.
+        '''
+        return {'contexts': len(self.contexts),
+                'sessions': len(self.sessions),
+                'resumed': self.resumed, 'full': self.full}
+
+    def client_context(self, protocol=ssl.PROTOCOL_TLS_CLIENT, **options):
+        '''
+        Return the shared context for connecting to servers.
+
+        :param int protocol: The ssl.PROTOCOL_* constant to use.
+        :param **options: Settings passed to build_context.
+        '''
+        return self.get_context(False, protocol, options)
+
+    def server_context(self, certfile, keyfile=None,
+                       protocol=ssl.PROTOCOL_TLS_SERVER, **options):
+        '''
+        Return the shared context for accepting connections.
+
+        :param str certfile: The certificate chain to present.
+        :param str keyfile: The private key, if it is not included in
+          `certfile`.
+        :param int protocol: The ssl.PROTOCOL_* constant to use.
+        :param **options: Other settings passed to build_context.
+        '''
+        options['certfile'] = certfile
+        options['keyfile'] = keyfile
+        return self.get_context(True, protocol, options)
+
+    def get_context(self, server_side, protocol, options):
+        key = (server_side, protocol, tuple(sorted(options.items())))
+        context = self.contexts.get(key)
+        if context is None:
+            context = self.build_context(server_side, protocol, **options)
+            self.contexts[key] = context
+        return context
+
+    @staticmethod
+    def build_context(server_side, protocol, certfile=None, keyfile=None,
+                      ca_certs=None, cert_reqs=None, ciphers=None,
+                      session_tickets=True, minimum_version=None):
+        '''
+        Build a new context. The option names match the arguments of
+        the old ssl.wrap_socket() function.
+
+        :param bool server_side: Is the context used to accept
+          connections?
+        :param int protocol: The ssl.PROTOCOL_* constant to use.
+        :param str certfile: A certificate chain to present.
+        :param str keyfile: The private key for `certfile`.
+        :param str ca_certs: A file of CA certificates to verify peers
+          against.
+        :param int cert_reqs: The ssl.CERT_* verification mode.
+        :param str ciphers: An OpenSSL cipher list.
+        :param bool session_tickets: Should a server context issue
+          session tickets?
+        :param ssl.TLSVersion minimum_version: The oldest protocol
+          version allowed.
+        '''
+        context = ssl.SSLContext(protocol)
+        if minimum_version is not None:
+            context.minimum_version = minimum_version
+        if cert_reqs is not None:
+            if cert_reqs == ssl.CERT_NONE:
+                context.check_hostname = False
+            context.verify_mode = cert_reqs
+        if certfile:
+            context.load_cert_chain(certfile, keyfile)
+        if ca_certs:
+            context.load_verify_locations(ca_certs)
+        if ciphers:
+            context.set_ciphers(ciphers)
+        if server_side and not session_tickets:
+            context.options |= ssl.OP_NO_TICKET
+        return context
+
+    def session(self, context, host, port):
+        '''
+        Return the session to resume when connecting to `host` and
+        `port` with `context`, or None.
+        '''
+        key = (context, host, port)
+        session = self.sessions.get(key)
+        if session is not None:
+            self.sessions.move_to_end(key)
+        return session
+
+    def save_session(self, host, port, sock):
+        '''
+        Remember the session of a client connection so that it can be
+        resumed by the next connection to the same host.
+
+        :param str host: The host the socket is connected to.
+        :param int port: The port the socket is connected to.
+        :param ssl.SSLSocket sock: A socket that finished its handshake.
+        '''
+        if sock.version() is None:
+            return  # The handshake never finished.
+        if sock.session_reused:
+            self.resumed += 1
+        else:
+            self.full += 1
+
+        session = sock.session
+        if session is None:
+            return
+        if sock.version() == 'TLSv1.3' and not session.has_ticket:
+            return  # Nothing to resume with until a ticket arrives.
+        key = (sock.context, host, port)
+        self.sessions[key] = session
+        self.sessions.move_to_end(key)
+        while len(self.sessions) > self.max_sessions:
+            self.sessions.popitem(last=False)
+
+    def clear(self):
+        '''
+        Forget all contexts and sessions.
+        '''
+        self.contexts.clear()
+        self.sessions.clear()
+
+
+#: The registry used by inputs and outputs that are not given one.
+default_registry = ContextRegistry()
+
+
+class TrixySSLConnection():
+    '''
+    Perform the TLS handshake of a TrixyConnection one step at a time as
+    the socket becomes readable or writable, and handle the
+    SSLWantReadError and SSLWantWriteError exceptions that a
+    non-blocking SSL socket raises once the handshake is over.
+
+    This is mixed in ahead of TrixyInput or TrixyOutput.
+    '''
+    #: Seconds a handshake may take before it fails, or None for no
+    #: limit. See trixy.timers.
+    handshake_timeout = 30
+
+    handshaking = False
+    handshake_want_write = False
+
+    def start_handshake(self):
+        '''
+        Begin the handshake on the (connected) SSL socket.
+        '''
+        self.handshaking = True
+        self.handshake_want_write = False
+        self.start_handshake_timer()
+        self.do_handshake_step()
+
+    def do_handshake_step(self):
+        try:
+            self.socket.do_handshake()
+        except ssl.SSLWantReadError:
+            self.handshake_want_write = False
+        except ssl.SSLWantWriteError:
+            self.handshake_want_write = True
+        except OSError as e:
+            self.handshaking = False
+            self.stop_handshake_timer()
+            self.handle_handshake_failed(e)
+        else:
+            self.handshaking = False
+            self.stop_handshake_timer()
+            self.handle_handshake_done()
+
+    def handle_handshake_done(self):
+        '''
+        The handshake finished. Send anything queued in the meantime.
+        '''
+        self.initiate_send()
+
+    def handle_handshake_failed(self, error):
+        '''
+        The handshake failed or timed out.
+
+        :param Exception error: The reason.
+        '''
+        self.handle_close()
+
+    def handle_timeout(self, kind):
+        if kind == 'handshake' and self.handshaking:
+            self.handshaking = False
+            self.handle_handshake_failed(
+                TimeoutError('TLS handshake timed out'))
+            return
+        super().handle_timeout(kind)
+
+    def readable(self):
+        if self.handshaking:
+            return self.poll_timer() and not self.handshake_want_write
+        return super().readable()
+
+    def writable(self):
+        if self.handshaking:
+            return self.handshake_want_write
+        if self.closed:
+            return False
+        return super().writable()
+
+    def handle_read(self):
+        if self.handshaking:
+            self.do_handshake_step()
+            return
+        super().handle_read()
+        # Decrypted data left in the SSL object does not make the
+        # socket readable again, so read it now.
+        while (not self.closed and self.socket is not None and
+               self.socket.pending()):
+            super().handle_read()
+
+    def handle_write(self):
+        if self.handshaking:
+            self.do_handshake_step()
+            return
+        super().handle_write()
+
+    def recv_chunk(self, buffer):
+        try:
+            return super().recv_chunk(buffer)
+        except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            # Only TLS records without data (such as session tickets)
+            # were read.
+            return None
+
+    def send_some(self, data):
+        if self.handshaking or not self.connected:
+            return 0
+        try:
+            return super().send_some(data)
+        except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            return 0
+
+
+class TrixySSLInput(TrixySSLConnection, trixy.TrixyInput):
+    '''
+    Acts like a normal TrixyInput, but speaks the SSL protocol back to
+    applications that expect it. The server context is shared by all
+    inputs with the same settings, so clients can resume their sessions.
+    '''
+    opaque = False
+    #: The ContextRegistry to take the context from. (Default:
+    #: default_registry.)
+    registry = None
+
+    def __init__(self, sock, addr, context=None,
+                 do_handshake_on_connect=None, suppress_ragged_eofs=True,
+                 **kwargs):
+        '''
+        :param socket.socket sock: The accepted socket.
+        :param tuple addr: The address of the client.
+        :param ssl.SSLContext context: The context to use. (Default: a
+          shared context built from the other arguments.)
+        :param bool do_handshake_on_connect: Deprecated and ignored; the
+          handshake is always run by the loop.
+        :param **kwargs: Settings for the context, as accepted by
+          the old ssl.wrap_socket() function: certfile, keyfile,
+          ca_certs, cert_reqs, ssl_version, and ciphers.
+        '''
+        if do_handshake_on_connect is not None:
+            warnings.warn('do_handshake_on_connect is ignored; the '
+                          'handshake is always run by the loop',
+                          DeprecationWarning, stacklevel=2)
         super().__init__(sock, addr)
-        self.socket = ssl.wrap_socket(self.socket, server_side=True, **kwargs)
+        if context is None:
+            registry = self.registry or default_registry
+            certfile = kwargs.pop('certfile', None)
+            protocol = kwargs.pop('ssl_version', ssl.PROTOCOL_TLS_SERVER)
+            context = registry.server_context(certfile, protocol=protocol,
+                                              **kwargs)
+        self.socket = context.wrap_socket(
+            self.socket, server_side=True, do_handshake_on_connect=False,
+            suppress_ragged_eofs=suppress_ragged_eofs)
+        self.start_handshake()
 
 
-class TrixySSLOutput(trixy.TrixyOutput):
+class TrixySSLOutput(TrixySSLConnection, trixy.TrixyOutput):
     '''
-    Acts like a normal TriyOutput, but uses Python's ssl.wrap_socket()
-    code to speak the SSL protocol to servers that expect it.
+    Acts like a normal TriyOutput, but speaks the SSL protocol to
+    servers that expect it. Sessions are resumed when connecting to a
+    host that an earlier output with the same context connected to.
+    Upstream nodes are told that the output is connected once the
+    handshake has finished.
 
     By default this class allows for SSL2 and SSL3 connections in
     addition to TLS. If you want to specify different settings, you can
     pass your own context to setup_socket().
     '''
+    opaque = False
     supports_assumed_connections = True
     default_protocol = ssl.PROTOCOL_SSLv23
+    #: Settings for the default context, as accepted by
+    #: ContextRegistry.build_context.
+    default_options = {}
+    #: The ContextRegistry to take contexts and sessions from. (Default:
+    #: default_registry.)
+    registry = None
 
     def __init__(self, host, port, autoconnect=True, **kwargs):
         super().__init__(host, port, autoconnect=False, **kwargs)
@@ -31,6 +362,9 @@ class TrixySSLOutput(trixy.TrixyOutput):
         if autoconnect:
             self.connect((host, port))
 
+    def get_registry(self):
+        return self.registry or default_registry
+
     def setup_socket(self, host, port, autoconnect, context=None, **kwargs):
         '''
         :param str host: The hostname the output should connect to.
@@ -43,13 +377,28 @@ class TrixySSLOutput(trixy.TrixyOutput):
         :param **kwargs: Anything else that should be passed to the
           SSLContext's wrap_socket method.
         '''
-        addr_info = socket.getaddrinfo(host, port)
         if not context:
-            context = ssl.SSLContext(self.default_protocol)
-        sock = context.wrap_socket(socket.socket(addr_info[0][0],
-                                                 addr_info[0][1]), **kwargs)
+            context = self.get_registry().client_context(
+                self.default_protocol, **self.default_options)
+        self.context = context
+        self.wrap_kwargs = kwargs
+        self.create_connection_socket(address_family(host))
+
+    def create_connection_socket(self, family):
+        sock = self.wrap_socket(socket.socket(family, socket.SOCK_STREAM),
+                                self.context, self.wrap_kwargs)
         self.set_socket(sock)
 
+    def wrap_socket(self, sock, context, kwargs):
+        '''
+        Wrap `sock` with `context`, resuming the last session with the
+        host if there is one.
+        '''
+        kwargs = dict(kwargs, do_handshake_on_connect=False)
+        kwargs.setdefault('session', self.get_registry().session(
+            context, self.host, self.port))
+        return context.wrap_socket(sock, **kwargs)
+
     def assume_connected(self, host, port, sock, context=None, **kwargs):
         '''
         Assume a connection that is already in progress and encrypt
@@ -64,17 +413,45 @@ class TrixySSLOutput(trixy.TrixyOutput):
         :param **kwargs: Anything else that should be passed to the
           SSLContext's wrap_socket method.
         '''
-        super().assume_connected(host, port, sock)
         if not context:
-            context = ssl.SSLContext(self.default_protocol)
-        sock = context.wrap_socket(sock, **kwargs)
+            context = self.get_registry().client_context(
+                self.default_protocol, **self.default_options)
+        self.host = host
+        self.port = port
+        self.context = context
+        super().assume_connected(host, port,
+                                 self.wrap_socket(sock, context, kwargs))
+        self.connected = True
+        self.start_handshake()
+
+    def handle_connect(self):
+        self.start_handshake()
+
+    def handle_handshake_done(self):
+        self.report_connected()
+        super().handle_handshake_done()
+
+    def handle_handshake_failed(self, error):
+        self.report_connect_failed(error)
+
+    def close(self):
+        if (isinstance(self.socket, ssl.SSLSocket) and self.connected and
+                not self.handshaking):
+            self.get_registry().save_session(self.host, self.port,
+                                             self.socket)
+        super().close()
 
 
-class TrixyTLSOutput(trixy.TrixyOutput):
+class TrixyTLSOutput(TrixySSLOutput):
     '''
     Acts identical to a TrixySSLOutput, but defaults to only accepting
-    TLS for security reasons. This makes it slightly easier to prevent
-    downgrade attacks, especially when doing hasty testing rather than
-    full development.
+    TLS 1.2 and up for security reasons. This makes it slightly easier
+    to prevent downgrade attacks, especially when doing hasty testing
+    rather than full development. Like TrixySSLOutput, the default
+    context does not verify the server's certificate; pass a context
+    to setup_socket() to verify it.
     '''
-    default_protocol = ssl.PROTOCOL_TLSv1  # Allows for TLSv1 and up
+    opaque = False
+    default_protocol = ssl.PROTOCOL_TLS_CLIENT
+    default_options = {'cert_reqs': ssl.CERT_NONE,
+                       'minimum_version': ssl.TLSVersion.TLSv1_2}
@@ -0,0 +1,225 @@
+'''
+Run CPU-heavy processing in a worker pool instead of on the loop.
+
+A processor that does real work on each packet, such as decompressing
+or scanning it, runs on the loop thread and holds up every other
+connection while it does. ExecutorProcessor instead sends the data to
+a thread or process pool and forwards each result once it comes back,
+in the order the data arrived. Each connection only has a few batches
+of data in the pool at a time; past that, the connection sending the
+data is paused until the pool catches up.
+
+For example::
+
+   import trixy.executor
+
+   def scan(data):
+       # Runs in a worker thread; return the data to forward.
+       return data
+
+   processor = trixy.executor.ExecutorProcessor(down=scan, up=scan)
+
+Threads suit functions that release the GIL, such as zlib and hashlib.
+For pure Python functions, use a process pool::
+
+   import concurrent.futures
+
+   trixy.executor.ExecutorProcessor.pool = trixy.executor.WorkerPool(
+       concurrent.futures.ProcessPoolExecutor())
+
+Functions run in a process pool must be picklable, which means they
+must be defined at the top level of a module.
+'''
+import collections
+import concurrent.futures
+import trixy
+from trixy.buffers import as_bytes
+from trixy.waker import LoopWaker
+
+
+class WorkerPool():
+    '''
+    An executor, and the means to get its results back onto the loop.
+    '''
+
+    def __init__(self, executor=None, max_workers=None):
+        '''
+        :param concurrent.futures.Executor executor: The executor to run
+          work in. A ThreadPoolExecutor is created when first needed if
+          None.
+        :param int max_workers: The number of threads in that
+          ThreadPoolExecutor; see ThreadPoolExecutor.
+        '''
+        self.executor = executor
+        self.max_workers = max_workers
+        self.waker = None
+        #: The number of submitted calls that have not been finished.
+        self.in_flight = 0
+
+    def submit(self, func, data, callback):
+        '''
+        Call `func(data)` in the pool, then `callback(future)` on the
+        loop thread.
+
+        :returns: The concurrent.futures.Future of the call.
+        '''
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                self.max_workers, thread_name_prefix='trixy-worker')
+        if self.waker is None or self.waker.closed:
+            self.waker = LoopWaker()
+        self.in_flight += 1
+        future = self.executor.submit(func, data)
+        waker = self.waker
+        future.add_done_callback(
+            lambda f: waker.call_soon_threadsafe(self.finish, callback, f))
+        return future
+
+    def finish(self, callback, future):
+        self.in_flight -= 1
+        try:
+            callback(future)
+        finally:
+            if not self.in_flight and self.waker is not None:
+                # Let the loop exit once nothing else is running.
+                self.waker.close()
+                self.waker = None
+
+
+#: The pool used by processors that are not given one.
+default_pool = WorkerPool()
+
+
+class ExecutorProcessor(trixy.TrixyProcessor):
+    '''
+    Pass the data moving in each direction through a function that
+    runs in a WorkerPool, and forward what it returns.
+    '''
+    #: The WorkerPool to run the functions in, or None to use the
+    #: default pool.
+    pool = None
+    #: The most batches of data moving in one direction that may be in
+    #: the pool at once. Past that, the connection sending the data
+    #: stops reading until a result comes back.
+    max_in_flight = 4
+
+    def __init__(self, down=None, up=None):
+        '''
+        :param down: Called with each batch of data moving down the
+          chain, as bytes. It returns the bytes to forward, which may be
+          empty. None passes the data through on the loop.
+        :param up: The same for data moving up the chain.
+        '''
+        super().__init__()
+        self.funcs = {'down': down, 'up': up}
+        #: The futures of the work submitted in each direction, oldest
+        #: first.
+        self.queues = {'down': collections.deque(),
+                       'up': collections.deque()}
+        self.paused = {'down': False, 'up': False}
+        #: True for a direction whose close waits for the work before it.
+        self.closing = {'down': False, 'up': False}
+
+    def get_pool(self):
+        if self.pool is None:
+            return default_pool
+        return self.pool
+
+    def handle_packet_down(self, data):
+        self.submit('down', (data,))
+
+    def handle_packet_up(self, data):
+        self.submit('up', (data,))
+
+    def handle_batch_down(self, batch):
+        self.submit('down', batch)
+
+    def handle_batch_up(self, batch):
+        self.submit('up', batch)
+
+    def submit(self, direction, batch):
+        func = self.funcs[direction]
+        if func is None:
+            self.forward(direction, batch)
+            return
+        # Copy the data; the batch's memory is reused after this call.
+        if len(batch) == 1:
+            data = as_bytes(batch[0])
+        else:
+            data = b''.join(batch)
+        queue = self.queues[direction]
+        queue.append(self.get_pool().submit(
+            func, data, lambda future: self.finish(direction)))
+        if len(queue) >= self.max_in_flight and not self.paused[direction]:
+            self.paused[direction] = True
+            self.pause_producers(direction)
+
+    def forward(self, direction, batch):
+        if direction == 'down':
+            self.forward_batch_down(batch)
+        else:
+            self.forward_batch_up(batch)
+
+    def finish(self, direction):
+        '''
+        Forward the results that have come back in `direction`, up to
+        the first one still being worked on.
+        '''
+        queue = self.queues[direction]
+        results = []
+        while queue and queue[0].done():
+            future = queue.popleft()
+            try:
+                result = future.result()
+            except Exception as e:
+                self.handle_work_failed(direction, e)
+                return
+            if result:
+                results.append(result)
+        if results:
+            self.forward(direction, results)
+
+        if self.paused[direction] and len(queue) < self.max_in_flight:
+            self.paused[direction] = False
+            self.resume_producers(direction)
+        if self.closing[direction] and not queue:
+            self.closing[direction] = False
+            super().handle_close(direction)
+
+    def pause_producers(self, direction):
+        if direction == 'down':
+            for node in self.upstream_nodes:
+                node.handle_pause('up')
+        else:
+            for node in self.downstream_nodes:
+                node.handle_pause('down')
+
+    def resume_producers(self, direction):
+        if direction == 'down':
+            for node in self.upstream_nodes:
+                node.handle_resume('up')
+        else:
+            for node in self.downstream_nodes:
+                node.handle_resume('down')
+
+    def handle_work_failed(self, direction, error):
+        '''
+        A function raised `error`. By default, the rest of the work is
+        dropped and the chain is closed in both directions.
+
+        :param str direction: The direction of the failed work.
+        :param Exception error: The exception raised.
+        '''
+        for queue in self.queues.values():
+            for future in queue:
+                future.cancel()
+            queue.clear()
+        super().handle_close('down')
+        super().handle_close('up')
+
+    def handle_close(self, direction='down'):
+        # Forward the results of the work still in the pool first.
+        if self.queues[direction]:
+            self.closing[direction] = True
+            return
+        super().handle_close(direction)
@@ -0,0 +1,559 @@
+'''
+Parse HTTP/1.1 as it streams through a chain.
+
+Most processors that deal with HTTP only need to look at or change the
+request line, the status line or the headers. HTTPProcessor parses the
+messages passing through it, requests moving down the chain and
+responses moving up, and calls a hook with each head. The bodies are
+framed, so that several requests sent on one connection (pipelining)
+are each found, but are otherwise passed along untouched as
+memoryviews of the data that was read. Changing a header therefore
+costs the same however large the body is.
+
+For example::
+
+   import trixy.http
+
+   class ExampleHTTPProcessor(trixy.http.HTTPProcessor):
+
+       def handle_request(self, request):
+           request.set(b'Accept-Encoding', b'identity')
+
+       def handle_response(self, response, request):
+           response.remove(b'Server')
+
+Once a CONNECT request is accepted, or a response switches protocols,
+the rest of the connection is passed along without being parsed. Data
+sent after a CONNECT request is held back until its response arrives.
+
+A message with both Transfer-Encoding and Content-Length is forwarded
+without the Content-Length, as RFC 9112 requires of intermediaries, so
+that the next hop cannot frame it differently.
+'''
+import collections
+import re
+import trixy
+
+
+#: Matches the blank line at the end of a head.
+HEAD_END = re.compile(rb'\r?\n\r?\n')
+#: Matches the end of a line.
+LINE_END = re.compile(rb'\n')
+#: Matches the size of a chunk.
+CHUNK_SIZE = re.compile(rb'[0-9A-Fa-f]{1,16}')
+
+
+class HTTPProtocolError(Exception):
+    '''
+    Data that cannot be parsed as HTTP/1.1 was received.
+    '''
+    pass
+
+
+class HTTPHead():
+    '''
+    The start line and headers of a message. Header names and values
+    are bytes, and names are matched without regard to case.
+    '''
+    __slots__ = ('version', 'headers', 'raw', 'original')
+
+    def __init__(self, version, headers, raw=None):
+        '''
+        :param bytes version: The protocol version, such as b'HTTP/1.1'.
+        :param list headers: The (name, value) pairs, in order.
+        :param bytes raw: The head as it was received, if it was.
+        '''
+        self.version = version
+        self.headers = headers
+        self.raw = raw
+        self.original = self.fields() if raw is not None else None
+
+    def start_line(self):
+        raise NotImplementedError()
+
+    def fields(self):
+        return (self.start_line(), tuple(self.headers))
+
+    def get(self, name, default=None):
+        '''
+        Return the value of the first header called `name`.
+        '''
+        name = name.lower()
+        for key, value in self.headers:
+            if key.lower() == name:
+                return value
+        return default
+
+    def get_all(self, name):
+        '''
+        Return the values of all headers called `name`, in order.
+        '''
+        name = name.lower()
+        return [value for key, value in self.headers if key.lower() == name]
+
+    def tokens(self, name):
+        '''
+        Return the lower case, comma separated items of all headers
+        called `name`, such as the codings in Transfer-Encoding.
+        '''
+        items = b','.join(self.get_all(name)).lower().split(b',')
+        return [item.strip(b' \t') for item in items if item.strip(b' \t')]
+
+    def add(self, name, value):
+        '''
+        Add a header after the others.
+        '''
+        self.headers.append((name, value))
+
+    def set(self, name, value):
+        '''
+        Replace all headers called `name` with one, in the place of the
+        first of them, or add it if there are none.
+        '''
+        lower = name.lower()
+        headers = []
+        for key, old in self.headers:
+            if key.lower() != lower:
+                headers.append((key, old))
+            elif value is not None:
+                headers.append((name, value))
+                value = None
+        if value is not None:
+            headers.append((name, value))
+        self.headers[:] = headers
+
+    def remove(self, name):
+        '''
+        Remove all headers called `name`.
+        '''
+        name = name.lower()
+        self.headers[:] = [(key, value) for key, value in self.headers
+                           if key.lower() != name]
+
+    def to_bytes(self):
+        '''
+        Return the head as it should be sent. A head that has not been
+        changed is sent exactly as it was received.
+        '''
+        if self.raw is not None and self.fields() == self.original:
+            return self.raw
+        lines = [self.start_line()]
+        lines.extend(key + b': ' + value for key, value in self.headers)
+        lines.append(b'\r\n')
+        return b'\r\n'.join(lines)
+
+    @classmethod
+    def parse(cls, raw):
+        '''
+        Parse a complete head, including the blank line at its end.
+
+        :param bytes raw: The head.
+        :raises HTTPProtocolError: If the head is not valid.
+        '''
+        lines = raw.rstrip(b'\r\n').split(b'\n')
+        headers = []
+        for line in lines[1:]:
+            line = line.rstrip(b'\r')
+            if line[:1] in (b' ', b'\t'):
+                raise HTTPProtocolError('Folded header lines are obsolete')
+            name, sep, value = line.partition(b':')
+            if not sep or not name or name != name.strip():
+                raise HTTPProtocolError('Invalid header line')
+            headers.append((name, value.strip(b' \t')))
+        return cls.from_start_line(lines[0].rstrip(b'\r'), headers, raw)
+
+
+class HTTPRequest(HTTPHead):
+    '''
+    The head of a request.
+    '''
+    __slots__ = ('method', 'target')
+
+    def __init__(self, method, target, version, headers, raw=None):
+        '''
+        :param bytes method: The method, such as b'GET'.
+        :param bytes target: The request target, such as b'/index.html'.
+        '''
+        self.method = method
+        self.target = target
+        super().__init__(version, headers, raw)
+
+    def start_line(self):
+        return b' '.join((self.method, self.target, self.version))
+
+    @classmethod
+    def from_start_line(cls, line, headers, raw):
+        parts = line.split(b' ')
+        if len(parts) != 3 or not parts[2].startswith(b'HTTP/1.'):
+            raise HTTPProtocolError('Invalid request line')
+        return cls(parts[0], parts[1], parts[2], headers, raw)
+
+
+class HTTPResponse(HTTPHead):
+    '''
+    The head of a response.
+    '''
+    __slots__ = ('status', 'reason')
+
+    def __init__(self, version, status, reason, headers, raw=None):
+        '''
+        :param int status: The status code, such as 200.
+        :param bytes reason: The reason phrase, such as b'OK'.
+        '''
+        self.status = status
+        self.reason = reason
+        super().__init__(version, headers, raw)
+
+    def start_line(self):
+        return b'%s %03i %s' % (self.version, self.status, self.reason)
+
+    @classmethod
+    def from_start_line(cls, line, headers, raw):
+        parts = line.split(b' ', 2)
+        if (len(parts) < 2 or not parts[0].startswith(b'HTTP/1.') or
+                len(parts[1]) != 3 or not parts[1].isdigit()):
+            raise HTTPProtocolError('Invalid status line')
+        reason = parts[2] if len(parts) == 3 else b''
+        return cls(parts[0], int(parts[1]), reason, headers, raw)
+
+
+class HTTPParser():
+    '''
+    Split one direction of a connection into heads, which are handed to
+    a callback, and body data, which is passed through.
+    '''
+    __slots__ = ('head_class', 'on_head', 'max_head_size', 'state',
+                 'remaining', 'buffer', 'line')
+
+    STATE_HEAD = 0
+    STATE_LENGTH = 1
+    STATE_CHUNK_SIZE = 2
+    STATE_CHUNK_DATA = 3
+    STATE_CHUNK_END = 4
+    STATE_TRAILERS = 5
+    STATE_UNTIL_CLOSE = 6
+    STATE_TUNNEL = 7
+    STATE_WAIT = 8
+
+    #: The longest line allowed in the framing of a chunked body.
+    max_line_size = 8192
+
+    def __init__(self, head_class, on_head, max_head_size=65536):
+        '''
+        :param type head_class: HTTPRequest or HTTPResponse.
+        :param on_head: Called with each parsed head. It must return the
+          bytes to send in place of the head, and set up the framing of
+          the body by calling one of the expect_* methods.
+        :param int max_head_size: The largest head accepted.
+        '''
+        self.head_class = head_class
+        self.on_head = on_head
+        self.max_head_size = max_head_size
+        self.state = self.STATE_HEAD
+        #: The number of body bytes left in a length or chunk.
+        self.remaining = 0
+        #: The start of a head that has not been completely received.
+        self.buffer = bytearray()
+        #: The start of a framing line that is not complete.
+        self.line = bytearray()
+
+    def expect_length(self, length):
+        if length:
+            self.state = self.STATE_LENGTH
+            self.remaining = length
+        else:
+            self.state = self.STATE_HEAD
+
+    def expect_chunked(self):
+        self.state = self.STATE_CHUNK_SIZE
+
+    def expect_until_close(self):
+        self.state = self.STATE_UNTIL_CLOSE
+
+    def wait(self):
+        '''
+        Hold everything back, up to max_head_size bytes, until tunnel()
+        or resume() is called.
+        '''
+        self.state = self.STATE_WAIT
+
+    def resume(self, pieces):
+        '''
+        Parse the data held back by wait() as the next message.
+
+        :param list pieces: The list to append the data to pass on to.
+        '''
+        self.state = self.STATE_HEAD
+        waiting = self.flush()
+        if waiting:
+            self.feed(waiting, pieces)
+
+    def tunnel(self):
+        '''
+        Stop parsing, and pass everything from now on through.
+
+        :returns: Bytes that were held back waiting for a head to be
+          completed.
+        '''
+        self.state = self.STATE_TUNNEL
+        return self.flush()
+
+    def flush(self):
+        '''
+        Return and forget the start of an incomplete head.
+        '''
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+    def feed(self, data, pieces):
+        '''
+        Parse the next piece of the stream.
+
+        :param bytes data: The data.
+        :param list pieces: The list to append the data to pass on to.
+          Body data is appended as memoryviews of `data`.
+        :raises HTTPProtocolError: If the data is not valid.
+        '''
+        data = memoryview(data)
+        size = len(data)
+        pos = 0
+        while pos < size:
+            state = self.state
+            if state == self.STATE_LENGTH or state == self.STATE_CHUNK_DATA:
+                end = min(size, pos + self.remaining)
+                pieces.append(data[pos:end])
+                self.remaining -= end - pos
+                pos = end
+                if not self.remaining:
+                    if state == self.STATE_LENGTH:
+                        self.state = self.STATE_HEAD
+                    else:
+                        self.state = self.STATE_CHUNK_END
+            elif state == self.STATE_HEAD:
+                pos = self.read_head(data, pos, pieces)
+            elif state == self.STATE_WAIT:
+                self.buffer += data[pos:]
+                self.check_head_size(len(self.buffer))
+                return
+            elif state >= self.STATE_UNTIL_CLOSE:
+                pieces.append(data[pos:] if pos else data)
+                return
+            else:
+                pos = self.read_line(data, pos, pieces)
+
+    def read_head(self, data, pos, pieces):
+        buffer = self.buffer
+        if not buffer:
+            # Blank lines before a request line are ignored (RFC 9112).
+            while pos < len(data) and data[pos] in b'\r\n':
+                pos += 1
+            found = HEAD_END.search(data, pos)
+            if found is None:
+                buffer += data[pos:]
+                self.check_head_size(len(buffer))
+                return len(data)
+            end = found.end()
+            raw = bytes(data[pos:end])
+        else:
+            start = len(buffer)
+            buffer += data[pos:]
+            found = HEAD_END.search(buffer, max(start - 3, 0))
+            if found is None:
+                self.check_head_size(len(buffer))
+                return len(data)
+            end = pos + found.end() - start
+            raw = bytes(buffer[:found.end()])
+            buffer.clear()
+        self.check_head_size(len(raw))
+        pieces.append(self.on_head(self.head_class.parse(raw)))
+        return end
+
+    def check_head_size(self, size):
+        if size > self.max_head_size:
+            raise HTTPProtocolError('Head larger than %i bytes' %
+                                    self.max_head_size)
+
+    def read_line(self, data, pos, pieces):
+        found = LINE_END.search(data, pos)
+        if found is None:
+            self.line += data[pos:]
+            if len(self.line) > self.max_line_size:
+                raise HTTPProtocolError('Chunk framing line too long')
+            pieces.append(data[pos:])
+            return len(data)
+        end = found.end()
+        pieces.append(data[pos:end])
+        line = data[pos:end]
+        if self.line:
+            self.line += line
+            line = bytes(self.line)
+            self.line.clear()
+        self.handle_line(bytes(line).rstrip(b'\r\n'))
+        return end
+
+    def handle_line(self, line):
+        state = self.state
+        if state == self.STATE_CHUNK_SIZE:
+            size = line.split(b';', 1)[0].strip(b' \t')
+            if not CHUNK_SIZE.fullmatch(size):
+                raise HTTPProtocolError('Invalid chunk size')
+            self.remaining = int(size, 16)
+            if self.remaining:
+                self.state = self.STATE_CHUNK_DATA
+            else:
+                self.state = self.STATE_TRAILERS
+        elif state == self.STATE_CHUNK_END:
+            if line:
+                raise HTTPProtocolError('Chunk data longer than its size')
+            self.state = self.STATE_CHUNK_SIZE
+        elif not line:
+            # The blank line after the trailers ends the message.
+            self.state = self.STATE_HEAD
+
+
+def content_length(head):
+    '''
+    Return the value of the Content-Length header of `head`, or None.
+
+    :raises HTTPProtocolError: If the header is not valid.
+    '''
+    values = set(head.tokens(b'content-length'))
+    if not values:
+        return None
+    value = values.pop()
+    if values or not value.isdigit():
+        raise HTTPProtocolError('Invalid Content-Length')
+    return int(value)
+
+
+class HTTPProcessor(trixy.TrixyProcessor):
+    '''
+    Parse requests moving down the chain and responses moving up it,
+    and call handle_request and handle_response with each head before
+    it is forwarded.
+    '''
+
+    #: The largest request or response head accepted.
+    max_head_size = 65536
+
+    def __init__(self):
+        super().__init__()
+        #: The requests whose responses have not started yet.
+        self.requests = collections.deque()
+        self.down = HTTPParser(HTTPRequest, self.parsed_request,
+                               self.max_head_size)
+        self.up = HTTPParser(HTTPResponse, self.parsed_response,
+                             self.max_head_size)
+
+    def handle_request(self, request):
+        '''
+        Look at or change a request head before it is forwarded.
+
+        :param HTTPRequest request: The head, which can be changed in
+          place.
+        '''
+        pass
+
+    def handle_response(self, response, request):
+        '''
+        Look at or change a response head before it is forwarded.
+
+        :param HTTPResponse response: The head, which can be changed in
+          place.
+        :param HTTPRequest request: The request being answered, or None
+          if the response was not asked for.
+        '''
+        pass
+
+    def parsed_request(self, request):
+        self.handle_request(request)
+        self.requests.append(request)
+        parser = self.down
+        if request.method == b'CONNECT':
+            # Only tunnel once the response accepts it.
+            parser.wait()
+            return request.to_bytes()
+
+        codings = request.tokens(b'transfer-encoding')
+        if codings:
+            if codings[-1] != b'chunked':
+                raise HTTPProtocolError('Request body length unknown')
+            request.remove(b'Content-Length')
+            parser.expect_chunked()
+        else:
+            parser.expect_length(content_length(request) or 0)
+        return request.to_bytes()
+
+    def parsed_response(self, response):
+        status = response.status
+        if 100 <= status < 200 and status != 101:
+            # An interim response; the final one is still to come.
+            self.handle_response(response, self.requests[0]
+                                 if self.requests else None)
+            self.up.expect_length(0)
+            return response.to_bytes()
+
+        request = self.requests.popleft() if self.requests else None
+        self.handle_response(response, request)
+        parser = self.up
+        method = request.method if request is not None else None
+        codings = response.tokens(b'transfer-encoding')
+        if status == 101 or (method == b'CONNECT' and status < 300):
+            parser.tunnel()
+            waiting = self.down.tunnel()
+            if waiting:
+                self.forward_packet_down(waiting)
+            return response.to_bytes()
+        if method == b'CONNECT':
+            # Refused, so what the client sent next is HTTP again.
+            pieces = []
+            self.down.resume(pieces)
+            if pieces:
+                self.forward_batch_down(pieces)
+        if method == b'HEAD' or status in (204, 304):
+            parser.expect_length(0)
+        elif codings:
+            response.remove(b'Content-Length')
+            if codings[-1] == b'chunked':
+                parser.expect_chunked()
+            else:
+                parser.expect_until_close()
+        else:
+            length = content_length(response)
+            if length is None:
+                parser.expect_until_close()
+            else:
+                parser.expect_length(length)
+        return response.to_bytes()
+
+    def handle_packet_down(self, data):
+        self.handle_batch_down((data,))
+
+    def handle_packet_up(self, data):
+        self.handle_batch_up((data,))
+
+    def handle_batch_down(self, batch):
+        pieces = []
+        for data in batch:
+            self.down.feed(data, pieces)
+        if pieces:
+            self.forward_batch_down(pieces)
+
+    def handle_batch_up(self, batch):
+        pieces = []
+        for data in batch:
+            self.up.feed(data, pieces)
+        if pieces:
+            self.forward_batch_up(pieces)
+
+    def handle_close(self, direction='down'):
+        # Pass on the start of a head that was never completed.
+        parser = self.down if direction == 'down' else self.up
+        waiting = parser.flush()
+        if waiting:
+            if direction == 'down':
+                self.forward_packet_down(waiting)
+            else:
+                self.forward_packet_up(waiting)
+        super().handle_close(direction)
@@ -0,0 +1,375 @@
+'''
+Find out where time goes inside a chain.
+
+When instrumentation is enabled, every call to a node's packet or
+batch handlers made through the chain is counted and timed, grouped by
+the node's class. A processor that calls forward_packet_down is only
+charged for its own work, not for the work of the nodes it forwards
+to. Connections also record how long they were
+open, and the amount of data waiting in their send buffers is reported
+when the metrics are read.
+
+Instrumentation is off by default and costs nothing then. Turn it on
+with enable(), and serve the results in the Prometheus text format from
+the same asyncore loop with a MetricsServer::
+
+   import trixy.metrics
+   trixy.metrics.enable()
+   trixy.metrics.MetricsServer('127.0.0.1', 9100)
+
+Everything is updated from the loop thread only, so the counters are
+plain integers and need no locks.
+'''
+import asyncore
+import math
+import socket
+import time
+import trixy
+
+
+class Histogram():
+    '''
+    A log-linear histogram in the style of HdrHistogram. Each power of
+    two above `lowest` is split into `sub_buckets` buckets of equal
+    width, so every recorded value lands in a bucket whose bounds are
+    within a fixed ratio of it, and recording a value takes constant
+    time. A bucket holds the values from the upper bound of the bucket
+    before it up to, but not including, its own upper bound.
+    '''
+    __slots__ = ('lowest', 'sub_buckets', 'counts', 'count', 'sum')
+
+    def __init__(self, lowest=1e-6, highest=10, sub_buckets=2):
+        '''
+        :param float lowest: The upper bound of the first bucket.
+        :param float highest: Values above this are only counted in the
+          final, unbounded bucket.
+        :param int sub_buckets: The number of buckets per power of two.
+        '''
+        self.lowest = lowest
+        self.sub_buckets = sub_buckets
+        octaves = max(1, math.ceil(math.log2(highest / lowest)))
+        #: Counts for each bucket. The last bucket has no upper bound.
+        self.counts = [0] * (octaves * sub_buckets + 2)
+        self.count = 0
+        self.sum = 0.0
+
+    def record(self, value):
+        '''
+        Add a value to the histogram.
+        '''
+        self.count += 1
+        self.sum += value
+        scaled = value / self.lowest
+        if scaled < 1:
+            index = 0
+        else:
+            mantissa, exponent = math.frexp(scaled)
+            index = (1 + (exponent - 1) * self.sub_buckets +
+                     int((mantissa * 2 - 1) * self.sub_buckets))
+            index = min(index, len(self.counts) - 1)
+        self.counts[index] += 1
+
+    def upper_bound(self, index):
+        '''
+        Return the upper bound of the bucket at `index`.
+        '''
+        if index == 0:
+            return self.lowest
+        if index == len(self.counts) - 1:
+            return math.inf
+        octave, sub = divmod(index - 1, self.sub_buckets)
+        return self.lowest * 2 ** octave * (1 + (sub + 1) / self.sub_buckets)
+
+    def percentile(self, fraction):
+        '''
+        Return the upper bound of the bucket holding the value below
+        which `fraction` of the recorded values lie.
+        '''
+        if not self.count:
+            return math.nan
+        wanted = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= wanted:
+                return self.upper_bound(index)
+        return math.inf
+
+    def buckets(self):
+        '''
+        Yield (upper bound, cumulative count) pairs for every bucket.
+        '''
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            yield self.upper_bound(index), seen
+
+
+class NodeStats():
+    '''
+    The counters for one class of node and one direction.
+    '''
+    __slots__ = ('packets', 'bytes', 'seconds')
+
+    def __init__(self):
+        self.packets = 0
+        self.bytes = 0
+        #: Time spent in the handler, excluding forwarded calls.
+        self.seconds = Histogram()
+
+
+class ConnectionStats():
+    '''
+    The counters for one class of connection.
+    '''
+    __slots__ = ('opened', 'open', 'lifetime')
+
+    def __init__(self):
+        self.opened = 0
+        #: The connections that are still open.
+        self.open = set()
+        self.lifetime = Histogram(lowest=1e-3, highest=86400)
+
+
+class Metrics():
+    '''
+    Counters and histograms for the nodes and connections of every
+    chain.
+    '''
+
+    def __init__(self):
+        #: Maps a (class name, direction) tuple to its NodeStats.
+        self.nodes = {}
+        #: Maps a class name to its ConnectionStats.
+        self.connections = {}
+        #: Time spent in nested handlers by each call being timed.
+        self.nested = []
+
+    def node_stats(self, node, direction):
+        key = (type(node).__name__, direction)
+        stats = self.nodes.get(key)
+        if stats is None:
+            stats = self.nodes[key] = NodeStats()
+        return stats
+
+    def call(self, node, direction, data):
+        '''
+        Call node.handle_packet_<direction>(data) and record it.
+
+        :param TrixyNode node: The node to hand the data to.
+        :param str direction: 'down' or 'up'.
+        :param bytes data: The data.
+        '''
+        stats = self.node_stats(node, direction)
+        stats.packets += 1
+        stats.bytes += len(data)
+        if direction == 'down':
+            self.timed(stats, node.handle_packet_down, data)
+        else:
+            self.timed(stats, node.handle_packet_up, data)
+
+    def call_batch(self, node, direction, batch):
+        '''
+        Call node.handle_batch_<direction>(batch) and record it. Every
+        packet in the batch is counted, and the call is timed once.
+        '''
+        stats = self.node_stats(node, direction)
+        stats.packets += len(batch)
+        stats.bytes += sum(len(data) for data in batch)
+        if direction == 'down':
+            self.timed(stats, node.handle_batch_down, batch)
+        else:
+            self.timed(stats, node.handle_batch_up, batch)
+
+    def timed(self, stats, handler, argument):
+        nested = self.nested
+        nested.append(0.0)
+        start = time.perf_counter()
+        try:
+            handler(argument)
+        finally:
+            elapsed = time.perf_counter() - start
+            stats.seconds.record(elapsed - nested.pop())
+            if nested:
+                nested[-1] += elapsed
+
+    def connection_stats(self, connection):
+        name = type(connection).__name__
+        stats = self.connections.get(name)
+        if stats is None:
+            stats = self.connections[name] = ConnectionStats()
+        return stats
+
+    def connection_opened(self, connection):
+        stats = self.connection_stats(connection)
+        stats.opened += 1
+        stats.open.add(connection)
+        connection.opened_at = time.monotonic()
+
+    def connection_closed(self, connection):
+        stats = self.connection_stats(connection)
+        if connection in stats.open:
+            stats.open.discard(connection)
+            stats.lifetime.record(time.monotonic() - connection.opened_at)
+
+    def render(self):
+        '''
+        Return all metrics in the Prometheus text exposition format.
+        '''
+        lines = []
+
+        def family(name, kind, description):
+            lines.append('# HELP %s %s' % (name, description))
+            lines.append('# TYPE %s %s' % (name, kind))
+
+        def histogram(name, labels, hist):
+            for bound, count in hist.buckets():
+                lines.append('%s_bucket{%s,le="%s"} %i' % (
+                    name, labels, format_bound(bound), count))
+            lines.append('%s_sum{%s} %r' % (name, labels, hist.sum))
+            lines.append('%s_count{%s} %i' % (name, labels, hist.count))
+
+        nodes = sorted(self.nodes.items())
+        family('trixy_node_packets_total', 'counter',
+               'Packets handed to nodes.')
+        for (node, direction), stats in nodes:
+            lines.append('trixy_node_packets_total{%s} %i' % (
+                node_labels(node, direction), stats.packets))
+        family('trixy_node_bytes_total', 'counter',
+               'Bytes handed to nodes.')
+        for (node, direction), stats in nodes:
+            lines.append('trixy_node_bytes_total{%s} %i' % (
+                node_labels(node, direction), stats.bytes))
+        family('trixy_node_handle_seconds', 'histogram',
+               'Time per handler call, excluding forwarded calls.')
+        for (node, direction), stats in nodes:
+            histogram('trixy_node_handle_seconds',
+                      node_labels(node, direction), stats.seconds)
+
+        connections = sorted(self.connections.items())
+        family('trixy_connections_opened_total', 'counter',
+               'Connections opened.')
+        for name, stats in connections:
+            lines.append('trixy_connections_opened_total{node="%s"} %i' % (
+                name, stats.opened))
+        family('trixy_connections_open', 'gauge', 'Connections open now.')
+        for name, stats in connections:
+            lines.append('trixy_connections_open{node="%s"} %i' % (
+                name, len(stats.open)))
+        family('trixy_send_queue_bytes', 'gauge',
+               'Bytes waiting to be sent by open connections.')
+        for name, stats in connections:
+            queued = sum(len(c.out_buffer) for c in stats.open)
+            lines.append('trixy_send_queue_bytes{node="%s"} %i' % (
+                name, queued))
+        family('trixy_connection_lifetime_seconds', 'histogram',
+               'How long closed connections were open.')
+        for name, stats in connections:
+            histogram('trixy_connection_lifetime_seconds',
+                      'node="%s"' % name, stats.lifetime)
+
+        return '\n'.join(lines) + '\n'
+
+
+def node_labels(node, direction):
+    return 'node="%s",direction="%s"' % (node, direction)
+
+
+def format_bound(bound):
+    if bound == math.inf:
+        return '+Inf'
+    return '%.6g' % bound
+
+
+#: The metrics used by enable() when it is not given any.
+default_metrics = Metrics()
+
+
+def enable(metrics=None):
+    '''
+    Start recording metrics for every node.
+
+    :param Metrics metrics: Where to record them. (Default:
+      default_metrics.)
+    :returns: The Metrics being recorded to.
+    '''
+    trixy.TrixyNode.metrics = metrics or default_metrics
+    return trixy.TrixyNode.metrics
+
+
+def disable():
+    '''
+    Stop recording metrics.
+    '''
+    trixy.TrixyNode.metrics = None
+
+
+class MetricsServer(asyncore.dispatcher):
+    '''
+    Serve the metrics over HTTP on the asyncore loop.
+    '''
+
+    def __init__(self, host, port, metrics=None):
+        '''
+        :param str host: The address to listen on.
+        :param int port: The port to listen on.
+        :param Metrics metrics: The metrics to serve. (Default:
+          default_metrics.)
+        '''
+        super().__init__()
+        self.metrics = metrics or default_metrics
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(16)
+
+    def handle_accepted(self, sock, addr):
+        MetricsHandler(sock, self.metrics)
+
+    def handle_close(self):
+        self.close()
+
+
+class MetricsHandler(asyncore.dispatcher_with_send):
+    '''
+    Answer a single HTTP request with the metrics, whatever its path.
+    '''
+    max_request_size = 8192
+
+    def __init__(self, sock, metrics):
+        super().__init__(sock)
+        self.metrics = metrics
+        self.request = b''
+        self.responded = False
+
+    def handle_read(self):
+        data = self.recv(4096)
+        if self.responded:
+            return
+        self.request += data
+        if b'\r\n\r\n' in self.request or b'\n\n' in self.request:
+            self.respond(200, 'OK', self.metrics.render())
+        elif len(self.request) > self.max_request_size:
+            self.respond(431, 'Request Header Fields Too Large', '')
+
+    def respond(self, status, reason, body):
+        body = body.encode('utf-8')
+        self.responded = True
+        self.send(('HTTP/1.0 %i %s\r\n'
+                   'Content-Type: text/plain; version=0.0.4\r\n'
+                   'Content-Length: %i\r\n'
+                   'Connection: close\r\n\r\n' % (
+                       status, reason, len(body))).encode('ascii') + body)
+        if not self.out_buffer:
+            self.close()
+
+    def handle_write(self):
+        super().handle_write()
+        if self.responded and not self.out_buffer:
+            self.close()
+
+    def writable(self):
+        return bool(self.out_buffer)
+
+    def handle_close(self):
+        self.close()
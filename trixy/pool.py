@@ -0,0 +1,298 @@
+'''
+Keep upstream connections open between uses.
+
+Every input normally builds a new output, and with it a new TCP
+connection to the backend. For request/response workloads that pay a
+connection setup per request, the PooledTrixyOutput instead returns
+its socket to a ConnectionPool when the input side closes between two
+exchanges, and the next output for the same backend takes it over with
+assume_connected.
+
+The pool limits how many idle sockets it keeps for each backend and
+how long they may sit idle, can cap the number of connections open to
+each backend at once, and checks that a socket is still healthy before
+handing it out.
+
+Only plain TCP connections are pooled. Sockets are pooled by host,
+port and PooledTrixyOutput.tls_settings(), which always returns None:
+there is no pooled version of the TLS outputs, so TLS connections
+still pay a handshake each time.
+'''
+import collections
+import socket
+import time
+import trixy
+
+
+class ConnectionPool():
+    '''
+    Idle upstream sockets, grouped by the key of the backend they are
+    connected to.
+    '''
+
+    def __init__(self, max_idle_per_host=8, max_per_host=None,
+                 idle_timeout=60):
+        '''
+        :param int max_idle_per_host: The maximum number of idle sockets
+          kept for each backend. Extra sockets are closed.
+        :param int max_per_host: The maximum number of connections in
+          use to each backend at once. Outputs beyond the limit wait for
+          a connection to be released. (Default: no limit.)
+        :param float idle_timeout: Idle sockets older than this many
+          seconds are closed instead of being reused.
+        '''
+        self.max_idle_per_host = max_idle_per_host
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+
+        #: Maps a key to a deque of (socket, time released) tuples.
+        self.idle = collections.defaultdict(collections.deque)
+        #: Maps a key to the number of connections in use.
+        self.active = collections.Counter()
+        #: Maps a key to a deque of outputs waiting for a connection.
+        self.waiters = collections.defaultdict(collections.deque)
+
+        #: Checkouts that reused an idle socket.
+        self.hits = 0
+        #: Checkouts that needed a new connection.
+        self.misses = 0
+
+    def stats(self):
+        '''
+        Return the pool's counters as a dictionary.
+        '''
+        return {'hits': self.hits, 'misses': self.misses,
+                'idle': sum(len(idle) for idle in self.idle.values()),
+                'active': sum(self.active.values()),
+                'waiting': sum(len(w) for w in self.waiters.values())}
+
+    @staticmethod
+    def is_healthy(sock):
+        '''
+        Check that an idle socket is still open and has no unexpected
+        data waiting on it.
+
+        :param socket.socket sock: The socket to check.
+        '''
+        try:
+            sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            return True  # Open with nothing to read.
+        except (OSError, ValueError):
+            return False
+        return False  # Closed by the peer, or stray data.
+
+    def request(self, key, output):
+        '''
+        Get a connection for `output`. Exactly one of these happens,
+        possibly before this method returns: output.use_pooled_socket
+        is called with an idle socket, output.open_connection is called
+        so it can connect itself, or the output waits for another
+        output with the same key to release its connection.
+
+        :param key: The key of the backend.
+        :param PooledTrixyOutput output: The output needing a connection.
+        '''
+        if (self.max_per_host is not None and
+                self.active[key] >= self.max_per_host):
+            self.waiters[key].append(output)
+            return
+        self.active[key] += 1
+        self.hand_out(key, output)
+
+    def hand_out(self, key, output):
+        sock = self.checkout(key)
+        if sock is not None:
+            self.hits += 1
+            output.use_pooled_socket(sock)
+        else:
+            self.misses += 1
+            output.open_connection()
+
+    def checkout(self, key):
+        '''
+        Remove and return a healthy idle socket for `key`, or None.
+        '''
+        idle = self.idle.get(key)
+        deadline = time.monotonic() - self.idle_timeout
+        while idle:
+            sock, released = idle.pop()  # Most recently used first.
+            if released >= deadline and self.is_healthy(sock):
+                return sock
+            sock.close()
+        return None
+
+    def release(self, key, sock=None):
+        '''
+        An output is done with its connection. If `sock` is given it is
+        still usable and is passed to a waiting output or kept idle.
+
+        :param key: The key of the backend.
+        :param socket.socket sock: The reusable socket, or None if the
+          connection was closed.
+        '''
+        if self.active[key] > 0:
+            self.active[key] -= 1
+        waiters = self.waiters.get(key)
+        while waiters:
+            output = waiters.popleft()
+            if output.closed:
+                continue
+            self.active[key] += 1
+            if sock is not None:
+                self.hits += 1
+                output.use_pooled_socket(sock)
+            else:
+                self.hand_out(key, output)
+            return
+
+        if sock is None:
+            return
+        idle = self.idle[key]
+        if len(idle) >= self.max_idle_per_host:
+            sock.close()
+            return
+        idle.append((sock, time.monotonic()))
+
+    def cancel(self, key, output):
+        '''
+        Stop an output from waiting for a connection.
+
+        :returns: True if the output was waiting.
+        '''
+        waiters = self.waiters.get(key)
+        if waiters and output in waiters:
+            waiters.remove(output)
+            return True
+        return False
+
+    def close(self):
+        '''
+        Close all idle sockets.
+        '''
+        for idle in self.idle.values():
+            while idle:
+                idle.pop()[0].close()
+        self.idle.clear()
+
+
+#: The pool used by pooled outputs that are not given one.
+default_pool = ConnectionPool()
+
+
+class PooledTrixyOutput(trixy.TrixyOutput):
+    '''
+    A TrixyOutput that takes its connection from a ConnectionPool and
+    returns it there when the input side of the chain closes, rather
+    than closing it.
+
+    Only the node that understands the protocol can tell whether the
+    connection sits between two complete exchanges, so pooling is opt
+    in: that node calls mark_reusable() once a response has been fully
+    received. Any data sent or read afterwards clears the mark, and an
+    output closed without it closes its connection as usual. Even when
+    marked, a connection is only returned when nothing is left unsent
+    and the backend has not closed it or sent data nobody read.
+    '''
+
+    def __init__(self, host, port, autoconnect=True, connect_timeout=None,
+                 pool=None):
+        '''
+        :param str host: The hostname to connect to.
+        :param int port: The port on the host to connect to.
+        :param bool autoconnect: Should we automatically connect to the
+          host and port when the object is made? (Default: yes.)
+        :param float connect_timeout: See TrixyOutput.
+        :param ConnectionPool pool: The pool to use. (Default:
+          default_pool.)
+        '''
+        self.pool = pool or default_pool
+        self.pool_key = None
+        #: True while the connection is between complete exchanges; see
+        #: mark_reusable.
+        self.at_boundary = False
+        super().__init__(host, port, autoconnect, connect_timeout)
+
+    def tls_settings(self):
+        '''
+        Return a hashable description of the TLS settings used on the
+        connection, or None for plain TCP. Connections are only shared
+        between outputs with equal settings. Pooling TLS connections is
+        not supported yet, so this always returns None; it is the place
+        for a TLS pooled output to describe its settings.
+        '''
+        return None
+
+    def setup_socket(self, host, port, autoconnect=True):
+        if autoconnect:
+            self.connect((host, port))
+
+    def connect(self, address):
+        self.pool_key = (address[0], address[1], self.tls_settings())
+        self.pool.request(self.pool_key, self)
+
+    def open_connection(self):
+        '''
+        Called by the pool when no idle connection is available.
+        '''
+        if not self.closed:
+            super().connect(self.pool_key[:2])
+
+    def use_pooled_socket(self, sock):
+        '''
+        Called by the pool with an idle connection to take over.
+
+        :param socket.socket sock: The connected socket.
+        '''
+        if self.closed:
+            self.pool.release(self.pool_key, sock)
+            return
+        self.assume_connected(self.pool_key[0], self.pool_key[1], sock)
+        self.connected = True
+        self.at_boundary = False
+        self.report_connected()
+        self.initiate_send()
+
+    def mark_reusable(self):
+        '''
+        Note that the exchange on the connection is complete, so it may
+        be returned to the pool when the output closes.
+        '''
+        self.at_boundary = True
+
+    def send(self, data):
+        self.at_boundary = False
+        super().send(data)
+
+    def send_batch(self, batch):
+        self.at_boundary = False
+        super().send_batch(batch)
+
+    def handle_read(self):
+        self.at_boundary = False
+        super().handle_read()
+
+    def reusable(self):
+        '''
+        Return True if the connection can be handed to another output.
+        '''
+        if not self.at_boundary:
+            return False
+        if not self.connected or self.socket is None or self.out_buffer:
+            return False
+        if self.splice_channel is not None and self.splice_channel.pending:
+            return False
+        return ConnectionPool.is_healthy(self.socket)
+
+    def close(self):
+        if self.closed:
+            return
+        sock = None
+        if self.pool_key is not None and self.reusable():
+            sock = self.socket
+            self.del_channel()
+            self.socket = None
+        super().close()
+        if self.pool_key is not None:
+            if not self.pool.cancel(self.pool_key, self):
+                self.pool.release(self.pool_key, sock)
@@ -0,0 +1,255 @@
+'''
+Ready-made processors.
+
+ReplaceProcessor rewrites data as it streams through a chain. Calling
+data.replace() on each packet misses matches that are split between
+two reads, and searching for several patterns that way scans every
+packet once per pattern. A Replacer instead builds an Aho-Corasick
+automaton for all of its patterns once, and each connection only keeps
+the automaton's state and the few bytes at the end of the last packet
+that could still be the start of a match.
+'''
+import collections
+import re
+import trixy
+from trixy.buffers import as_bytes
+
+
+class Replacer():
+    '''
+    Search for several byte strings at once and replace them. Build one
+    Replacer when the program starts and share it between connections.
+
+    Matches never overlap. Where they would, the match that ends first
+    wins, and of the matches ending at the same place the longest wins.
+    '''
+
+    def __init__(self, replacements):
+        '''
+        :param dict replacements: Maps each pattern (bytes) to the bytes
+          that replace it.
+        :raises ValueError: If a pattern is empty.
+        '''
+        patterns = list(replacements)
+        if not all(patterns):
+            raise ValueError('Patterns must not be empty')
+        self.replacements = [bytes(replacements[p]) for p in patterns]
+        self.lengths = [len(p) for p in patterns]
+
+        # Build the trie.
+        goto = [{}]
+        #: The number of bytes each state has matched.
+        self.depth = [0]
+        terminal = [-1]
+        for index, pattern in enumerate(patterns):
+            state = 0
+            for byte in pattern:
+                if byte not in goto[state]:
+                    goto.append({})
+                    self.depth.append(self.depth[state] + 1)
+                    terminal.append(-1)
+                    goto[state][byte] = len(goto) - 1
+                state = goto[state][byte]
+            terminal[state] = index
+
+        # Fill in the failure transitions breadth first, producing a
+        # complete transition table with 256 entries per state.
+        count = len(goto)
+        #: The transition table: delta[state << 8 | byte].
+        self.delta = delta = [0] * (count << 8)
+        #: The pattern to replace on reaching each state, or -1.
+        self.match = match = list(terminal)
+        fail = [0] * count
+        for byte, child in goto[0].items():
+            delta[byte] = child
+        queue = collections.deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            if match[state] < 0:
+                match[state] = match[fail[state]]
+            row = state << 8
+            fail_row = fail[state] << 8
+            for byte in range(256):
+                child = goto[state].get(byte)
+                if child is None:
+                    delta[row | byte] = delta[fail_row | byte]
+                else:
+                    delta[row | byte] = child
+                    fail[child] = delta[fail_row | byte]
+                    queue.append(child)
+
+        #: The length of the longest pattern.
+        self.max_length = max(self.lengths)
+        #: Finds where the next complete match starts, so the automaton
+        #: only has to run near matches.
+        self.next_match = re.compile(b'|'.join(
+            re.escape(p) for p in sorted(patterns, key=len, reverse=True)))
+
+    def stream(self):
+        '''
+        Return a new ReplaceStream using this automaton.
+        '''
+        return ReplaceStream(self)
+
+    def replace(self, data):
+        '''
+        Replace the patterns in a complete piece of data.
+        '''
+        stream = self.stream()
+        return b''.join(stream.feed(data)) + stream.flush()
+
+
+class ReplaceStream():
+    '''
+    The state of one stream of data being searched by a Replacer.
+    '''
+    __slots__ = ('replacer', 'state', 'carry')
+
+    def __init__(self, replacer):
+        self.replacer = replacer
+        self.state = 0
+        #: Bytes held back because they could be the start of a match.
+        #: There are never more than the current state's depth.
+        self.carry = b''
+
+    def feed(self, data):
+        '''
+        Search the next piece of the stream.
+
+        :param bytes data: The data.
+        :returns: A list of bytes-like pieces that make up the output
+          so far. The pieces may be memoryviews of `data`.
+        '''
+        replacer = self.replacer
+        delta = replacer.delta
+        match = replacer.match
+        search = replacer.next_match.search
+        data = memoryview(as_bytes(data))
+        size = len(data)
+        carry = self.carry
+        state = self.state
+        pieces = []
+
+        # Positions below zero refer to the held back bytes.
+        start = -len(carry)
+        i = 0
+        searching = True
+        while i < size:
+            if not state and searching:
+                # Skip to the start of the leftmost complete match. No
+                # match can end before it does, because none starts
+                # before it. Without one, only the last few bytes can
+                # begin a match that the next packet completes.
+                found = search(data, i)
+                if found is not None:
+                    i = found.start()
+                else:
+                    searching = False
+                    i = max(i, size - replacer.max_length + 1)
+                    continue
+            state = delta[state << 8 | data[i]]
+            i += 1
+            pattern = match[state]
+            if pattern >= 0:
+                end = i - replacer.lengths[pattern]
+                self.emit(pieces, carry, data, start, end)
+                pieces.append(replacer.replacements[pattern])
+                start = i
+                state = 0
+
+        keep = size - replacer.depth[state]
+        self.emit(pieces, carry, data, start, keep)
+        if keep >= 0:
+            self.carry = bytes(data[max(keep, 0):])
+        else:
+            self.carry = carry[len(carry) + keep:] + bytes(data)
+        self.state = state
+        return pieces
+
+    @staticmethod
+    def emit(pieces, carry, data, start, end):
+        if start >= end:
+            return
+        if start < 0:
+            pieces.append(carry[len(carry) + start:len(carry) + min(end, 0)])
+        if end > 0:
+            pieces.append(data[max(start, 0):end])
+
+    def flush(self):
+        '''
+        End the stream and return the bytes that were held back.
+        '''
+        carry = self.carry
+        self.carry = b''
+        self.state = 0
+        return carry
+
+
+class ReplaceProcessor(trixy.TrixyProcessor):
+    '''
+    Replace patterns in the data passing through, in either direction,
+    including matches split between packets.
+    '''
+
+    def __init__(self, down=None, up=None):
+        '''
+        :param Replacer down: Replaces patterns in data moving down the
+          chain (from the input towards the output).
+        :param Replacer up: Replaces patterns in data moving up the
+          chain.
+        '''
+        super().__init__()
+        self.down = down.stream() if down is not None else None
+        self.up = up.stream() if up is not None else None
+
+    @staticmethod
+    def join(pieces):
+        if len(pieces) == 1:
+            return as_bytes(pieces[0])
+        return b''.join(pieces)
+
+    def handle_packet_down(self, data):
+        if self.down is None:
+            self.forward_packet_down(data)
+            return
+        pieces = self.down.feed(data)
+        if pieces:
+            self.forward_packet_down(self.join(pieces))
+
+    def handle_packet_up(self, data):
+        if self.up is None:
+            self.forward_packet_up(data)
+            return
+        pieces = self.up.feed(data)
+        if pieces:
+            self.forward_packet_up(self.join(pieces))
+
+    def handle_batch_down(self, batch):
+        if self.down is None:
+            self.forward_batch_down(batch)
+            return
+        output = [self.join(pieces) for pieces in map(self.down.feed, batch)
+                  if pieces]
+        if output:
+            self.forward_batch_down(output)
+
+    def handle_batch_up(self, batch):
+        if self.up is None:
+            self.forward_batch_up(batch)
+            return
+        output = [self.join(pieces) for pieces in map(self.up.feed, batch)
+                  if pieces]
+        if output:
+            self.forward_batch_up(output)
+
+    def handle_close(self, direction='down'):
+        # Pass on bytes held back for a match that never completed.
+        stream = self.down if direction == 'down' else self.up
+        if stream is not None:
+            carry = stream.flush()
+            if carry:
+                if direction == 'down':
+                    self.forward_packet_down(carry)
+                else:
+                    self.forward_packet_up(carry)
+        super().handle_close(direction)
@@ -9,9 +9,12 @@ made to a proxy server. This allows intercepted traffic to be easily
 routed on networks that require a proxy. It also makes it easier to
 route traffic into the Tor network.
 '''
+import errno
 import struct
 import socket
 import trixy
+from trixy.buffers import ChunkBuffer
+from trixy.resolver import default_resolver
 
 
 class Socks4Input(trixy.TrixyInput):
@@ -21,16 +24,66 @@ class Socks4Input(trixy.TrixyInput):
     '''
     # TODO: decide if binding will be allowed. Probably off by default
     #   but can be enabled by an option in __init__?
+    #: Requests longer than this are rejected by closing the connection.
+    max_request_size = 1024
+    #: Seconds to wait for a requested connection before replying that
+    #: the request failed.
+    connect_timeout = 10
+    #: Seconds a client may take to send its request.
+    handshake_timeout = 30
+
     def __init__(self, sock, addr):
         super().__init__(sock, addr)
         self.first_packet = True
+        self.request_buffer = bytearray()
+        #: The (addr, port) of a request that has not been replied to.
+        self.pending_request = None
+        #: True once the request has been refused or has failed.
+        self.refused = False
+        self.start_handshake_timer()
 
     def handle_packet_down(self, data):
-        if self.first_packet:
-            self.handle_proxy_request(data)
-            self.first_packet = False
+        if not self.first_packet:
+            if not self.refused:
+                self.forward_packet_down(data)
+            return
+
+        # The request may arrive split across several reads, or share a
+        #   read with the first bytes of the payload.
+        buf = self.request_buffer
+        buf += data
+        if not buf:
+            return
+        if buf[0] != 4:
+            self.handle_close()
+            return
+        length = self.request_length(buf)
+        if length is None:
+            if len(buf) > self.max_request_size:
+                self.handle_close()
             return
-        self.forward_packet_down(data)
+
+        self.first_packet = False
+        self.stop_handshake_timer()
+        request = bytes(buf[:length])
+        payload = bytes(buf[length:])
+        self.request_buffer = None
+        self.handle_proxy_request(request)
+        # The payload is only for a request that went ahead.
+        if payload and not (self.closed or self.refused):
+            self.forward_packet_down(payload)
+
+    def request_length(self, data):
+        '''
+        Return the length of the request at the start of `data`, or
+        None if the request is not complete yet.
+
+        :param bytearray data: The data received so far.
+        '''
+        end = data.find(b'\x00', 8)
+        if end < 0:
+            return None
+        return end + 1
 
     def handle_proxy_request(self, data):
         '''
@@ -38,6 +91,8 @@ class Socks4Input(trixy.TrixyInput):
         either initiate a connection to a remote host and port, or it
         is a request to bind a port. This method is responsible for
         processing those requests.
+
+        :param bytes data: The complete request.
         '''
         if data.startswith(b'\x04\x01'):  # CONNECT request
             port = struct.unpack('!H', data[2:4])[0]
@@ -55,13 +110,24 @@ class Socks4Input(trixy.TrixyInput):
         that a connection be made to a remote host. At this point, that
         request can be accepted, modified, or declined.
 
-        The default behavior is to accept the request as-is.
+        The default behavior is to accept the request as-is. The reply
+        is sent once the connection has succeeded or failed.
         '''
-        self.connect_node(trixy.TrixyOutput(addr, port))
-
-        # TODO: need functionality to detect if the connection fails to
-        #   notify the application accordingly.
-        self.reply_request_granted(addr, port)
+        self.pending_request = (addr, port)
+        self.connect_node(trixy.TrixyOutput(
+            addr, port, connect_timeout=self.connect_timeout))
+
+    def handle_output_connected(self, output):
+        if self.pending_request is not None:
+            addr, port = self.pending_request
+            self.pending_request = None
+            self.reply_request_granted(addr, port)
+
+    def handle_output_failed(self, output, error):
+        if self.pending_request is not None:
+            addr, port = self.pending_request
+            self.pending_request = None
+            self.reply_request_failed(addr, port)
 
     def reply_request_granted(self, addr, port):
         '''
@@ -81,8 +147,8 @@ class Socks4Input(trixy.TrixyInput):
         or the requested port could not be bound).
         '''
         # 91 is the response for a rejected or failed request
-        self.send(struct.pack('!BBH4s', 0x00, 91, port,
-                              socket.inet_aton(addr)))
+        self.refuse(struct.pack('!BBH4s', 0x00, 91, port,
+                                socket.inet_aton(addr)))
 
     def reply_request_rejected(self, addr, port):
         '''
@@ -91,8 +157,8 @@ class Socks4Input(trixy.TrixyInput):
         '''
         # 92 is the response for a request being rejected because the SOCKS
         #   server cannot connect to identd on the client.
-        self.send(struct.pack('!BBH4s', 0x00, 92, port,
-                              socket.inet_aton(addr)))
+        self.refuse(struct.pack('!BBH4s', 0x00, 92, port,
+                                socket.inet_aton(addr)))
 
     def reply_request_rejected_id_mismatch(self, addr, port):
         '''
@@ -102,8 +168,25 @@ class Socks4Input(trixy.TrixyInput):
         '''
         # 93 is the response for rejections due to the client program and
         #   identd reporting different user-ids.
-        self.send(struct.pack('!BBH4s', 0x00, 93, port,
-                              socket.inet_aton(addr)))
+        self.refuse(struct.pack('!BBH4s', 0x00, 93, port,
+                                socket.inet_aton(addr)))
+
+    def refuse(self, reply):
+        '''
+        Send a reply refusing the request, and close the connection once
+        it has been sent.
+
+        :param bytes reply: The reply to send.
+        '''
+        self.refused = True
+        self.send(reply)
+        if not self.out_buffer:
+            self.handle_close()
+
+    def handle_write(self):
+        super().handle_write()
+        if self.refused and not self.out_buffer and not self.closed:
+            self.handle_close()
 
 
 class Socks4aInput(Socks4Input):
@@ -114,10 +197,26 @@ class Socks4aInput(Socks4Input):
     '''
     # TODO: decide if binding will be allowed. Probably off by default
     #   but can be enabled by an option in __init__?
-    def __init__(self, sock, addr):
-        super().__init__(sock, addr)
-        print('Got connect')
-        self.first_packet = True
+
+    def request_length(self, data):
+        '''
+        Return the length of the request at the start of `data`, or
+        None if the request is not complete yet. A SOCKS4a request with
+        an address of 0.0.0.x has a hostname after the user id.
+
+        :param bytearray data: The data received so far.
+        '''
+        end = super().request_length(data)
+        if end is None or not self.has_hostname(data):
+            return end
+        hostname_end = data.find(b'\x00', end)
+        if hostname_end < 0:
+            return None
+        return hostname_end + 1
+
+    @staticmethod
+    def has_hostname(data):
+        return data[4:7] == b'\x00\x00\x00' and data[7] != 0
 
     def handle_proxy_request(self, data):
         '''
@@ -125,37 +224,42 @@ class Socks4aInput(Socks4Input):
         either initiate a connection to a remote host and port, or it
         is a request to bind a port. This method is responsible for
         processing those requests.
+
+        :param bytes data: The complete request.
         '''
-        print('handle_proxy_request: ', data)
         if data.startswith(b'\x04\x01'):  # CONNECT request
             port = struct.unpack('!H', data[2:4])[0]
-            addr = socket.inet_ntoa(data[4:8])
-            userid = data[8:-1]
-
-            # TODO: test if the address is invalid, which suggests that
-            #   we need to resolve the hostname contained later in the data.
-
-            print('  ', addr, ':', port, ' username: ', userid)
+            userid_end = data.index(b'\x00', 8)
+            userid = data[8:userid_end]
+            if self.has_hostname(data):
+                addr = data[userid_end + 1:-1].decode('ascii')
+            else:
+                addr = socket.inet_ntoa(data[4:8])
 
             self.handle_connect_request(addr, port, userid)
 
         elif data.startswith(b'\x04\x02'):  # BIND request
             pass  # TODO: implement binding behavior; see note above.
 
-    def handle_connect_request(self, addr, port, userid):
-        '''
-        The application connecting to this SOCKS4 input has requested
-        that a connection be made to a remote host. At this point, that
-        request can be accepted, modified, or declined.
+    def reply_request_granted(self, addr, port):
+        # The reply always carries an IPv4 address; a hostname request
+        #   is answered with 0.0.0.0 as the protocol document allows.
+        if not self.is_ipv4(addr):
+            addr = '0.0.0.0'
+        super().reply_request_granted(addr, port)
 
-        The default behavior is to accept the request as-is.
-        '''
-        print('Handling a connect request:', addr, ':', port, userid)
-        self.connect_node(trixy.TrixyOutput(addr, port))
+    def reply_request_failed(self, addr, port):
+        if not self.is_ipv4(addr):
+            addr = '0.0.0.0'
+        super().reply_request_failed(addr, port)
 
-        # TODO: need functionality to detect if the connection fails to
-        #   notify the application accordingly.
-        self.reply_request_granted(addr, port)
+    @staticmethod
+    def is_ipv4(addr):
+        try:
+            socket.inet_aton(addr)
+        except OSError:
+            return False
+        return True
 
 
 class Socks5Input(trixy.TrixyInput):
@@ -171,53 +275,118 @@ class Socks5Input(trixy.TrixyInput):
 
     SUPPORTED_METHODS = [b'\x00']
 
+    #: Seconds to wait for a requested connection before replying that
+    #: the request failed.
+    connect_timeout = 10
+    #: Seconds a client may take to negotiate a method and send its
+    #: request.
+    handshake_timeout = 30
+
     def __init__(self, sock, addr):
         super().__init__(sock, addr)
         self.state = self.STATE_WAITING_FOR_METHODS
+        self.handshake_buffer = bytearray()
+        #: The (addr, port, addrtype) of a request that has not been
+        #: replied to.
+        self.pending_request = None
+        #: True once the request has been refused or has failed.
+        self.refused = False
+        self.start_handshake_timer()
 
     def handle_packet_down(self, data):
         if self.state == self.STATE_PROXY_ACTIVE:
-            self.forward_packet_down(data)
-
-        elif self.state == self.STATE_WAITING_FOR_METHODS:
-            if data.startswith(b'\x05') and len(data) > 2:
-                nmethods = data[1]
-                methods = data[2:]
-
-                # Truncate method list if nmethods smaller, but attempt to
-                # work regardless of a method count and actual count mismatch.
-                # TODO: truncating is fingerpritable; is this desired?
-                #   Is there another implementation to copy?
-                if len(methods) > nmethods:
-                    methods = methods[0:nmethods]
-                self.handle_method_select(methods)
-
-        elif self.state == self.STATE_WAITING_FOR_REQUEST:
-            if not data.startswith(b'\x05'):  # Invalid
-                self.close()  # Disconnect
-                return
-
-            if data[1] == 0x01:  # CONNECT request
-                if data[3] == 0x01:  # IPv4 address
-                    dst_addr = socket.inet_ntoa(data[4:8])
-                    port = struct.unpack('!H', data[8:10])[0]
-                elif data[3] == 0x03:  # Domain name
-                    dst_addr_len = data[4]
-                    dst_addr = data[5:5 + dst_addr_len].decode('ascii')
-                    port = data[5 + dst_addr_len:7 + dst_addr_len]
-                    port = struct.unpack('!H', port)[0]
-                elif data[3] == 0x04:  # IPv6 address
-                    dst_addr = socket.inet_ntop(socket.AF_INET6, data[4:20])
-                    port = struct.unpack('!H', data[20:22])[0]
-                else:
-                    self.close()  # Disconnect; unsupported address type
-                    return
-
-                self.handle_connect_request(dst_addr, port, data[3:4])
+            if not self.refused:
+                self.forward_packet_down(data)
+            return
 
+        # Handshake messages may arrive split across several reads, or
+        #   several may arrive (followed by payload) in a single read.
+        buf = self.handshake_buffer
+        buf += data
+        while buf and self.state != self.STATE_PROXY_ACTIVE:
+            if self.state == self.STATE_WAITING_FOR_METHODS:
+                length = self.parse_methods(buf)
+            elif self.state == self.STATE_WAITING_FOR_REQUEST:
+                length = self.parse_request(buf)
             else:
-                self.close()  # Disconnect
                 return
+            if self.closed or self.refused:
+                # Nothing after a refused message is acted on.
+                buf.clear()
+                return
+            if not length:
+                return
+            del buf[:length]
+
+        if self.state == self.STATE_PROXY_ACTIVE:
+            self.stop_handshake_timer()
+        if buf and self.state == self.STATE_PROXY_ACTIVE:
+            payload = bytes(buf)
+            buf.clear()
+            self.forward_packet_down(payload)
+
+    def parse_methods(self, buf):
+        '''
+        Handle the method selection message at the start of `buf`.
+
+        :param bytearray buf: The handshake data received so far.
+        :returns: The length of the message, or 0 if it is incomplete
+          or the connection was closed.
+        '''
+        if buf[0] != 5:
+            self.close()  # Disconnect
+            return 0
+        if len(buf) < 2:
+            return 0
+        length = 2 + buf[1]
+        if len(buf) < length:
+            return 0
+
+        self.handle_method_select(bytes(buf[2:length]))
+        return length
+
+    def parse_request(self, buf):
+        '''
+        Handle the request message at the start of `buf`.
+
+        :param bytearray buf: The handshake data received so far.
+        :returns: The length of the message, or 0 if it is incomplete
+          or the connection was closed.
+        '''
+        if buf[0] != 5:  # Invalid
+            self.close()  # Disconnect
+            return 0
+        if len(buf) < 5:
+            return 0
+
+        addrtype = buf[3]
+        if addrtype == 0x01:  # IPv4 address
+            length = 10
+        elif addrtype == 0x03:  # Domain name
+            length = 7 + buf[4]
+        elif addrtype == 0x04:  # IPv6 address
+            length = 22
+        else:
+            self.close()  # Disconnect; unsupported address type
+            return 0
+        if len(buf) < length:
+            return 0
+
+        if buf[1] != 0x01:  # Only CONNECT requests are supported
+            self.close()  # Disconnect
+            return 0
+
+        data = bytes(buf[:length])
+        if addrtype == 0x01:
+            dst_addr = socket.inet_ntoa(data[4:8])
+        elif addrtype == 0x03:
+            dst_addr = data[5:-2].decode('ascii')
+        else:
+            dst_addr = socket.inet_ntop(socket.AF_INET6, data[4:20])
+        port = struct.unpack('!H', data[-2:])[0]
+
+        self.handle_connect_request(dst_addr, port, data[3:4])
+        return length
 
     def handle_method_select(self, methods):
         '''
@@ -230,8 +399,8 @@ class Socks5Input(trixy.TrixyInput):
             if method in methods:
                 self.reply_method(method)
                 self.state = self.STATE_WAITING_FOR_REQUEST
-            else:
-                self.close()  # Disconnect
+                return
+        self.reply_method(b'\xff')  # No acceptable methods
 
     def handle_connect_request(self, addr, port, addrtype):
         '''
@@ -239,22 +408,55 @@ class Socks5Input(trixy.TrixyInput):
         that a connection be made to a remote host. At this point, that
         request can be accepted, modified, or declined.
 
-        The default behavior is to accept the request as-is.
+        The default behavior is to accept the request as-is. The reply
+        is sent once the connection has succeeded or failed; data the
+        client sends in the meantime is held by the output.
         '''
-        self.connect_node(trixy.TrixyOutput(addr, port))
-
-        # TODO: need functionality to detect if the connection fails to
-        #   notify the application accordingly.
-        self.reply_request_granted(addr, port, addrtype)
+        self.pending_request = (addr, port, addrtype)
+        self.connect_node(trixy.TrixyOutput(
+            addr, port, connect_timeout=self.connect_timeout))
         self.state = self.STATE_PROXY_ACTIVE
 
+    def handle_output_connected(self, output):
+        if self.pending_request is not None:
+            addr, port, addrtype = self.pending_request
+            self.pending_request = None
+            self.reply_request_granted(addr, port, addrtype)
+
+    def handle_output_failed(self, output, error):
+        if self.pending_request is not None:
+            addr, port, addrtype = self.pending_request
+            self.pending_request = None
+            self.reply_request_failed(addr, port, addrtype,
+                                      socks5_reply_code(error))
+
     def reply_request_granted(self, addr, port, addrtype):
         '''
         Send a reply stating that the connection or bind request has
         been granted and that the connection or bind attempt was
         successfully completed.
         '''
-        pkt = b'\x05\x00\x00' + addrtype
+        self.reply_request(0x00, addr, port, addrtype)
+
+    def reply_request_failed(self, addr, port, addrtype, reply=0x01):
+        '''
+        Send a reply stating that the connection or bind request
+        failed.
+
+        :param int reply: The SOCKS5 reply code explaining the failure.
+          (Default: general SOCKS server failure.)
+        '''
+        self.reply_request(reply, addr, port, addrtype)
+
+    def reply_request(self, reply, addr, port, addrtype):
+        '''
+        Send a reply to a request.
+
+        :param int reply: The SOCKS5 reply code.
+        '''
+        if reply:
+            self.refused = True
+        pkt = b'\x05' + bytes((reply,)) + b'\x00' + addrtype
         if addrtype == b'\x01':  # IPv4
             pkt += socket.inet_aton(addr)
         elif addrtype == b'\x03':  # Domain name
@@ -281,14 +483,199 @@ class Socks5Input(trixy.TrixyInput):
 
 
 class Socks4Output(trixy.TrixyOutput):
-    # TODO: implement assumed connections (useful for SOCKS over SSL)
-    supports_assumed_connections = False
+    '''
+    Implements the SOCKS4 protocol as defined in this document:
+    http://www.openssh.com/txt/socks4.protocol
 
+    The CONNECT request is sent as soon as the connection to the proxy
+    server is made, and the data waiting to be sent follows it right
+    away instead of waiting for the server's reply. A SOCKS4 hop so
+    costs one round trip rather than two. Hostnames are looked up
+    locally, because SOCKS4 requests carry an IPv4 address.
+    '''
+
+    STATE_NONE = 0
+    STATE_WAITING_FOR_REPLY = 1
+    STATE_PROXY_ACTIVE = 254
+    STATE_PROXY_DISABLED = 255
+
+    state = STATE_NONE
+    #: The user id sent in the request.
+    userid = b''
+    #: Seconds the proxy server may take to reply to the request once
+    #: connected.
+    handshake_timeout = 30
 
-class Socks4aOutput(trixy.TrixyOutput):
     # TODO: implement assumed connections (useful for SOCKS over SSL)
     supports_assumed_connections = False
 
+    def __init__(self, host, port, autoconnect=True,
+                 proxyhost='127.0.0.1', proxyport=1080, userid=None):
+        '''
+        :param str host: The host the proxy server should connect to.
+        :param int port: The port the proxy server should connect to.
+        :param bool autoconnect: See TrixyOutput.
+        :param str proxyhost: The proxy server's host.
+        :param int proxyport: The proxy server's port.
+        :param bytes userid: Overrides the userid class attribute.
+        '''
+        self.dsthost = host
+        self.dstport = port
+        if userid is not None:
+            self.userid = userid
+        self.state = self.STATE_NONE
+        #: The request, once the destination's address is known.
+        self.request = None
+        #: True once the connection to the proxy server is made.
+        self.proxy_connected = False
+
+        self.downstream_buffer = ChunkBuffer()
+        self.upstream_buffer = bytearray()
+        super().__init__(proxyhost, proxyport, autoconnect)
+        self.prepare_request()
+
+    def prepare_request(self):
+        '''
+        Build the request, looking up the destination first if it is a
+        hostname.
+        '''
+        try:
+            self.set_request(socket.inet_pton(socket.AF_INET, self.dsthost))
+        except OSError:
+            resolver = self.resolver or default_resolver
+            resolver.resolve(self.dsthost, self.dstport,
+                             self.handle_destination_resolved,
+                             family=socket.AF_INET)
+
+    def handle_destination_resolved(self, result):
+        if self.closed:
+            return
+        if isinstance(result, Exception):
+            self.report_connect_failed(result)
+            return
+        sockaddr = result[0][4]
+        self.set_request(socket.inet_aton(sockaddr[0]))
+
+    def set_request(self, addr, hostname=b''):
+        '''
+        Set the request to send, and send it if the proxy server is
+        connected.
+
+        :param bytes addr: The packed IPv4 address to connect to.
+        :param bytes hostname: The hostname, for SOCKS4a, or empty.
+        '''
+        self.request = (struct.pack('!BBH4s', 4, 1, self.dstport, addr) +
+                        self.userid + b'\x00')
+        if hostname:
+            self.request += hostname + b'\x00'
+        self.send_request()
+
+    def send_request(self):
+        '''
+        Send the request, followed by the data waiting to be sent, once
+        both the connection and the request are ready.
+        '''
+        if (self.request is None or not self.proxy_connected or
+                self.state != self.STATE_NONE):
+            return
+        self.set_state(self.STATE_WAITING_FOR_REPLY)
+        self.send(self.request + self.downstream_buffer.read())
+
+    def handle_connect(self):
+        self.proxy_connected = True
+        self.start_handshake_timer()
+        self.send_request()
+
+    def handle_timeout(self, kind):
+        if kind == 'handshake':
+            self.report_connect_failed(
+                TimeoutError('SOCKS handshake timed out'))
+            return
+        super().handle_timeout(kind)
+
+    def handle_packet_down(self, data):
+        self.handle_batch_down((data,))
+
+    def handle_batch_down(self, batch):
+        if self.state == self.STATE_NONE:
+            for data in batch:
+                self.downstream_buffer.append(data)
+        elif self.state != self.STATE_PROXY_DISABLED:
+            # Pipelined behind the request.
+            self.send_batch(batch)
+
+    def handle_packet_up(self, data):
+        if self.state == self.STATE_PROXY_ACTIVE:
+            self.forward_packet_up(data)
+        elif self.state == self.STATE_WAITING_FOR_REPLY:
+            # The reply may arrive split across several reads, or be
+            #   followed by payload in the same read.
+            buf = self.upstream_buffer
+            buf += data
+            if len(buf) < 8:
+                return
+            self.parse_reply(buf)
+            if self.state == self.STATE_PROXY_ACTIVE and len(buf) > 8:
+                self.forward_packet_up(bytes(buf[8:]))
+            buf.clear()
+
+    def handle_batch_up(self, batch):
+        if self.state == self.STATE_PROXY_ACTIVE:
+            self.forward_batch_up(batch)
+        else:
+            self.handle_each_up(batch)
+
+    def parse_reply(self, buf):
+        '''
+        Handle the server's reply to the request at the start of `buf`.
+
+        :param bytearray buf: At least the 8 bytes of the reply.
+        '''
+        if buf[0] != 0:
+            raise SocksProtocolError('Invalid reply message')
+        if buf[1] == 90:  # Request granted
+            self.set_state(self.STATE_PROXY_ACTIVE)
+            self.report_connected()
+        elif 91 <= buf[1] <= 93:
+            self.set_state(self.STATE_PROXY_DISABLED)
+            self.report_connect_failed(SocksRequestFailed(buf[1]))
+        else:
+            raise SocksProtocolError('Unassigned reply code used')
+
+    def set_state(self, state):
+        old_state = self.state
+        self.state = state
+        if state >= self.STATE_PROXY_ACTIVE:
+            self.stop_handshake_timer()
+        self.handle_state_change(oldstate=old_state, newstate=state)
+
+    def handle_state_change(self, oldstate, newstate):
+        '''
+        Called when the state changes; see Socks5Output.
+
+        :param int oldstate: The old state number.
+        :param int newstate: The new state number.
+        '''
+        pass
+
+
+class Socks4aOutput(Socks4Output):
+    '''
+    Implements the SOCKS4a extension to SOCKS4, as defined in this
+    document: http://www.openssh.com/txt/socks4a.protocol
+
+    Hostnames are sent to the proxy server to look up, instead of being
+    looked up locally.
+    '''
+
+    def prepare_request(self):
+        try:
+            self.set_request(socket.inet_pton(socket.AF_INET, self.dsthost))
+        except OSError:
+            # An address of 0.0.0.x means a hostname follows.
+            self.set_request(b'\x00\x00\x00\x01',
+                             self.dsthost.encode('idna'))
+
 
 class Socks5Output(trixy.TrixyOutput):
     '''
@@ -307,6 +694,9 @@ class Socks5Output(trixy.TrixyOutput):
 
     supported_auth_methods = []
     state = STATE_NONE
+    #: Seconds the proxy server may take to accept the request once
+    #: connected.
+    handshake_timeout = 30
 
     # TODO: implement assumed connections (useful for SOCKS over SSL)
     supports_assumed_connections = False
@@ -320,7 +710,8 @@ class Socks5Output(trixy.TrixyOutput):
         self.supported_auth_methods = [b'\x00']
         self.state = self.STATE_NONE
 
-        self.downstream_buffer = b''
+        self.downstream_buffer = ChunkBuffer()
+        self.upstream_buffer = bytearray()
 
         # Check if the given host is an IP address
         try:
@@ -362,17 +753,23 @@ class Socks5Output(trixy.TrixyOutput):
 
     def handle_connect(self):
         nummethods = len(self.supported_auth_methods)
-        self.send(struct.pack('!BB%ip' % nummethods, 5, nummethods,
+        self.send(struct.pack('!BB%is' % nummethods, 5, nummethods,
                               b''.join(self.supported_auth_methods)))
         self.set_state(self.STATE_WAITING_FOR_SERVER_METHOD_SELECT)
+        self.start_handshake_timer()
+
+    def handle_timeout(self, kind):
+        if kind == 'handshake':
+            self.report_connect_failed(
+                TimeoutError('SOCKS handshake timed out'))
+            return
+        super().handle_timeout(kind)
 
     def handle_packet_down(self, data):
-        print('socks5:', data)
         if self.state == self.STATE_PROXY_ACTIVE:
-            print('socks5-active:', data)
             self.send(data)
         else:
-            self.downstream_buffer += data
+            self.downstream_buffer.append(data)
 
     def handle_packet_up(self, data):
         if self.state == self.STATE_PROXY_DISABLED:
@@ -380,33 +777,96 @@ class Socks5Output(trixy.TrixyOutput):
 
         elif self.state == self.STATE_PROXY_ACTIVE:
             self.forward_packet_up(data)
+            return
+
+        # Server replies may arrive split across several reads, or be
+        #   followed by payload in the same read.
+        buf = self.upstream_buffer
+        buf += data
+        while buf and self.state != self.STATE_PROXY_ACTIVE:
+            if self.state == self.STATE_WAITING_FOR_SERVER_METHOD_SELECT:
+                length = self.parse_method_select(buf)
+            elif self.state == self.STATE_WAITING_FOR_BIND_RESPONSE:
+                length = self.parse_bind_response(buf)
+            else:
+                return
+            if not length:
+                return
+            del buf[:length]
 
-        elif self.state == self.STATE_WAITING_FOR_SERVER_METHOD_SELECT:
-            if len(data) == 2 and data.startswith(b'\x05'):
-                selected_auth_method = data[1:2]
-                if selected_auth_method not in self.supported_auth_methods:
-                    # TODO: check the RFC for graceful disconnection approach
-                    raise SocksProtocolError('Server selected bad auth method')
-
-                # Authentication complete; attempt the connection
-                self.send(b'\x05\x01\x00' + bytes((self.ip_type,)) +
-                          self.dsthost_bytes + struct.pack('!H', self.dstport))
-                self.set_state(self.STATE_WAITING_FOR_BIND_RESPONSE)
-
-        elif self.state == self.STATE_WAITING_FOR_BIND_RESPONSE:
-            if len(data) > 7 and data.startswith(b'\x05'):
-                response = data[1]
-                if response == 0:  # Success
-                    self.set_state(self.STATE_PROXY_ACTIVE)
-                    self.send(self.downstream_buffer)
-                elif response < 9:
-                    self.handle_close()
-                else:
-                    SocksProtocolError('Unassigned bind response used')
+        if buf and self.state == self.STATE_PROXY_ACTIVE:
+            payload = bytes(buf)
+            buf.clear()
+            self.forward_packet_up(payload)
+
+    def parse_method_select(self, buf):
+        '''
+        Handle the server's method selection message at the start of
+        `buf`.
+
+        :param bytearray buf: The handshake data received so far.
+        :returns: The length of the message, or 0 if it is incomplete.
+        '''
+        if len(buf) < 2:
+            return 0
+        if buf[0] != 5:
+            raise SocksProtocolError('Invalid method selection message')
+
+        selected_auth_method = bytes(buf[1:2])
+        if selected_auth_method not in self.supported_auth_methods:
+            # TODO: check the RFC for graceful disconnection approach
+            raise SocksProtocolError('Server selected bad auth method')
+
+        # Authentication complete; attempt the connection
+        self.send(b'\x05\x01\x00' + bytes((self.ip_type,)) +
+                  self.dsthost_bytes + struct.pack('!H', self.dstport))
+        self.set_state(self.STATE_WAITING_FOR_BIND_RESPONSE)
+        return 2
+
+    def parse_bind_response(self, buf):
+        '''
+        Handle the server's reply to the CONNECT request at the start
+        of `buf`.
+
+        :param bytearray buf: The handshake data received so far.
+        :returns: The length of the message, or 0 if it is incomplete
+          or the connection was closed.
+        '''
+        if len(buf) < 5:
+            return 0
+        if buf[0] != 5:
+            raise SocksProtocolError('Invalid reply message')
+
+        addrtype = buf[3]
+        if addrtype == self.IP_TYPE_V4:
+            length = 10
+        elif addrtype == self.IP_TYPE_DOMAIN:
+            length = 7 + buf[4]
+        elif addrtype == self.IP_TYPE_V6:
+            length = 22
+        else:
+            raise SocksProtocolError('Invalid address type in reply')
+        if len(buf) < length:
+            return 0
+
+        response = buf[1]
+        if response == 0:  # Success
+            self.set_state(self.STATE_PROXY_ACTIVE)
+            if self.downstream_buffer:
+                self.send(self.downstream_buffer.read())
+            self.report_connected()
+            return length
+        elif response < 9:
+            self.report_connect_failed(SocksRequestFailed(response))
+            return 0
+        else:
+            raise SocksProtocolError('Unassigned bind response used')
 
     def set_state(self, state):
         old_state = self.state
         self.state = state
+        if state >= self.STATE_PROXY_ACTIVE:
+            self.stop_handshake_timer()
         self.handle_state_change(oldstate=old_state, newstate=state)
 
     def handle_state_change(self, oldstate, newstate):
@@ -430,3 +890,40 @@ class SocksProtocolError(Exception):
     '''
     pass
 
+
+class SocksRequestFailed(ConnectionError):
+    '''
+    A SOCKS server replied that it could not carry out a request.
+    '''
+    def __init__(self, reply):
+        '''
+        :param int reply: The reply code sent by the server.
+        '''
+        super().__init__('SOCKS request failed with reply %i' % reply)
+        self.reply = reply
+
+
+#: SOCKS5 reply codes for the errors a failed connection can raise.
+SOCKS5_ERRNO_REPLIES = {
+    errno.ENETUNREACH: 0x03,   # Network unreachable
+    errno.EHOSTUNREACH: 0x04,  # Host unreachable
+    errno.ETIMEDOUT: 0x04,
+    errno.ECONNREFUSED: 0x05,  # Connection refused
+}
+
+
+def socks5_reply_code(error):
+    '''
+    Choose the SOCKS5 reply code that best describes why a connection
+    failed.
+
+    :param Exception error: The error the output failed with.
+    '''
+    if isinstance(error, SocksRequestFailed):
+        return error.reply
+    if isinstance(error, socket.gaierror):
+        return 0x04  # Host unreachable
+    if isinstance(error, OSError) and error.errno in SOCKS5_ERRNO_REPLIES:
+        return SOCKS5_ERRNO_REPLIES[error.errno]
+    return 0x01  # General SOCKS server failure
+
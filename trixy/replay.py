@@ -0,0 +1,335 @@
+'''
+Replay captured sessions against a server, for load testing.
+
+A Replay maps a LOG file written by trixy.capture into memory and
+indexes where each connection's records are, once. It then opens a
+ReplaySession for each connection, at the same point in time relative
+to the start of the capture as the original, or faster or slower by
+`speed`. A session is the top of a chain, in place of a TrixyInput:
+it sends the data the client sent through the chain, straight from the
+mapped file, with the original gaps between packets.
+
+Build each session's chain in its __init__, as for an input::
+
+   import trixy.replay
+
+   class ExampleSession(trixy.replay.ReplaySession):
+       def __init__(self, replay, conn_id):
+           super().__init__(replay, conn_id)
+           self.connect_node(trixy.TrixyOutput('127.0.0.1', 8000))
+
+   replay = trixy.replay.Replay('traffic.log', ExampleSession, speed=10)
+   replay.run()
+   print(replay.finished, replay.failed, replay.bytes_received)
+
+A session waits for the chain's output to connect before it starts its
+clock, and stops sending while the output asks it to pause. When it
+reaches the end of its records, it waits up to `linger` seconds to
+receive as much data as the server originally sent before closing.
+Timing is kept by a trixy.timers.TimerWheel, so packets are sent up to
+its resolution late.
+'''
+import asyncore
+import collections
+import mmap
+import time
+import trixy
+import trixy.timers
+from trixy.capture import LOG_MAGIC, RECORD, DOWN, UP, CLOSE
+
+
+class ReplaySession(trixy.TrixyNode):
+    '''
+    Send the data of one captured connection down the chain.
+    '''
+    #: Seconds to wait, after the last record, for the server to send as
+    #: much data as it did originally.
+    linger = 5.0
+    #: Wait for an output further down the chain to connect before
+    #: sending. Set to False for chains that do not end in an output.
+    wait_connected = True
+    timer_slot = None
+
+    def __init__(self, replay, conn_id):
+        '''
+        :param Replay replay: The replay this session is part of.
+        :param int conn_id: The id of the connection in the capture.
+        '''
+        super().__init__()
+        self.replay = replay
+        self.conn_id = conn_id
+        self.offsets = replay.connections[conn_id]
+        #: The index of the next record to send.
+        self.position = 0
+        self.pause_count = 0
+        #: When the output connected and the records started, or None.
+        self.started = None
+        #: The time.monotonic() the records are closed at, while
+        #: lingering.
+        self.closing_at = None
+        self.finished = False
+        #: The bytes the server sent originally, up to this point.
+        self.expected = 0
+        #: The bytes sent and received.
+        self.sent = 0
+        self.received = 0
+
+    def start(self):
+        '''
+        Called by the replay once the chain has been built.
+        '''
+        if not self.wait_connected:
+            self.handle_output_connected(None)
+
+    def handle_output_connected(self, output):
+        if self.started is None and not self.finished:
+            self.started = time.monotonic()
+            self.send()
+
+    def handle_output_failed(self, output, error):
+        self.finish(failed=True)
+
+    def send(self):
+        '''
+        Send the records that are due, then schedule the next one.
+        '''
+        view = self.replay.view
+        speed = self.replay.speed
+        first = self.replay.timestamp(self.offsets[0])
+        batch = []
+        now = None
+        while self.position < len(self.offsets) and not (
+                self.pause_count or self.finished):
+            offset = self.offsets[self.position]
+            timestamp, conn_id, kind, length = RECORD.unpack_from(
+                view, offset)
+            if speed:
+                due = self.started + (timestamp - first) / speed
+                if now is None:
+                    now = time.monotonic()
+                if due > now:
+                    self.replay.wheel.schedule(self, due)
+                    break
+            self.position += 1
+            if kind == DOWN:
+                start = offset + RECORD.size
+                batch.append(view[start:start + length])
+                self.sent += length
+            elif kind == UP:
+                self.expected += length
+            elif kind == CLOSE:
+                self.position = len(self.offsets)
+        if batch:
+            self.replay.bytes_sent += sum(len(data) for data in batch)
+            self.forward_batch_down(batch)
+            # The chain copies what it keeps, so the slices can go;
+            # any left would stop Replay.close() unmapping the file.
+            for data in batch:
+                data.release()
+        if self.position >= len(self.offsets):
+            self.linger_or_finish()
+
+    def linger_or_finish(self):
+        if self.finished:
+            return
+        if self.received >= self.expected:
+            self.finish()
+            return
+        if self.closing_at is None:
+            self.closing_at = time.monotonic() + self.linger
+        if time.monotonic() >= self.closing_at:
+            self.finish()
+        else:
+            self.replay.wheel.schedule(self, self.closing_at)
+
+    def handle_timer(self):
+        if self.finished:
+            return
+        if self.closing_at is not None:
+            self.linger_or_finish()
+        else:
+            self.send()
+
+    def handle_pause(self, direction='up'):
+        self.pause_count += 1
+
+    def handle_resume(self, direction='up'):
+        if self.pause_count:
+            self.pause_count -= 1
+            if (not self.pause_count and self.started is not None and
+                    self.closing_at is None and self.timer_slot is None):
+                self.send()
+
+    def handle_packet_up(self, data):
+        self.handle_batch_up((data,))
+
+    def handle_batch_up(self, batch):
+        size = sum(len(data) for data in batch)
+        self.received += size
+        self.replay.bytes_received += size
+        if self.closing_at is not None and self.received >= self.expected:
+            self.finish()
+
+    def handle_close(self, direction='down'):
+        # The output closed.
+        self.finish(failed=self.started is None)
+
+    def finish(self, failed=False):
+        '''
+        Close the chain and tell the replay this session is over.
+        '''
+        if self.finished:
+            return
+        self.finished = True
+        if self.timer_slot is not None:
+            self.replay.wheel.cancel(self)
+        super().handle_close('down')
+        self.replay.session_finished(self, failed)
+
+
+class Replay():
+    '''
+    Replay the connections in a capture LOG file.
+    '''
+    timer_slot = None
+
+    def __init__(self, path, session=ReplaySession, speed=1.0,
+                 concurrency=None, wheel=None):
+        '''
+        :param str path: The LOG file.
+        :param session: The ReplaySession class to create for each
+          connection.
+        :param float speed: How many times faster than the original to
+          replay, or None to send everything as fast as the chain takes
+          it.
+        :param int concurrency: The most sessions open at once, or None
+          for no limit. Sessions that would open past it wait their
+          turn.
+        :param trixy.timers.TimerWheel wheel: The wheel to time the
+          sessions with; the default wheel if None.
+        '''
+        self.session = session
+        self.speed = speed
+        self.concurrency = concurrency
+        self.wheel = trixy.timers.default_wheel if wheel is None else wheel
+
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
+        if self.view[:len(LOG_MAGIC)] != LOG_MAGIC:
+            self.close()
+            raise ValueError('not a capture log: %s' % path)
+        #: Maps each connection id to the offsets of its records, in
+        #: the order the connections were opened.
+        self.connections = collections.OrderedDict()
+        self.index()
+
+        #: The ids of the connections not started yet.
+        self.waiting = collections.deque(self.connections)
+        self.started = None
+        #: The number of sessions open, started, finished and failed.
+        self.active = 0
+        self.opened = 0
+        self.finished = 0
+        self.failed = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def index(self):
+        view = self.view
+        offset = len(LOG_MAGIC)
+        end = len(view) - RECORD.size
+        while offset <= end:
+            timestamp, conn_id, kind, length = RECORD.unpack_from(
+                view, offset)
+            if offset + RECORD.size + length > len(view):
+                break  # Cut off while being written.
+            offsets = self.connections.get(conn_id)
+            if offsets is None:
+                offsets = self.connections[conn_id] = []
+            offsets.append(offset)
+            offset += RECORD.size + length
+
+    def timestamp(self, offset):
+        return RECORD.unpack_from(self.view, offset)[0]
+
+    @property
+    def done(self):
+        return self.started is not None and not (self.waiting or
+                                                 self.active)
+
+    def start(self):
+        '''
+        Start replaying. The sessions run while the loop in
+        trixy.timers runs, or use run().
+        '''
+        self.started = time.monotonic()
+        if self.connections:
+            self.first = min(self.timestamp(offsets[0])
+                             for offsets in self.connections.values())
+        self.start_due()
+
+    def start_due(self):
+        '''
+        Start the sessions that are due, as far as concurrency allows.
+        '''
+        now = time.monotonic()
+        while self.waiting and (self.concurrency is None or
+                                self.active < self.concurrency):
+            conn_id = self.waiting[0]
+            if self.speed:
+                due = self.started + (
+                    self.timestamp(self.connections[conn_id][0]) -
+                    self.first) / self.speed
+                if due > now:
+                    self.wheel.schedule(self, due)
+                    return
+            self.waiting.popleft()
+            self.active += 1
+            self.opened += 1
+            self.session(self, conn_id).start()
+
+    def handle_timer(self):
+        self.start_due()
+
+    def session_finished(self, session, failed):
+        self.active -= 1
+        if failed:
+            self.failed += 1
+        else:
+            self.finished += 1
+        if self.waiting and self.timer_slot is None:
+            self.start_due()
+
+    def run(self, use_poll=False, map=None):
+        '''
+        Start replaying, and run the loop until every session is over.
+
+        :param bool use_poll: Use poll() instead of select().
+        :param dict map: The socket map; asyncore's default if None.
+        '''
+        if map is None:
+            map = asyncore.socket_map
+        self.start()
+        while not self.done:
+            if map:
+                trixy.timers.loop(1.0, use_poll, map, count=1,
+                                  wheel=self.wheel)
+            else:
+                # Nothing to poll until the next session starts.
+                wait = self.wheel.next_timeout()
+                if wait is None:
+                    return  # Nothing left that could finish them.
+                if wait:
+                    time.sleep(wait)
+                self.wheel.advance()
+
+    def close(self):
+        '''
+        Unmap the file. Sessions still running must not send anything
+        afterwards. The slices of the file each session sends are
+        released once the chain has taken them, so nodes that keep data
+        past the call must copy it, as for any batch.
+        '''
+        self.view.release()
+        self.map.close()
@@ -0,0 +1,230 @@
+'''
+Resolve hostnames without blocking the event loop.
+
+socket.getaddrinfo() blocks until the name server answers, and while it
+does every other connection handled by the loop waits too. The Resolver
+runs lookups on a small thread pool instead, hands the results back to
+the loop thread, and caches them so that repeated connections to the
+same host do not need another lookup. Concurrent lookups for the same
+name share a single query, and failures are cached for a shorter time
+so that a bad name does not cause a storm of queries.
+
+Addresses that are already numeric are answered immediately without
+using the thread pool or the cache.
+'''
+import asyncio
+import concurrent.futures
+import copy
+import socket
+import time
+from trixy.waker import LoopWaker
+
+
+def address_family(host):
+    '''
+    Return AF_INET6 if `host` is an IPv6 address, otherwise AF_INET.
+    Names are not looked up.
+
+    :param str host: A hostname or address.
+    '''
+    try:
+        socket.inet_pton(socket.AF_INET6, host)
+    except (OSError, TypeError):
+        return socket.AF_INET
+    return socket.AF_INET6
+
+
+#: The old name of trixy.waker.LoopWaker.
+ResolverWaker = LoopWaker
+
+
+class Resolver():
+    '''
+    A caching, non-blocking wrapper around socket.getaddrinfo().
+    '''
+
+    def __init__(self, ttl=300, negative_ttl=30, max_size=4096,
+                 max_workers=4):
+        '''
+        :param float ttl: Seconds to cache a successful lookup.
+        :param float negative_ttl: Seconds to cache a failed lookup.
+        :param int max_size: The maximum number of cached lookups. The
+          oldest entry is dropped to make room for a new one.
+        :param int max_workers: The number of lookups that may run at
+          the same time.
+        '''
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self.max_workers = max_workers
+
+        #: Maps a lookup key to an (expiry time, result) tuple. The
+        #: result is either a getaddrinfo() list or an exception.
+        self.cache = {}
+        #: Maps a lookup key to the callbacks waiting for it.
+        self.pending = {}
+        #: Maps a lookup key to an asyncio future waiting for it.
+        self.pending_futures = {}
+
+        #: Lookups answered from the cache.
+        self.hits = 0
+        #: Lookups that had to query the name server.
+        self.misses = 0
+        #: Lookups that joined a query already in progress.
+        self.coalesced = 0
+
+        self.executor = None
+        self.waker = None
+
+    def stats(self):
+        '''
+        Return the resolver's counters as a dictionary.
+        '''
+        return {'hits': self.hits, 'misses': self.misses,
+                'coalesced': self.coalesced, 'cached': len(self.cache),
+                'in_flight': len(self.pending) + len(self.pending_futures)}
+
+    def clear(self):
+        '''
+        Forget all cached results.
+        '''
+        self.cache.clear()
+
+    @staticmethod
+    def numeric_lookup(host, port, family=0, type=socket.SOCK_STREAM):
+        '''
+        Return the getaddrinfo() result for a numeric host, or None if
+        the host is a name that needs to be looked up.
+        '''
+        try:
+            return socket.getaddrinfo(host, port, family, type, 0,
+                                      socket.AI_NUMERICHOST)
+        except socket.gaierror:
+            return None
+
+    def cached(self, key):
+        '''
+        Return the cached result for `key`, or None if there is none or
+        it has expired.
+        '''
+        entry = self.cache.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self.cache[key]
+            return None
+        self.hits += 1
+        return entry[1]
+
+    def store(self, key, result):
+        if len(self.cache) >= self.max_size:
+            del self.cache[next(iter(self.cache))]
+        if isinstance(result, Exception):
+            ttl = self.negative_ttl
+        else:
+            ttl = self.ttl
+        self.cache[key] = (time.monotonic() + ttl, result)
+
+    def submit(self, key):
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                self.max_workers, thread_name_prefix='trixy-resolver')
+        self.misses += 1
+        return self.executor.submit(socket.getaddrinfo, *key)
+
+    def resolve(self, host, port, callback, family=0,
+                type=socket.SOCK_STREAM):
+        '''
+        Look up `host` and `port` for use with the asyncore loop. The
+        callback is called on the loop thread with either a getaddrinfo()
+        result list or the exception the lookup failed with. It may be
+        called before this method returns if the answer is already
+        known.
+
+        :param str host: The hostname or address to look up.
+        :param int port: The port to look up.
+        :param callback: Called with the result.
+        '''
+        result = self.numeric_lookup(host, port, family, type)
+        if result is None:
+            key = (host, port, family, type)
+            result = self.cached(key)
+        if result is not None:
+            callback(result)
+            return
+
+        if key in self.pending:
+            self.coalesced += 1
+            self.pending[key].append(callback)
+            return
+
+        if self.waker is None or self.waker.closed:
+            self.waker = LoopWaker()
+        self.pending[key] = [callback]
+        future = self.submit(key)
+        waker = self.waker
+        future.add_done_callback(
+            lambda f: waker.call_soon_threadsafe(self.finish, key, f))
+
+    def finish(self, key, future):
+        try:
+            result = future.result()
+        except Exception as e:
+            result = e
+        self.store(key, result)
+
+        error = None
+        for callback in self.pending.pop(key, ()):
+            try:
+                callback(result)
+            except Exception as e:
+                # Still answer the other callbacks; raise it afterwards.
+                error = error or e
+        if not self.pending and self.waker is not None:
+            # Let asyncore.loop() exit once nothing else is running.
+            self.waker.close()
+            self.waker = None
+        if error is not None:
+            raise error
+
+    async def resolve_async(self, host, port, family=0,
+                            type=socket.SOCK_STREAM):
+        '''
+        Look up `host` and `port` for use with an asyncio loop.
+
+        :returns: The getaddrinfo() result list.
+        :raises OSError: If the lookup failed.
+        '''
+        result = self.numeric_lookup(host, port, family, type)
+        if result is None:
+            key = (host, port, family, type)
+            result = self.cached(key)
+        if result is None:
+            future = self.pending_futures.get(key)
+            if future is not None:
+                self.coalesced += 1
+            else:
+                future = asyncio.wrap_future(self.submit(key))
+                self.pending_futures[key] = future
+                future.add_done_callback(
+                    lambda f: self.finish_async(key, f))
+            try:
+                result = await asyncio.shield(future)
+            except OSError as e:
+                result = e
+        if isinstance(result, Exception):
+            # The cached exception is shared; raising it again would add
+            # to its traceback every time.
+            raise copy.copy(result)
+        return result
+
+    def finish_async(self, key, future):
+        del self.pending_futures[key]
+        if future.cancelled():
+            return
+        error = future.exception()
+        self.store(key, error if error is not None else future.result())
+
+
+#: The resolver used by outputs that are not given one.
+default_resolver = Resolver()
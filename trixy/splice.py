@@ -0,0 +1,88 @@
+'''
+Move data between two sockets without copying it into Python. When an
+input and an output are joined by a chain of opaque nodes (nodes that
+promise not to look at or alter the data passing through them), the
+bytes can be moved from one socket to the other with os.splice()
+through a pipe so they never leave the kernel.
+
+os.splice() is only available on Linux with Python 3.10 or newer. On
+other platforms `splice_supported` is False and the connection classes
+fall back to recv_into() with a reused buffer.
+'''
+import errno
+import os
+
+
+#: True when os.splice() can be used on this platform.
+splice_supported = hasattr(os, 'splice')
+
+#: Errors that mean the other end of a socket has gone away.
+DISCONNECTED = frozenset((errno.ECONNRESET, errno.ENOTCONN, errno.ESHUTDOWN,
+                          errno.ECONNABORTED, errno.EPIPE, errno.EBADF))
+
+
+class SpliceChannel():
+    '''
+    A pipe holding data on its way from a source socket to a
+    destination socket.
+    '''
+
+    def __init__(self):
+        self.read_fd, self.write_fd = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+        #: The number of bytes in the pipe that have not been written.
+        self.pending = 0
+        #: The connection the pending data was read from.
+        self.source = None
+
+    def fill(self, src_fd, size):
+        '''
+        Move up to `size` bytes from `src_fd` into the pipe.
+
+        :param int src_fd: The file descriptor to read from.
+        :param int size: The maximum number of bytes to move.
+        :returns: The number of bytes moved (0 at end of file), or None
+          if no data was available.
+        :raises ConnectionError: If the source socket has disconnected.
+        '''
+        try:
+            num = os.splice(src_fd, self.write_fd, size,
+                            flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+        except BlockingIOError:
+            return None
+        except OSError as e:
+            if e.errno in DISCONNECTED:
+                raise ConnectionError(e.errno, e.strerror)
+            raise
+        self.pending += num
+        return num
+
+    def drain(self, dst_fd):
+        '''
+        Move as much pending data as possible from the pipe to
+        `dst_fd`.
+
+        :param int dst_fd: The file descriptor to write to.
+        :returns: The number of bytes still waiting in the pipe.
+        :raises ConnectionError: If the destination socket has
+          disconnected.
+        '''
+        while self.pending:
+            try:
+                num = os.splice(self.read_fd, dst_fd, self.pending,
+                                flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+            except BlockingIOError:
+                break
+            except OSError as e:
+                if e.errno in DISCONNECTED:
+                    raise ConnectionError(e.errno, e.strerror)
+                raise
+            if num == 0:
+                break
+            self.pending -= num
+        return self.pending
+
+    def close(self):
+        os.close(self.read_fd)
+        os.close(self.write_fd)
+        self.pending = 0
+        self.source = None
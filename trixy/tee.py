@@ -0,0 +1,197 @@
+'''
+Mirror the data moving down a chain to other outputs.
+
+A node with several downstream nodes hands every packet to each of
+them, and the slowest decides how fast the chain goes: when any of
+them has too much data waiting to be sent, the input stops reading.
+That is right for the nodes the chain depends on, but not for a copy
+of the traffic sent to a monitoring or logging service.
+
+TeeProcessor forwards data to its downstream nodes, the primary path,
+as usual, and also to any number of mirrors. Each mirror has a queue
+of its own. A mirror that cannot keep up fills its queue instead of
+pausing the input, and once the queue is full its drop policy decides
+what happens. All mirrors share one read-only copy of each packet, so
+adding mirrors does not add copies.
+
+For example::
+
+   import trixy.tee
+
+   class ExampleInput(trixy.TrixyInput):
+       def __init__(self, sock, addr):
+           super().__init__(sock, addr)
+           tee = trixy.tee.TeeProcessor()
+           self.connect_node(tee)
+           tee.connect_node(trixy.TrixyOutput('127.0.0.1', 8000))
+           tee.add_mirror(trixy.TrixyOutput('127.0.0.1', 9000))
+
+Data sent back up by a mirror is discarded, and a mirror closing or
+failing to connect does not affect the primary path.
+'''
+import collections
+import trixy
+from trixy.buffers import as_bytes
+
+
+#: Drop packets that arrive while the queue is full.
+DROP_NEWEST = 'drop-newest'
+#: Drop the oldest queued packets to make room.
+DROP_OLDEST = 'drop-oldest'
+#: Close the mirror, so that it never sees a stream with gaps in it.
+CLOSE = 'close'
+
+
+class MirrorBranch(trixy.TrixyNode):
+    '''
+    The node above a mirror: it queues the packets the mirror is not
+    ready for, and keeps the mirror's requests and replies from
+    reaching the rest of the chain.
+    '''
+
+    def __init__(self, max_queued, policy):
+        '''
+        :param int max_queued: The most bytes to queue.
+        :param str policy: DROP_NEWEST, DROP_OLDEST or CLOSE.
+        '''
+        super().__init__()
+        self.max_queued = max_queued
+        self.policy = policy
+        self.queue = collections.deque()
+        #: The number of bytes in the queue.
+        self.queued = 0
+        #: The number of bytes dropped.
+        self.dropped = 0
+        self.paused = False
+        #: True once the mirror is closed or closing.
+        self.closed = False
+        #: True while a close waits for the queue to be sent.
+        self.closing = False
+
+    def push(self, batch):
+        '''
+        Send a batch of bytes objects to the mirror, or queue it.
+        '''
+        if self.closed:
+            return
+        if not self.paused and not self.queue:
+            self.forward_batch_down(batch)
+            return
+
+        for data in batch:
+            if self.queued + len(data) > self.max_queued:
+                if self.policy == CLOSE:
+                    self.dropped += self.queued + len(data)
+                    self.queue.clear()
+                    self.queued = 0
+                    self.closed = True
+                    super().handle_close('down')
+                    return
+                if self.policy == DROP_NEWEST:
+                    self.dropped += len(data)
+                    continue
+                while self.queue and self.queued + len(data) > self.max_queued:
+                    old = self.queue.popleft()
+                    self.queued -= len(old)
+                    self.dropped += len(old)
+                if len(data) > self.max_queued:
+                    self.dropped += len(data)
+                    continue
+            self.queue.append(data)
+            self.queued += len(data)
+
+    def flush(self):
+        while self.queue and not self.paused:
+            data = self.queue.popleft()
+            self.queued -= len(data)
+            self.forward_packet_down(data)
+        if self.closing and not self.queue:
+            self.closing = False
+            super().handle_close('down')
+
+    def handle_pause(self, direction='up'):
+        self.paused = True
+
+    def handle_resume(self, direction='up'):
+        self.paused = False
+        self.flush()
+
+    def handle_packet_up(self, data):
+        pass
+
+    def handle_batch_up(self, batch):
+        pass
+
+    def handle_output_connected(self, output):
+        pass
+
+    def handle_output_failed(self, output, error):
+        self.closed = True
+        self.queue.clear()
+        self.queued = 0
+
+    def handle_close(self, direction='down'):
+        if direction == 'up':
+            # The mirror went away.
+            self.closed = True
+            self.queue.clear()
+            self.queued = 0
+            return
+        if self.closed:
+            return
+        self.closed = True
+        if self.queue:
+            self.closing = True
+        else:
+            super().handle_close('down')
+
+
+class TeeProcessor(trixy.TrixyProcessor):
+    '''
+    Forward data moving down the chain to the downstream nodes and to
+    mirrors that cannot slow the chain down.
+    '''
+    #: The most bytes queued for each mirror by default.
+    max_queued = 1 << 20
+    #: What a mirror does with data that does not fit in its queue by
+    #: default: DROP_NEWEST, DROP_OLDEST or CLOSE.
+    policy = CLOSE
+
+    def __init__(self):
+        super().__init__()
+        #: The MirrorBranch of each mirror.
+        self.mirrors = []
+
+    def add_mirror(self, node, max_queued=None, policy=None):
+        '''
+        Send a copy of the data moving down the chain to `node`.
+
+        :param trixy.TrixyNode node: The mirror, usually an output.
+        :param int max_queued: Overrides the max_queued class attribute.
+        :param str policy: Overrides the policy class attribute.
+        :returns: The MirrorBranch linking the mirror.
+        '''
+        branch = MirrorBranch(
+            self.max_queued if max_queued is None else max_queued,
+            self.policy if policy is None else policy)
+        self.mirrors.append(branch)
+        branch.connect_node(node)
+        return branch
+
+    def handle_packet_down(self, data):
+        self.handle_batch_down((data,))
+
+    def handle_batch_down(self, batch):
+        self.forward_batch_down(batch)
+        if self.mirrors:
+            # One copy for all mirrors; the batch's memory is reused
+            # once this call returns.
+            shared = [as_bytes(data) for data in batch]
+            for branch in self.mirrors:
+                branch.push(shared)
+
+    def handle_close(self, direction='down'):
+        # Either end of the primary path closing ends the mirrored stream.
+        for branch in self.mirrors:
+            branch.handle_close('down')
+        super().handle_close(direction)
@@ -0,0 +1,250 @@
+'''
+Timeouts for many connections on the asyncore loop.
+
+asyncore has no timers of its own. A TimerWheel keeps scheduled items
+in slots, one per tick of time, on several levels: the first level has
+a slot for each of the next 64 ticks, the next a slot for each of the
+following 64 groups of 64 ticks, and so on. Adding or cancelling an
+item costs the same however many are scheduled, and each tick only
+looks at the items in one slot. Items further out are moved down a
+level as their time comes closer.
+
+The scheduled items are the connections themselves, so there is no
+separate timer object per connection. A connection keeps one entry in
+the wheel, for the earliest of its deadlines, and does not touch the
+wheel when it is active; its idle deadline is checked and pushed back
+only when the entry comes due.
+
+Timeouts fire on time while the loop is run with loop() from this
+module, which is used in place of asyncore.loop()::
+
+   import trixy
+   import trixy.timers
+
+   class ExampleInput(trixy.TrixyInput):
+       idle_timeout = 300
+
+   trixy.TrixyServer(ExampleInput, '0.0.0.0', 8080)
+   trixy.timers.loop()
+
+Under asyncore.loop() nothing advances the wheel. Connections notice
+that their own timer is overdue the next time the loop polls them and
+have the wheel fire it with the loop's next events, so timeouts still
+fire, but up to the loop's poll timeout late.
+'''
+import asyncore
+import math
+import select
+import time
+from trixy.waker import LoopWaker
+
+
+class TimerWheel():
+    '''
+    A hierarchical timing wheel. Items are any objects with a
+    `timer_slot` attribute (None while not scheduled) and a
+    handle_timer() method, which is called once their deadline has
+    passed.
+    '''
+    #: Seconds the wheel may go without being advanced, while an item is
+    #: overdue, before it is taken to not be advanced at all; see
+    #: overdue().
+    stalled_after = 1.0
+
+    def __init__(self, resolution=0.1, slot_bits=6, levels=4):
+        '''
+        :param float resolution: The length of a tick, in seconds.
+          Items fire up to this long after their deadline.
+        :param int slot_bits: Each level has 2 ** slot_bits slots.
+        :param int levels: The number of levels. Deadlines beyond the
+          last level are moved down once they come within it.
+        '''
+        self.resolution = resolution
+        self.slot_bits = slot_bits
+        self.mask = (1 << slot_bits) - 1
+        self.wheels = [[set() for i in range(1 << slot_bits)]
+                       for level in range(levels)]
+        #: The last tick that was processed.
+        self.tick = int(time.monotonic() / resolution)
+        #: The number of scheduled items.
+        self.count = 0
+        #: When advance() was last called, from time.monotonic().
+        self.advanced_at = time.monotonic()
+        #: Wakes the loop up to fire deferred items; see defer().
+        self.waker = None
+
+    def __len__(self):
+        return self.count
+
+    def schedule(self, item, deadline):
+        '''
+        Call item.handle_timer() once time.monotonic() reaches
+        `deadline`, replacing any earlier schedule of `item`.
+
+        :param item: The item.
+        :param float deadline: The time, from time.monotonic().
+        '''
+        self.cancel(item)
+        tick = max(math.ceil(deadline / self.resolution), self.tick + 1)
+        item.timer_tick = tick
+        self.insert(item, tick)
+        self.count += 1
+
+    def cancel(self, item):
+        '''
+        Unschedule `item`, if it is scheduled.
+        '''
+        if item.timer_slot is not None:
+            item.timer_slot.discard(item)
+            item.timer_slot = None
+            self.count -= 1
+
+    def insert(self, item, tick):
+        delta = tick - self.tick
+        bits = self.slot_bits
+        last = len(self.wheels) - 1
+        for level, slots in enumerate(self.wheels):
+            if delta < 1 << (bits * (level + 1)):
+                break
+        else:
+            # Too far out for the wheel; park it in the furthest slot
+            # and look again when that slot is moved down.
+            level = last
+            tick = self.tick + (1 << (bits * (level + 1))) - 1
+            slots = self.wheels[last]
+        slot = slots[(tick >> (bits * level)) & self.mask]
+        slot.add(item)
+        item.timer_slot = slot
+
+    def advance(self, now=None):
+        '''
+        Process every tick up to `now`, calling handle_timer() on the
+        items that are due.
+
+        :param float now: The current time.monotonic(), if known.
+        '''
+        if now is None:
+            now = time.monotonic()
+        self.advanced_at = now
+        target = int(now / self.resolution)
+        if not self.count:
+            self.tick = max(self.tick, target)
+            return
+        bits = self.slot_bits
+        while self.tick < target:
+            self.tick += 1
+            tick = self.tick
+            # Move items down from the higher levels whose slot has come
+            # round, highest first so they can fall more than one level.
+            for level in range(len(self.wheels) - 1, 0, -1):
+                if tick & ((1 << (bits * level)) - 1):
+                    continue
+                slot = self.wheels[level][(tick >> (bits * level)) &
+                                          self.mask]
+                items = list(slot)
+                slot.clear()
+                for item in items:
+                    self.insert(item, item.timer_tick)
+
+            slot = self.wheels[0][tick & self.mask]
+            if not slot:
+                continue
+            items = list(slot)
+            slot.clear()
+            self.count -= len(items)
+            for item in items:
+                item.timer_slot = None
+            for item in items:
+                item.handle_timer()
+            if not self.count:
+                self.tick = target
+                return
+
+    def overdue(self, item, now=None):
+        '''
+        Return True if `item` is overdue and the wheel is not being
+        advanced to fire it, so the caller should fire it itself.
+
+        :param item: A scheduled item.
+        :param float now: The current time.monotonic(), if known.
+        '''
+        if now is None:
+            now = time.monotonic()
+        return (item.timer_tick * self.resolution + self.stalled_after < now
+                and self.advanced_at + self.stalled_after < now)
+
+    def defer(self, item):
+        '''
+        Unschedule `item`, which is overdue, and call its handle_timer()
+        with the loop's next events. It cannot be called from the poll
+        that found it overdue: closing a connection there could close
+        sockets the poll is about to wait on.
+
+        :param item: A scheduled item.
+        '''
+        self.cancel(item)
+        if self.waker is None or self.waker.closed:
+            self.waker = LoopWaker()
+        self.waker.call_soon_threadsafe(self.fire_deferred, item)
+
+    def fire_deferred(self, item):
+        try:
+            item.handle_timer()
+        finally:
+            waker = self.waker
+            if not self.count and waker is not None and not waker.callbacks:
+                # Let asyncore.loop() exit once nothing else is running.
+                waker.close()
+                self.waker = None
+
+    def next_timeout(self, now=None):
+        '''
+        Return the number of seconds until the wheel next needs to be
+        advanced, or None if nothing is scheduled.
+
+        :param float now: The current time.monotonic(), if known.
+        '''
+        if not self.count:
+            return None
+        if now is None:
+            now = time.monotonic()
+        level = self.wheels[0]
+        for offset in range(1, len(level) + 1):
+            tick = self.tick + offset
+            if level[tick & self.mask] or not tick & self.mask:
+                # Something is due, or a higher level moves down.
+                return max(0.0, tick * self.resolution - now)
+
+
+#: The wheel used by connections that do not set their own.
+default_wheel = TimerWheel()
+
+
+def loop(timeout=30.0, use_poll=False, map=None, count=None, wheel=None):
+    '''
+    Run the asyncore loop like asyncore.loop(), advancing `wheel`
+    between polls and never waiting past its next deadline.
+
+    :param float timeout: The longest time to wait in one poll.
+    :param bool use_poll: Use poll() instead of select(), if available.
+    :param dict map: The socket map; asyncore's default if None.
+    :param int count: The number of polls, or None to run until the
+      map is empty.
+    :param TimerWheel wheel: The wheel; the default wheel if None.
+    '''
+    if map is None:
+        map = asyncore.socket_map
+    if wheel is None:
+        wheel = default_wheel
+    if use_poll and hasattr(select, 'poll'):
+        poll = asyncore.poll2
+    else:
+        poll = asyncore.poll
+
+    while map and (count is None or count > 0):
+        now = time.monotonic()
+        wheel.advance(now)
+        wait = wheel.next_timeout(now)
+        poll(timeout if wait is None else min(timeout, wait), map)
+        if count is not None:
+            count -= 1
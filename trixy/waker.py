@@ -0,0 +1,66 @@
+'''
+Wake the asyncore loop from other threads.
+
+Threads that finish work for the loop, such as the resolver's lookups
+and the executor's jobs, cannot call into the loop's connections
+directly. A LoopWaker queues their callbacks and writes a byte to a
+socket pair, so the loop wakes up from its poll and runs them on its
+own thread. The timer wheel uses one the same way to fire timers after
+the current poll.
+'''
+import asyncore
+import collections
+import socket
+
+
+class LoopWaker(asyncore.dispatcher):
+    '''
+    Run callbacks queued from other threads on the asyncore loop. A
+    byte written to a socket pair wakes the loop up.
+    '''
+
+    def __init__(self, map=None):
+        self.wake_socket, sock = socket.socketpair()
+        self.wake_socket.setblocking(False)
+        super().__init__(sock, map)
+        self.callbacks = collections.deque()
+        self.closed = False
+
+    def call_soon_threadsafe(self, func, *args):
+        '''
+        Schedule `func(*args)` to run on the loop thread. May be called
+        from any thread.
+        '''
+        self.callbacks.append((func, args))
+        try:
+            self.wake_socket.send(b'\x00')
+        except (BlockingIOError, OSError):
+            pass  # Already awake, or closed.
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        try:
+            while self.socket.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while self.callbacks:
+            func, args = self.callbacks.popleft()
+            try:
+                func(*args)
+            except Exception:
+                # Report it, but keep the waker and the other callbacks.
+                nil, t, v, tbinfo = asyncore.compact_traceback()
+                self.log_info('uncaptured python exception in callback '
+                              '%r (%s:%s %s)' % (func, t, v, tbinfo),
+                              'error')
+
+    def handle_close(self):
+        self.close()
+
+    def close(self):
+        self.closed = True
+        super().close()
+        self.wake_socket.close()
@@ -0,0 +1,172 @@
+'''
+The worker pool runs a Trixy server in several processes at once so
+that a proxy is not limited to a single core. Every worker binds the
+same host and port with SO_REUSEPORT and the kernel balances incoming
+connections between them.
+
+A supervisor process starts the workers, restarts any worker that
+crashes, and on SIGTERM or SIGINT asks the workers to drain: each
+worker stops accepting new connections and exits once its existing
+connections have closed (or the drain timeout has passed).
+'''
+import asyncio
+import asyncore
+import os
+import signal
+import time
+import traceback
+import trixy
+import trixy.aio
+import trixy.timers
+
+
+class TrixyWorkerPool():
+    '''
+    Pre-fork a number of worker processes that each run a server for
+    the same input class, host, and port.
+    '''
+
+    def __init__(self, tinput, host, port, workers=None,
+                 server=trixy.TrixyServer, drain_timeout=30,
+                 restart_delay=1):
+        '''
+        :param TrixyInput tinput: The input class each worker's server
+          instantiates for incoming connections.
+        :param str host: The host to listen on.
+        :param int port: The port to listen on.
+        :param int workers: The number of worker processes to run.
+          (Default: one per CPU.)
+        :param server: The server class to run in each worker. Either
+          TrixyServer or trixy.aio.AsyncTrixyServer (or a subclass).
+        :param float drain_timeout: The maximum number of seconds a
+          worker waits for open connections to close on shutdown.
+        :param float restart_delay: The number of seconds to wait before
+          restarting a worker that crashed.
+        '''
+        self.tinput = tinput
+        self.host = host
+        self.port = port
+        self.workers = workers or os.cpu_count() or 1
+        self.server = server
+        self.drain_timeout = drain_timeout
+        self.restart_delay = restart_delay
+
+        self.pids = set()
+        self.running = False
+
+    def run(self):
+        '''
+        Start the workers and supervise them until a shutdown signal is
+        received. This must be called from the main thread.
+        '''
+        self.running = True
+        signal.signal(signal.SIGTERM, self.handle_shutdown_signal)
+        signal.signal(signal.SIGINT, self.handle_shutdown_signal)
+
+        for i in range(self.workers):
+            self.spawn_worker()
+
+        while self.pids:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            except InterruptedError:
+                continue
+            self.pids.discard(pid)
+            self.handle_worker_exit(pid, status)
+
+    def stop(self):
+        '''
+        Ask all workers to drain and exit, and stop restarting them.
+        '''
+        self.running = False
+        for pid in list(self.pids):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                self.pids.discard(pid)
+
+    def handle_shutdown_signal(self, signum, frame):
+        self.stop()
+
+    def handle_worker_exit(self, pid, status):
+        '''
+        A worker has exited. Restart it if it was not asked to stop.
+
+        :param int pid: The process id of the worker.
+        :param int status: The exit status as returned by os.wait().
+        '''
+        if self.running:
+            time.sleep(self.restart_delay)
+            if self.running:
+                self.spawn_worker()
+
+    def spawn_worker(self):
+        '''
+        Fork a new worker process.
+        '''
+        pid = os.fork()
+        if pid:
+            self.pids.add(pid)
+            return pid
+
+        status = 1
+        try:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            self.run_worker()
+            status = 0
+        except BaseException:
+            # os._exit() skips the usual report of the exception.
+            traceback.print_exc()
+        finally:
+            os._exit(status)
+
+    def run_worker(self):
+        '''
+        Run the server in the current (worker) process until it has
+        been drained.
+        '''
+        if issubclass(self.server, trixy.aio.AsyncTrixyServer):
+            self.run_asyncio_worker()
+        else:
+            self.run_asyncore_worker()
+
+    def run_asyncore_worker(self):
+        server = self.server(self.tinput, self.host, self.port,
+                             reuse_port=True)
+        deadline = []
+
+        def drain(signum, frame):
+            server.close()
+            deadline.append(time.monotonic() + self.drain_timeout)
+        signal.signal(signal.SIGTERM, drain)
+
+        while asyncore.socket_map:
+            trixy.timers.loop(timeout=1, count=1)
+            if deadline and time.monotonic() > deadline[0]:
+                break
+
+    def run_asyncio_worker(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        server = self.server(self.tinput, self.host, self.port,
+                             reuse_port=True, loop=loop)
+
+        async def drain():
+            deadline = loop.time() + self.drain_timeout
+            while loop.time() < deadline:
+                if all(conn.closed for conn in server.connections):
+                    break
+                await asyncio.sleep(0.1)
+            loop.stop()
+
+        def handle_term():
+            server.close()
+            loop.create_task(drain())
+        loop.add_signal_handler(signal.SIGTERM, handle_term)
+
+        try:
+            loop.run_forever()
+        finally:
+            loop.close()